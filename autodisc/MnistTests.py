@@ -3,11 +3,17 @@
 #########################################
 
 import numpy as np
+import os
+import sys
 import theano
 import theano.tensor as T
 
 from DexNet import DEX_NET
-from load_data import load_udm, load_udm_ss, load_mnist
+# the data loaders are shared with the other packages (see shared/README.md)
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (repo_dir in sys.path):
+    sys.path.append(repo_dir)
+from shared.load_data import load_udm, load_udm_ss, load_mnist
 import NetTrainers as NT
 
 def init_biases(NET, b_init=0.0):
@@ -3,12 +3,20 @@
 #########################################
 
 import numpy as np
+import os
+import sys
 import theano
 import theano.tensor as T
 import theano.tensor.shared_randomstreams
 
 from FrankeNet import SS_DEV_NET
-from load_data import load_udm, load_udm_ss, load_mnist
+# the data loaders and sweep runner are shared with the other packages (see
+# shared/README.md)
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (repo_dir in sys.path):
+    sys.path.append(repo_dir)
+from shared.load_data import load_udm, load_udm_ss, load_mnist, split_udm_ss, share_udm
+import shared.sweep_runner as SR
 import NetTrainers as NT
 
 def init_biases(NET, b_init=0.0):
@@ -21,23 +29,30 @@ def init_biases(NET, b_init=0.0):
         layer.b.set_value(b_const)
     return
 
-def train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count=1000):
-    """Run semisupervised DEV-regularized test."""
+def train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count=1000, udm_data=None):
+    """Run semisupervised DEV-regularized test.
+
+    If udm_data is given, it should be in-memory MNIST data as returned by
+    load_udm(as_shared=False), which will be split instead of reloading.
+    """
 
     # Load some data to train/validate/test with
-    dataset = 'data/mnist.pkl.gz'
-    datasets = load_udm_ss(dataset, su_count, rng)
+    if udm_data is None:
+        dataset = 'data/mnist.pkl.gz'
+        datasets = load_udm_ss(dataset, su_count, rng)
+    else:
+        datasets = split_udm_ss(udm_data, su_count, rng)
 
     # Tell the net that it's semisupervised, which will force it to use only
     # unlabeled examples for computing the DEV regularizer.
     NET.is_semisupervised = 1
 
     # Run training on the given NET
-    NT.train_ss_mlp(NET=NET, \
+    result = NT.train_ss_mlp(NET=NET, \
         mlp_params=mlp_params, \
         sgd_params=sgd_params, \
         datasets=datasets)
-    return
+    return result
 
 def train_mlp(NET, mlp_params, sgd_params):
     """Run mlp training test."""
@@ -46,25 +61,28 @@ def train_mlp(NET, mlp_params, sgd_params):
     #dataset = 'data/mnist.pkl.gz'
     #datasets = load_udm(dataset)
     dataset = 'data/mnist_batches.npz'
-    datasets = load_mnist(dataset)
+    datasets = load_mnist(dataset, zero_mean=False)
 
     # Tell the net that it's not semisupervised, which will force it to use
     # _all_ examples for computing the DEV regularizer.
     NET.is_semisupervised = 0
 
     # Train the net
-    NT.train_mlp(NET=NET, \
+    result = NT.train_mlp(NET=NET, \
         mlp_params=mlp_params, \
         sgd_params=sgd_params, \
         datasets=datasets)
-    return
+    return result
 
-def train_dae(NET, dae_layer, mlp_params, sgd_params):
+def train_dae(NET, dae_layer, mlp_params, sgd_params, udm_data=None):
     """Run DAE training test."""
 
     # Load some data to train/validate/test with
-    dataset = 'data/mnist.pkl.gz'
-    datasets = load_udm(dataset)
+    if udm_data is None:
+        dataset = 'data/mnist.pkl.gz'
+        datasets = load_udm(dataset)
+    else:
+        datasets = share_udm(udm_data)
 
     # Run denoising autoencoder training on the given layer of NET
     NT.train_dae(NET=NET, \
@@ -74,8 +92,8 @@ def train_dae(NET, dae_layer, mlp_params, sgd_params):
         datasets=datasets)
     return
 
-def batch_test_ss_mlp(test_count=10, su_count=1000):
-    """Run multiple semisupervised learning tests."""
+def batch_test_ss_mlp(test_count=10, su_count=1000, proc_count=None, threads_per_proc=1):
+    """Run multiple semisupervised learning tests, in parallel."""
     # Set some reasonable sgd parameters
     sgd_params = {}
     sgd_params['start_rate'] = 0.1
@@ -98,8 +116,9 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
     # Goofy symbolic sacrament to Theano
     x_in = T.matrix('x_in')
 
-    # Run tests with different sorts of regularization
-    for test_num in range(test_count):
+    # Run tests with different sorts of regularization, one test per worker
+    def run_test(test_num, udm_data):
+        results = []
         """
         # Run test with no droppish regularization
         sgd_params['result_tag'] = "ss_raw_s{0:d}_t{1:d}".format(test_num, su_count)
@@ -111,7 +130,8 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
         NET = SS_DEV_NET(rng=rng, input=x_in, params=mlp_params)
         init_biases(NET, b_init=0.1)
         rng = np.random.RandomState(test_num)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         # Run test with standard dropout on supervised examples
         sgd_params['result_tag'] = "ss_sde_s{0:d}_t{1:d}".format(test_num, su_count)
         sgd_params['mlp_type'] = 'sde'
@@ -121,7 +141,8 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
         NET = SS_DEV_NET(rng=rng, input=x_in, params=mlp_params)
         init_biases(NET, b_init=0.1)
         rng = np.random.RandomState(test_num)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         """
         # Run test with DEV regularization on unsupervised examples
         sgd_params['result_tag'] = "ss_dev_s{0:d}_t{1:d}".format(test_num, su_count)
@@ -134,11 +155,21 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
         NET = SS_DEV_NET(rng=rng, input=x_in, params=mlp_params)
         init_biases(NET, b_init=0.1)
         rng = np.random.RandomState(test_num)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
-    return
-
-def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
-    """Run multiple semisupervised learning tests."""
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
+        return results
+
+    # Load the data once, and run the tests across local worker processes,
+    # with all results going into a single file.
+    sgd_params['results_file'] = os.devnull
+    udm_data = load_udm('data/mnist.pkl.gz', as_shared=False)
+    records = SR.run_sweep(run_test, range(test_count), udm_data, \
+            "ss_dev_t{0:d}".format(su_count), proc_count=proc_count, \
+            threads_per_proc=threads_per_proc)
+    return records
+
+def batch_test_ss_mlp_gentle(test_count=10, su_count=1000, proc_count=None, threads_per_proc=1):
+    """Run multiple semisupervised learning tests, in parallel."""
     # Set some reasonable sgd parameters
     sgd_params = {}
     sgd_params['start_rate'] = 0.1
@@ -161,8 +192,9 @@ def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
     # Goofy symbolic sacrament to Theano
     x_in = T.matrix('x_in')
 
-    # Run tests with different sorts of regularization
-    for test_num in range(test_count):
+    # Run tests with different sorts of regularization, one test per worker
+    def run_test(test_num, udm_data):
+        results = []
         rng_seed = test_num
         # Initialize a random number generator for this test
         rng = np.random.RandomState(rng_seed)
@@ -177,30 +209,44 @@ def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
         sgd_params['epochs'] = 5
         NET.set_dev_lams([0.0, 0.0, 0.0])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         # Train with more DEV regularization
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.02, 0.02, 0.02])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         # Train with more DEV regularization
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.04, 0.04, 0.04])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         # Train with more DEV regularization
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.06, 0.06, 0.06])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         # Train with most DEV regularization
         sgd_params['epochs'] = 100
         NET.set_dev_lams([0.1, 0.1, 0.2])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
-    return
-
-def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
+        return results
+
+    # Load the data once, and run the tests across local worker processes,
+    # with all results going into a single file.
+    sgd_params['results_file'] = os.devnull
+    udm_data = load_udm('data/mnist.pkl.gz', as_shared=False)
+    records = SR.run_sweep(run_test, range(test_count), udm_data, \
+            "ss_dev_gentle_t{0:d}".format(su_count), proc_count=proc_count, \
+            threads_per_proc=threads_per_proc)
+    return records
+
+def batch_test_ss_mlp_pt(test_count=10, su_count=1000, proc_count=None, threads_per_proc=1):
     """Setup basic test for semisupervised DEV-regularized MLP."""
 
     # Set some reasonable sgd parameters
@@ -223,7 +269,9 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
     mlp_params['lam_l2a'] = 1e-3
     mlp_params['use_bias'] = 1
 
-    for test_num in range(test_count):
+    # Run a single test, in a sweep worker process
+    def run_test(test_num, udm_data):
+        results = []
         rng_seed = test_num
         sgd_params['result_tag'] = "test_{0:d}".format(test_num)
 
@@ -247,7 +295,7 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
             print("==================================================")
             print("Pretraining hidden layer {0:d}".format(i+1))
             print("==================================================")
-            train_dae(NET, i, mlp_params, sgd_params)
+            train_dae(NET, i, mlp_params, sgd_params, udm_data=udm_data)
 
         # Run semisupervised training on the given MLP
         sgd_params['batch_size'] = 100
@@ -258,24 +306,37 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
         sgd_params['epochs'] = 5
         NET.set_dev_lams([0.01, 0.01, 0.01])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         # Train with more DEV regularization
         sgd_params['top_only'] = False
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.02, 0.02, 0.02])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         # Train with more DEV regularization
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.05, 0.05, 0.08])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
         # Train with most DEV regularization
         sgd_params['epochs'] = 500
         NET.set_dev_lams([0.1, 0.1, 0.2])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
-    return
+        results.append(train_ss_mlp(NET, mlp_params, sgd_params, rng, \
+                su_count, udm_data=udm_data))
+        return results
+
+    # Load the data once, and run the tests across local worker processes,
+    # with all results going into a single file.
+    sgd_params['results_file'] = os.devnull
+    udm_data = load_udm('data/mnist.pkl.gz', as_shared=False)
+    records = SR.run_sweep(run_test, range(test_count), udm_data, \
+            "ss_dev_pt_t{0:d}".format(su_count), proc_count=proc_count, \
+            threads_per_proc=threads_per_proc)
+    return records
 
 def test_dropout_ala_original():
     """Run standard dropout training on MNIST with parameters to reproduce
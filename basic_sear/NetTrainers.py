@@ -1,4 +1,5 @@
 import numpy as np
+import numpy.random as npr
 import os
 import sys
 import time
@@ -10,6 +11,28 @@ from theano.ifelse import ifelse
 import theano.printing
 
 import utils as utils
+# the snapshot evaluator is shared with the other packages (see shared/README.md)
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (repo_dir in sys.path):
+    sys.path.append(repo_dir)
+from shared.async_eval import compile_eval_func, AsyncEvaluator, \
+        log_eval_results
+
+def row_permutation(row_count):
+    """Make a shared vector of row indices, for gathering minibatches."""
+    return theano.shared(value=np.arange(row_count, dtype=np.int32))
+
+def shuffle_rows(perm_var):
+    """
+    Reshuffle the row indices in perm_var.
+
+    Minibatches are gathered with T.take through perm_var, so only this small
+    index vector is regenerated and copied to the device. The (possibly very
+    large) data matrices that it indexes into are never touched.
+    """
+    row_count = perm_var.get_value(borrow=True).shape[0]
+    perm_var.set_value(npr.permutation(row_count).astype(np.int32))
+    return
 
 def train_mlp(
         NET,
@@ -24,6 +47,9 @@ def train_mlp(
     should be a three-tuple, where each item is an (X, Y) pair of observation
     matrix X and class vector Y. The (X, Y) pairs will be used for training,
     validation, and testing respectively.
+
+    Returns a dict with the best validation error, the test error at that
+    point, the epoch at which it occurred, and the full evaluation history.
     """
     initial_learning_rate = sgd_params['start_rate']
     learning_rate_decay = sgd_params['decay_rate']
@@ -33,14 +59,22 @@ def train_mlp(
     wt_norm_bound = sgd_params['wt_norm_bound']
     result_tag = sgd_params['result_tag']
     bias_noise = sgd_params['bias_noise']
-    txt_file_name = "results_mlp_{0}.txt".format(result_tag)
+    eval_freq = sgd_params.get('eval_freq', 1)
+    eval_mem_mb = sgd_params.get('eval_mem_mb', 256)
+    patience = sgd_params.get('patience', None)
+    txt_file_name = sgd_params.get('results_file', \
+            "results_mlp_{0}.txt".format(result_tag))
     img_file_name = "weights_mlp_{0}.png".format(result_tag)
+    # per-phase wall-clock profiling (see utils.PhaseProfiler), off by default
+    prof = utils.PhaseProfiler(enabled=sgd_params.get('profile', False), \
+            report_every=sgd_params.get('profile_every', 100), \
+            out_file=sgd_params.get('profile_file', None), tag=result_tag)
 
     ###########################################################################
-    # We will use minibatches for training, as well as for computing stats    #
-    # over the validation and testing sets. For Theano reasons, it will be    #
+    # We will use minibatches for training. For Theano reasons, it will be    #
     # easiest if we set up arrays storing the start/end index of each batch   #
-    # w.r.t. the relevant observation/class matrices/vectors.                 #
+    # w.r.t. the relevant observation/class matrices/vectors. Validation and  #
+    # testing are done by an AsyncEvaluator, in its own process.              #
     ###########################################################################
     # Get the training observations and classes
     Xtr, Ytr = (datasets[0][0], T.cast(datasets[0][1], 'int32'))
@@ -50,19 +84,12 @@ def train_mlp(
             for i in range(tr_batches)]
     tr_bidx = theano.shared(value=np.asarray(tr_bidx, dtype=theano.config.floatX))
     tr_bidx = T.cast(tr_bidx, 'int32')
+    # Minibatches are gathered through a permutation of the row indices, so
+    # that reshuffling only has to regenerate the permutation.
+    tr_perm = row_permutation(tr_samples)
     # Get the validation and testing observations and classes
-    Xva, Yva = (datasets[1][0], T.cast(datasets[1][1], 'int32'))
-    Xte, Yte = (datasets[2][0], T.cast(datasets[2][1], 'int32'))
-    va_samples = Xva.get_value(borrow=True).shape[0]
-    te_samples = Xte.get_value(borrow=True).shape[0]
-    va_batches = int(np.ceil(va_samples / 100.))
-    te_batches = int(np.ceil(te_samples / 100.))
-    va_bidx = [[i*100, min(va_samples, (i+1)*100)] for i in range(va_batches)]
-    te_bidx = [[i*100, min(te_samples, (i+1)*100)] for i in range(te_batches)]
-    va_bidx = theano.shared(value=np.asarray(va_bidx, dtype=theano.config.floatX))
-    te_bidx = theano.shared(value=np.asarray(te_bidx, dtype=theano.config.floatX))
-    va_bidx = T.cast(va_bidx, 'int32')
-    te_bidx = T.cast(te_bidx, 'int32')
+    va_samples = datasets[1][0].get_value(borrow=True).shape[0]
+    te_samples = datasets[2][0].get_value(borrow=True).shape[0]
 
     # Print some useful information about the dataset
     print "dataset info:"
@@ -97,21 +124,11 @@ def train_mlp(
                    NET.dev_reg_loss(y), NET.raw_reg_loss]
 
     ############################################################################
-    # Compile testing and validation models. these models are evaluated on     #
-    # batches of the same size as used in training. trying to jam a large      #
-    # validation or test set through the net may take too much memory.         #
+    # Compile a copy of the metric graph that takes the network parameters as  #
+    # inputs. An AsyncEvaluator runs it on parameter snapshots, over large     #
+    # batches of the validation and testing sets, in a separate process.       #
     ############################################################################
-    test_model = theano.function(inputs=[index], \
-            outputs=NET_metrics, \
-            givens={ \
-                x: Xte[te_bidx[index,0]:te_bidx[index,1],:], \
-                y: Yte[te_bidx[index,0]:te_bidx[index,1]]})
-
-    validate_model = theano.function(inputs=[index], \
-            outputs=NET_metrics, \
-            givens={ \
-                x: Xva[va_bidx[index,0]:va_bidx[index,1],:], \
-                y: Yva[va_bidx[index,0]:va_bidx[index,1]]})
+    eval_func = compile_eval_func(x, y, NET_metrics, NET.mlp_params)
 
     ############################################################################
     # prepare momentum and gradient variables, and construct the updates that  #
@@ -175,14 +192,14 @@ def train_mlp(
     train_sde = theano.function(inputs=[epoch, index], outputs=NET_metrics, \
             updates=sde_updates, \
             givens={ \
-                x: Xtr[tr_bidx[index,0]:tr_bidx[index,1],:], \
-                y: Ytr[tr_bidx[index,0]:tr_bidx[index,1]]})
+                x: T.take(Xtr, tr_perm[tr_bidx[index,0]:tr_bidx[index,1]], axis=0), \
+                y: T.take(Ytr, tr_perm[tr_bidx[index,0]:tr_bidx[index,1]])})
 
     train_dev = theano.function(inputs=[epoch, index], outputs=NET_metrics, \
             updates=dev_updates, \
             givens={ \
-                x: Xtr[tr_bidx[index,0]:tr_bidx[index,1],:], \
-                y: Ytr[tr_bidx[index,0]:tr_bidx[index,1]]})
+                x: T.take(Xtr, tr_perm[tr_bidx[index,0]:tr_bidx[index,1]], axis=0), \
+                y: T.take(Ytr, tr_perm[tr_bidx[index,0]:tr_bidx[index,1]])})
 
     # theano function to decay the learning rate, this is separate from the
     # training function because we only want to do this once each epoch instead
@@ -195,12 +212,10 @@ def train_mlp(
     ###############
     print '... training'
 
-    validation_error = 100.
-    test_error = 100.
-    min_validation_error = 100.
-    min_test_error = 100.
+    best = {'va_error': 100., 'te_error': 100., 'epoch': 0, 'history': []}
+    train_log = {}
     epoch_counter = 0
-    start_time = time.clock()
+    start_time = time.time()
 
     results_file = open(txt_file_name, 'wb')
     results_file.write("mlp_type: {0}\n".format(mlp_type))
@@ -209,25 +224,33 @@ def train_mlp(
     results_file.write("dev_lams: {0}\n".format(str(mlp_params['dev_lams'])))
     results_file.flush()
 
-    e_time = time.clock()
+    # start the evaluation worker, with bias noise off in its copy of NET
+    NET.set_bias_noise(0.0)
+    evaluator = AsyncEvaluator(eval_func, NET.mlp_params, \
+            [datasets[1], datasets[2]], mem_mb=eval_mem_mb)
+
+    e_time = time.time()
     # get array of epoch metrics (on a single minibatch)
     epoch_metrics = train_sde(1, 0)
-    validation_metrics = [0. for v in epoch_metrics]
-    test_metrics = [0. for v in epoch_metrics]
-    # compute metrics on testing set
     while epoch_counter < n_epochs:
         ######################################################
         # process some number of minibatches for this epoch. #
         ######################################################
         NET.set_bias_noise(bias_noise)
         epoch_counter = epoch_counter + 1
+        prof.start('shuffle')
+        shuffle_rows(tr_perm)
+        prof.stop('shuffle')
         epoch_metrics = [0. for v in epoch_metrics]
         for b_idx in xrange(tr_batches):
             # compute update for some this minibatch
+            prof.start('train')
             if ((epoch_counter <= 0) or (mlp_type == 'sde')):
                 batch_metrics = train_sde(epoch_counter, b_idx)
             else:
                 batch_metrics = train_dev(epoch_counter, b_idx)
+            prof.stop('train')
+            prof.end_batch()
             epoch_metrics = [(em + bm) for (em, bm) in zip(epoch_metrics, batch_metrics)]
         # Compute 'averaged' values over the minibatches
         epoch_metrics[0] = 100 * (float(epoch_metrics[0]) / tr_samples)
@@ -240,47 +263,37 @@ def train_mlp(
         ######################################################
         # validation, testing, and general diagnostic stuff. #
         ######################################################
-        NET.set_bias_noise(0.0)
-        # compute metrics on validation set
-        validation_metrics = [0. for v in epoch_metrics]
-        for b_idx in xrange(va_batches):
-            batch_metrics = validate_model(b_idx)
-            validation_metrics = [(em + bm) for (em, bm) in zip(validation_metrics, batch_metrics)]
-        # Compute 'averaged' values over the minibatches
-        validation_error = 100 * (float(validation_metrics[0]) / va_samples)
-        validation_metrics[1:] = [(float(v) / va_batches) for v in validation_metrics[1:]]
-        validation_loss = validation_metrics[1]
-
-        # compute test error if new best validation error was found
-        tag = " "
-        # compute metrics on testing set
-        test_metrics = [0. for v in epoch_metrics]
-        for b_idx in xrange(te_batches):
-            batch_metrics = test_model(b_idx)
-            test_metrics = [(em + bm) for (em, bm) in zip(test_metrics, batch_metrics)]
-        # Compute 'averaged' values over the minibatches
-        test_error = 100 * (float(test_metrics[0]) / te_samples)
-        test_metrics[1:] = [(float(v) / te_batches) for v in test_metrics[1:]]
-        test_loss = test_metrics[1]
-        if (validation_error < min_validation_error):
-            min_validation_error = validation_error
-            min_test_error = test_error
-            tag = ", test={0:.2f}".format(test_error)
-        results_file.write("{0:.2f} {1:.2f} {2:.2f} {3:.4f} {4:.4f} {5:.4f}\n".format( \
-                train_error, validation_error, test_error, train_loss, validation_loss, test_loss))
-        results_file.flush()
+        # hand a parameter snapshot to the evaluator, and log any results
+        # that have come back since the last epoch
+        prof.start('eval')
+        if ((epoch_counter % eval_freq) == 0):
+            if evaluator.submit(epoch_counter):
+                train_log[epoch_counter] = (train_error, train_loss)
+        log_eval_results(evaluator.results(), train_log, best, results_file)
+        prof.stop('eval')
 
         # report and save progress.
-        print "epoch {0:d}: t_err={1:.2f}, t_loss={2:.4f}, t_dev={3:.4f}, t_reg={4:.4f}, valid={5:.2f}{6}".format( \
+        print "epoch {0:d}: t_err={1:.2f}, t_loss={2:.4f}, t_dev={3:.4f}, t_reg={4:.4f}, best_valid={5:.2f}".format( \
                 epoch_counter, epoch_metrics[0], epoch_metrics[1], epoch_metrics[2], epoch_metrics[3], \
-                validation_error, tag)
-        print "--time: {0:.4f}".format((time.clock() - e_time))
-        e_time = time.clock()
+                best['va_error'])
+        print "--time: {0:.4f}".format((time.time() - e_time))
+        e_time = time.time()
         # save first layer weights to an image locally
+        prof.start('visualize')
         utils.visualize(NET, 0, img_file_name)
+        prof.stop('visualize')
+        # stop early if validation error hasn't improved for a while
+        if (patience and ((epoch_counter - best['epoch']) > patience)):
+            print "stopping early, no improvement since epoch {0:d}".format(best['epoch'])
+            break
+    log_eval_results(evaluator.close(), train_log, best, results_file)
+    if prof.enabled:
+        print(prof.report())
 
     print("optimization complete. best validation error {0:.4f}, with test error {1:.4f}".format( \
-          (min_validation_error), (min_test_error)))
+          best['va_error'], best['te_error']))
+    results_file.close()
+    return best
 
 def train_ss_mlp(
         NET,
@@ -295,6 +308,8 @@ def train_ss_mlp(
     unlabeled inputs for training, the third item is a matrix/vector pair of
     inputs/labels for validation, and the fourth is a matrix/vector pair of
     inputs/labels for testing.
+
+    Returns a summary dict, as for train_mlp().
     """
     initial_learning_rate = sgd_params['start_rate']
     learning_rate_decay = sgd_params['decay_rate']
@@ -304,8 +319,16 @@ def train_ss_mlp(
     wt_norm_bound = sgd_params['wt_norm_bound']
     result_tag = sgd_params['result_tag']
     bias_noise = sgd_params['bias_noise']
-    txt_file_name = "results_mlp_{0}.txt".format(result_tag)
+    eval_freq = sgd_params.get('eval_freq', 1)
+    eval_mem_mb = sgd_params.get('eval_mem_mb', 256)
+    patience = sgd_params.get('patience', None)
+    txt_file_name = sgd_params.get('results_file', \
+            "results_mlp_{0}.txt".format(result_tag))
     img_file_name = "weights_mlp_{0}.png".format(result_tag)
+    # per-phase wall-clock profiling (see utils.PhaseProfiler), off by default
+    prof = utils.PhaseProfiler(enabled=sgd_params.get('profile', False), \
+            report_every=sgd_params.get('profile_every', 100), \
+            out_file=sgd_params.get('profile_file', None), tag=result_tag)
 
     # Get supervised and unsupervised portions of training data, and create
     # arrays of start/end indices for easy minibatch slicing.
@@ -324,20 +347,13 @@ def train_ss_mlp(
     un_bidx = theano.shared(value=np.asarray(un_bidx, dtype=theano.config.floatX))
     su_bidx = T.cast(su_bidx, 'int32')
     un_bidx = T.cast(un_bidx, 'int32')
-    # get the validation and testing sets and create arrays of start/end
-    # indices for easy minibatch slicing
-    Xva, Yva = (datasets[2][0], T.cast(datasets[2][1], 'int32'))
-    Xte, Yte = (datasets[3][0], T.cast(datasets[3][1], 'int32'))
-    va_samples = Xva.get_value(borrow=True).shape[0]
-    te_samples = Xte.get_value(borrow=True).shape[0]
-    va_batches = int(np.ceil(va_samples / 100.))
-    te_batches = int(np.ceil(te_samples / 100.))
-    va_bidx = [[i*100, min(va_samples, (i+1)*100)] for i in range(va_batches)]
-    te_bidx = [[i*100, min(te_samples, (i+1)*100)] for i in range(te_batches)]
-    va_bidx = theano.shared(value=np.asarray(va_bidx, dtype=theano.config.floatX))
-    te_bidx = theano.shared(value=np.asarray(te_bidx, dtype=theano.config.floatX))
-    va_bidx = T.cast(va_bidx, 'int32')
-    te_bidx = T.cast(te_bidx, 'int32')
+    # Minibatches are gathered through permutations of the row indices, so
+    # that reshuffling only has to regenerate the permutations.
+    su_perm = row_permutation(su_samples)
+    un_perm = row_permutation(un_samples)
+    # Get the validation and testing observations and classes
+    va_samples = datasets[2][0].get_value(borrow=True).shape[0]
+    te_samples = datasets[3][0].get_value(borrow=True).shape[0]
 
     # Print some useful information about the dataset
     print "dataset info:"
@@ -375,21 +391,11 @@ def train_ss_mlp(
                    NET.dev_reg_loss(y), NET.raw_reg_loss]
 
     ############################################################################
-    # compile testing and validation models. these models are evaluated on     #
-    # batches of the same size as used in training. trying to jam a large      #
-    # validation or test set through the net may take too much memory.         #
+    # Compile a copy of the metric graph that takes the network parameters as  #
+    # inputs. An AsyncEvaluator runs it on parameter snapshots, over large     #
+    # batches of the validation and testing sets, in a separate process.       #
     ############################################################################
-    test_model = theano.function(inputs=[index], \
-            outputs=NET_metrics, \
-            givens={ \
-                x: Xte[te_bidx[index,0]:te_bidx[index,1],:], \
-                y: Yte[te_bidx[index,0]:te_bidx[index,1]]})
-
-    validate_model = theano.function(inputs=[index], \
-            outputs=NET_metrics, \
-            givens={ \
-                x: Xva[va_bidx[index,0]:va_bidx[index,1],:], \
-                y: Yva[va_bidx[index,0]:va_bidx[index,1]]})
+    eval_func = compile_eval_func(x, y, NET_metrics, NET.mlp_params)
 
     ############################################################################
     # prepare momentum and gradient variables, and construct the updates that  #
@@ -453,18 +459,22 @@ def train_ss_mlp(
     train_sde = theano.function(inputs=[epoch, su_idx, un_idx], outputs=NET_metrics, \
             updates=sde_updates, \
             givens={ \
-                x: T.concatenate([Xtr_su[su_bidx[su_idx,0]:su_bidx[su_idx,1],:], \
-                        Xtr_un[un_bidx[un_idx,0]:un_bidx[un_idx,1],:]]), \
-                y: T.concatenate([Ytr_su[su_bidx[su_idx,0]:su_bidx[su_idx,1]], \
-                        Ytr_un[un_bidx[un_idx,0]:un_bidx[un_idx,1]]])})
+                x: T.concatenate([ \
+                        T.take(Xtr_su, su_perm[su_bidx[su_idx,0]:su_bidx[su_idx,1]], axis=0), \
+                        T.take(Xtr_un, un_perm[un_bidx[un_idx,0]:un_bidx[un_idx,1]], axis=0)]), \
+                y: T.concatenate([ \
+                        T.take(Ytr_su, su_perm[su_bidx[su_idx,0]:su_bidx[su_idx,1]]), \
+                        T.take(Ytr_un, un_perm[un_bidx[un_idx,0]:un_bidx[un_idx,1]])])})
 
     train_dev = theano.function(inputs=[epoch, su_idx, un_idx], outputs=NET_metrics, \
             updates=dev_updates, \
             givens={ \
-                x: T.concatenate([Xtr_su[su_bidx[su_idx,0]:su_bidx[su_idx,1],:], \
-                        Xtr_un[un_bidx[un_idx,0]:un_bidx[un_idx,1],:]]),
-                y: T.concatenate([Ytr_su[su_bidx[su_idx,0]:su_bidx[su_idx,1]], \
-                        Ytr_un[un_bidx[un_idx,0]:un_bidx[un_idx,1]]])})
+                x: T.concatenate([ \
+                        T.take(Xtr_su, su_perm[su_bidx[su_idx,0]:su_bidx[su_idx,1]], axis=0), \
+                        T.take(Xtr_un, un_perm[un_bidx[un_idx,0]:un_bidx[un_idx,1]], axis=0)]),
+                y: T.concatenate([ \
+                        T.take(Ytr_su, su_perm[su_bidx[su_idx,0]:su_bidx[su_idx,1]]), \
+                        T.take(Ytr_un, un_perm[un_bidx[un_idx,0]:un_bidx[un_idx,1]])])})
 
     # theano function to decay the learning rate, this is separate from the
     # training function because we only want to do this once each epoch instead
@@ -477,12 +487,10 @@ def train_ss_mlp(
     ###############
     print '... training'
 
-    validation_error = 100.
-    test_error = 100.
-    min_validation_error = 100.
-    min_test_error = 100.
+    best = {'va_error': 100., 'te_error': 100., 'epoch': 0, 'history': []}
+    train_log = {}
     epoch_counter = 0
-    start_time = time.clock()
+    start_time = time.time()
 
     results_file = open(txt_file_name, 'wb')
     results_file.write("mlp_type: {0}\n".format(mlp_type))
@@ -491,14 +499,16 @@ def train_ss_mlp(
     results_file.write("dev_lams: {0}\n".format(str(mlp_params['dev_lams'])))
     results_file.flush()
 
-    e_time = time.clock()
+    # start the evaluation worker, with bias noise off in its copy of NET
+    NET.set_bias_noise(0.0)
+    evaluator = AsyncEvaluator(eval_func, NET.mlp_params, \
+            [datasets[2], datasets[3]], mem_mb=eval_mem_mb)
+
+    e_time = time.time()
     su_index = 0
     un_index = 0
     # get array of epoch metrics (on a single minibatch)
     epoch_metrics = train_sde(1, 0, 0)
-    validation_metrics = [0. for v in epoch_metrics]
-    test_metrics = [0. for v in epoch_metrics]
-    # compute metrics on testing set
     while epoch_counter < n_epochs:
         ######################################################
         # process some number of minibatches for this epoch. #
@@ -509,13 +519,25 @@ def train_ss_mlp(
         epoch_metrics = [0. for v in epoch_metrics]
         for b_idx in xrange(tr_batches):
             # compute update for some this minibatch
+            prof.start('train')
             if ((epoch_counter <= 0) or (mlp_type == 'sde')):
                 batch_metrics = train_sde(epoch_counter, su_index, un_index)
             else:
                 batch_metrics = train_dev(epoch_counter, su_index, un_index)
+            prof.stop('train')
+            prof.end_batch()
             epoch_metrics = [(em + bm) for (em, bm) in zip(epoch_metrics, batch_metrics)]
             su_index = (su_index + 1) if ((su_index + 1) < su_batches) else 0
             un_index = (un_index + 1) if ((un_index + 1) < un_batches) else 0
+            # reshuffle each portion of the training set after each pass
+            if (su_index == 0):
+                prof.start('shuffle')
+                shuffle_rows(su_perm)
+                prof.stop('shuffle')
+            if (un_index == 0):
+                prof.start('shuffle')
+                shuffle_rows(un_perm)
+                prof.stop('shuffle')
         # Compute 'averaged' values over the minibatches
         epoch_metrics[0] = 100 * (float(epoch_metrics[0]) / (tr_batches * su_bsize))
         epoch_metrics[1:] = [(float(v) / tr_batches) for v in epoch_metrics[1:]]
@@ -527,48 +549,37 @@ def train_ss_mlp(
         ######################################################
         # validation, testing, and general diagnostic stuff. #
         ######################################################
-        # Set to testing mode
-        NET.set_bias_noise(0.0)
-        # compute metrics on validation set
-        validation_metrics = [0. for v in epoch_metrics]
-        for b_idx in xrange(va_batches):
-            batch_metrics = validate_model(b_idx)
-            validation_metrics = [(em + bm) for (em, bm) in zip(validation_metrics, batch_metrics)]
-        # Compute 'averaged' values over the minibatches
-        validation_error = 100 * (float(validation_metrics[0]) / va_samples)
-        validation_metrics[1:] = [(float(v) / va_batches) for v in validation_metrics[1:]]
-        validation_loss = validation_metrics[1]
-
-        # compute test error if new best validation error was found
-        tag = " "
-        # compute metrics on testing set
-        test_metrics = [0. for v in epoch_metrics]
-        for b_idx in xrange(te_batches):
-            batch_metrics = test_model(b_idx)
-            test_metrics = [(em + bm) for (em, bm) in zip(test_metrics, batch_metrics)]
-        # Compute 'averaged' values over the minibatches
-        test_error = 100 * (float(test_metrics[0]) / te_samples)
-        test_metrics[1:] = [(float(v) / te_batches) for v in test_metrics[1:]]
-        test_loss = test_metrics[1]
-        if (validation_error < min_validation_error):
-            min_validation_error = validation_error
-            min_test_error = test_error
-            tag = ", test={0:.2f}".format(test_error)
-        results_file.write("{0:.2f} {1:.2f} {2:.2f} {3:.4f} {4:.4f} {5:.4f}\n".format( \
-                train_error, validation_error, test_error, train_loss, validation_loss, test_loss))
-        results_file.flush()
+        # hand a parameter snapshot to the evaluator, and log any results
+        # that have come back since the last epoch
+        prof.start('eval')
+        if ((epoch_counter % eval_freq) == 0):
+            if evaluator.submit(epoch_counter):
+                train_log[epoch_counter] = (train_error, train_loss)
+        log_eval_results(evaluator.results(), train_log, best, results_file)
+        prof.stop('eval')
 
         # report and save progress.
-        print "epoch {0:d}: t_err={1:.2f}, t_loss={2:.4f}, t_dev={3:.4f}, t_reg={4:.4f}, valid={5:.2f}{6}".format( \
+        print "epoch {0:d}: t_err={1:.2f}, t_loss={2:.4f}, t_dev={3:.4f}, t_reg={4:.4f}, best_valid={5:.2f}".format( \
                 epoch_counter, epoch_metrics[0], epoch_metrics[1], epoch_metrics[2], epoch_metrics[3], \
-                validation_error, tag)
-        print "--time: {0:.4f}".format((time.clock() - e_time))
-        e_time = time.clock()
+                best['va_error'])
+        print "--time: {0:.4f}".format((time.time() - e_time))
+        e_time = time.time()
         # save first layer weights to an image locally
+        prof.start('visualize')
         utils.visualize(NET, 0, img_file_name)
+        prof.stop('visualize')
+        # stop early if validation error hasn't improved for a while
+        if (patience and ((epoch_counter - best['epoch']) > patience)):
+            print "stopping early, no improvement since epoch {0:d}".format(best['epoch'])
+            break
+    log_eval_results(evaluator.close(), train_log, best, results_file)
+    if prof.enabled:
+        print(prof.report())
 
     print("optimization complete. best validation error {0:.4f}, with test error {1:.4f}".format( \
-          (min_validation_error), (min_test_error)))
+          best['va_error'], best['te_error']))
+    results_file.close()
+    return best
 
 def train_dae(
     NET,
@@ -590,8 +601,13 @@ def train_dae(
     mlp_type = sgd_params['mlp_type']
     wt_norm_bound = sgd_params['wt_norm_bound']
     result_tag = sgd_params['result_tag']
-    txt_file_name = "results_dae_{0}.txt".format(result_tag)
+    txt_file_name = sgd_params.get('results_file', \
+            "results_dae_{0}.txt".format(result_tag))
     img_file_name = "weights_dae_{0}.png".format(result_tag)
+    # per-phase wall-clock profiling (see utils.PhaseProfiler), off by default
+    prof = utils.PhaseProfiler(enabled=sgd_params.get('profile', False), \
+            report_every=sgd_params.get('profile_every', 100), \
+            out_file=sgd_params.get('profile_file', None), tag=result_tag)
 
     # Get the training data and create arrays of start/end indices for
     # easy minibatch slicing
@@ -740,7 +756,7 @@ def train_dae(
     min_validation_loss = 1e6
     min_test_loss = 1e6
     epoch_counter = 0
-    start_time = time.clock()
+    start_time = time.time()
 
     results_file = open(txt_file_name, 'wb')
     results_file.write("mlp_type: {0}\n".format(mlp_type))
@@ -754,15 +770,18 @@ def train_dae(
         ######################################################
         # Process some number of minibatches for this epoch. #
         ######################################################
-        e_time = time.clock()
+        e_time = time.time()
         epoch_counter = epoch_counter + 1
         epoch_metrics = [0. for val in epoch_metrics]
         for minibatch_index in xrange(tr_batches):
             # Compute update for some joint supervised/unsupervised minibatch
+            prof.start('train')
             if ((mlp_type == 'sde') or (mlp_type == 'dev')):
                 batch_metrics = train_sde(epoch_counter, minibatch_index)
             else:
                 batch_metrics = train_raw(epoch_counter, minibatch_index)
+            prof.stop('train')
+            prof.end_batch()
             epoch_metrics = [(em + bm) for (em, bm) in zip(epoch_metrics, batch_metrics)]
         epoch_metrics = [(val / tr_batches) for val in epoch_metrics]
 
@@ -773,14 +792,18 @@ def train_dae(
         # Validation, testing, and general diagnostic stuff. #
         ######################################################
         # Compute metrics on validation set
+        prof.start('eval')
         validation_metrics = [validate_model(i) for i in xrange(va_batches)]
+        prof.stop('eval')
         validation_loss = np.mean([vm[0] for vm in validation_metrics])
 
         # Compute test error if new best validation error was found
         tag = " "
         if ((validation_loss < min_validation_loss) or ((epoch_counter % 10) == 0)):
             # Compute metrics on testing set
+            prof.start('eval')
             test_metrics = [test_model(i) for i in xrange(te_batches)]
+            prof.stop('eval')
             test_loss = np.mean([tm[0] for tm in test_metrics])
             if (validation_loss < min_validation_loss):
                 min_validation_loss = validation_loss
@@ -792,9 +815,13 @@ def train_dae(
         # Report and save progress.
         print "epoch {0:d}: tr_loss={1:.4f}, tr_recon={2:.4f}, tr_sparse={3:.4f}, va_loss={4:.4f}{5}".format( \
                 epoch_counter, epoch_metrics[0], epoch_metrics[1], epoch_metrics[2], validation_loss, tag)
-        print "--time: {0:.4f}".format((time.clock() - e_time))
+        print "--time: {0:.4f}".format((time.time() - e_time))
         # Save first layer weights to an image locally
+        prof.start('visualize')
         utils.visualize(NET, 0, img_file_name)
+        prof.stop('visualize')
+    if prof.enabled:
+        print(prof.report())
 
 
 
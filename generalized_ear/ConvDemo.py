@@ -34,22 +34,70 @@ import theano.tensor as T
 # from theano.tensor.signal import downsample
 # from theano.tensor.nnet import conv
 
-from logistic_sgd import load_data
+# the data loaders are shared with the other packages (see shared/README.md)
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (repo_dir in sys.path):
+    sys.path.append(repo_dir)
+from shared.load_data import load_udm
 from collections import OrderedDict
 
-from theano.sandbox.cuda.basic_ops import gpu_contiguous
-from pylearn2.sandbox.cuda_convnet.filter_acts import FilterActs
-from pylearn2.sandbox.cuda_convnet.pool import MaxPool
-from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams
-
 from NetLayers import ConvPoolLayer, HiddenLayer, relu_actfun, \
-                      Reshape2D4DLayer, Reshape4D2DLayer
+                      Reshape2D4DLayer, Reshape4D2DLayer, default_conv_backend
 from output_losses import LogisticRegression
 from utils import visualize_samples
 
+def build_lenet5(rng, x, nkerns=[48, 64], backend=None):
+    """Build the LeNet5-style conv net used by evaluate_lenet5().
+
+    Returns the list of conv/hidden layers, from input to output. The given
+    backend is passed to each ConvPoolLayer.
+    """
+    relu = lambda vals: relu_actfun(vals)
+
+    # Reshape matrix of rasterized images of shape (batch_size,28*28)
+    # to a 4D tensor, compatible with our LeNetConvPoolLayer
+    layer0_prep = Reshape2D4DLayer(input=x, out_shape=(1, 28, 28))
+
+    # Construct the first convolutional pooling layer:
+    # filtering reduces the image size to (28-7+1,28-7+1)=(22,22)
+    # maxpooling reduces this further to (22/2,22/2) = (11,11)
+    # 4D output tensor is thus of shape (batch_size,nkerns[0],11,11)
+    layer0 = ConvPoolLayer(rng, input=layer0_prep.output, \
+            filt_def=(nkerns[0], 1, 7, 7), pool_def=(2, 2), \
+            activation=relu, drop_rate=0.0, input_noise=0.1, bias_noise=0.05, \
+            W=None, b=None, name="layer0", W_scale=2.0, backend=backend)
+
+    # Construct the second convolutional pooling layer
+    # filtering reduces the image size to (11-4+1,11-4+1)=(8,8)
+    # maxpooling reduces this further to (8/2,8/2) = (4,4)
+    # 4D output tensor is thus of shape (nkerns[0],nkerns[1],4,4)
+    layer1 = ConvPoolLayer(rng, input=layer0.output, \
+            filt_def=(nkerns[1], nkerns[0], 4, 4), pool_def=(2, 2), \
+            activation=relu, drop_rate=0.0, input_noise=0.0, bias_noise=0.05, \
+            W=None, b=None, name="layer1", W_scale=2.0, backend=backend)
+
+    # the HiddenLayer being fully-connected, it operates on 2D matrices of
+    # shape (batch_size,num_pixels) (i.e matrix of rasterized images).
+    # This will generate a matrix of shape (20,32*4*4) = (20,512)
+    layer2_prep = Reshape4D2DLayer(layer1.output)
+
+    # construct a fully-connected relu layer
+    layer2 = HiddenLayer(rng, layer2_prep.output, nkerns[1]*4*4, 512, \
+                 activation=relu, pool_size=0, \
+                 drop_rate=0.0, input_noise=0.0, bias_noise=0.05, \
+                 W=None, b=None, name="layer2", W_scale=2.0)
+
+    # construct an output layer to predict classes
+    layer3 = HiddenLayer(rng, layer2.output, 512, 10, \
+             activation=relu, pool_size=0, \
+             drop_rate=0.5, input_noise=0.0, bias_noise=0.0, \
+             W=None, b=None, name="layer2", W_scale=2.0)
+
+    return [layer0, layer1, layer2, layer3]
+
 def evaluate_lenet5(learning_rate=0.05, n_epochs=500,
                     dataset='./data/mnist.pkl.gz',
-                    nkerns=[48, 64], batch_size=256):
+                    nkerns=[48, 64], batch_size=256, backend=None):
     """ Demonstrates lenet on MNIST dataset
 
     :type learning_rate: float
@@ -64,15 +112,22 @@ def evaluate_lenet5(learning_rate=0.05, n_epochs=500,
 
     :type nkerns: list of ints
     :param nkerns: number of kernels on each layer
+
+    :type backend: string
+    :param backend: conv backend for ConvPoolLayer ('cuda_convnet' or 'cpu')
     """
 
     rng = numpy.random.RandomState(23455)
 
-    datasets = load_data(dataset)
+    datasets = load_udm(dataset, zero_mean=False)
 
+    # load_udm() gives floatX labels from 1-10, so shift and cast them
     train_set_x, train_set_y = datasets[0]
     valid_set_x, valid_set_y = datasets[1]
     test_set_x, test_set_y = datasets[2]
+    train_set_y = T.cast(train_set_y - 1, 'int32')
+    valid_set_y = T.cast(valid_set_y - 1, 'int32')
+    test_set_y = T.cast(test_set_y - 1, 'int32')
 
     # compute number of minibatches for training, validation and testing
     n_train_batches = train_set_x.get_value(borrow=True).shape[0]
@@ -98,47 +153,7 @@ def evaluate_lenet5(learning_rate=0.05, n_epochs=500,
     ######################
     print '... building the model'
 
-    tanh = lambda vals: T.tanh(vals)
-    relu = lambda vals: relu_actfun(vals)
-
-    # Reshape matrix of rasterized images of shape (batch_size,28*28)
-    # to a 4D tensor, compatible with our LeNetConvPoolLayer
-    layer0_prep = Reshape2D4DLayer(input=x, out_shape=(1, 28, 28))
-
-    # Construct the first convolutional pooling layer:
-    # filtering reduces the image size to (28-7+1,28-7+1)=(22,22)
-    # maxpooling reduces this further to (22/2,22/2) = (11,11)
-    # 4D output tensor is thus of shape (batch_size,nkerns[0],11,11)
-    layer0 = ConvPoolLayer(rng, input=layer0_prep.output, \
-            filt_def=(nkerns[0], 1, 7, 7), pool_def=(2, 2), \
-            activation=relu, drop_rate=0.0, input_noise=0.1, bias_noise=0.05, \
-            W=None, b=None, name="layer0", W_scale=2.0)
-
-    # Construct the second convolutional pooling layer
-    # filtering reduces the image size to (11-4+1,11-4+1)=(8,8)
-    # maxpooling reduces this further to (8/2,8/2) = (4,4)
-    # 4D output tensor is thus of shape (nkerns[0],nkerns[1],4,4)
-    layer1 = ConvPoolLayer(rng, input=layer0.output, \
-            filt_def=(nkerns[1], nkerns[0], 4, 4), pool_def=(2, 2), \
-            activation=relu, drop_rate=0.0, input_noise=0.0, bias_noise=0.05, \
-            W=None, b=None, name="layer1", W_scale=2.0)
-
-    # the HiddenLayer being fully-connected, it operates on 2D matrices of
-    # shape (batch_size,num_pixels) (i.e matrix of rasterized images).
-    # This will generate a matrix of shape (20,32*4*4) = (20,512)
-    layer2_prep = Reshape4D2DLayer(layer1.output)
-
-    # construct a fully-connected relu layer
-    layer2 = HiddenLayer(rng, layer2_prep.output, nkerns[1]*4*4, 512, \
-                 activation=relu, pool_size=0, \
-                 drop_rate=0.0, input_noise=0.0, bias_noise=0.05, \
-                 W=None, b=None, name="layer2", W_scale=2.0)
-
-    # construct an output layer to predict classes
-    layer3 = HiddenLayer(rng, layer2.output, 512, 10, \
-             activation=relu, pool_size=0, \
-             drop_rate=0.5, input_noise=0.0, bias_noise=0.0, \
-             W=None, b=None, name="layer2", W_scale=2.0)
+    (layer0, layer1, layer2, layer3) = build_lenet5(rng, x, nkerns, backend)
 
     # get a loss function to apply to the output layer
     loss_func = LogisticRegression(layer3)
@@ -269,6 +284,43 @@ def evaluate_lenet5(learning_rate=0.05, n_epochs=500,
                           os.path.split(__file__)[1] +
                           ' ran for %.2fm' % ((end_time - start_time) / 60.))
 
+def benchmark_lenet5(backend=None, batch_size=256, batch_count=20, \
+                     nkerns=[48, 64]):
+    """Measure training throughput of the LeNet5 net from build_lenet5().
+
+    This runs batch_count SGD updates on random data (after one warm-up
+    update, which isn't timed) and returns the number of images per second.
+    """
+    if backend is None:
+        backend = default_conv_backend()
+    rng = numpy.random.RandomState(23455)
+    x = T.matrix('x')
+    y = T.ivector('y')
+    layers = build_lenet5(rng, x, nkerns, backend)
+    cost = LogisticRegression(layers[-1]).loss_func(y)
+    params = []
+    for layer in layers:
+        params.extend(layer.params)
+    updates = [(p, p - 0.01 * T.grad(cost, p)) for p in params]
+
+    X = numpy.asarray(rng.uniform(size=(batch_size, 28*28)), \
+            dtype=theano.config.floatX)
+    Y = numpy.asarray(rng.randint(0, 10, size=(batch_size,)), dtype='int32')
+    X_shared = theano.shared(X)
+    Y_shared = theano.shared(Y)
+    train_batch = theano.function([], cost, updates=updates, \
+            givens={x: X_shared, y: Y_shared})
+
+    train_batch()
+    t1 = time.time()
+    for i in range(batch_count):
+        train_batch()
+    t2 = time.time()
+    ims_per_sec = (batch_count * batch_size) / (t2 - t1)
+    print("lenet5 ({0:s}): {1:.1f} images/sec, {2:.4f}s/batch".format( \
+            backend, ims_per_sec, (t2 - t1) / batch_count))
+    return ims_per_sec
+
 if __name__ == '__main__':
     evaluate_lenet5()
 
@@ -7,7 +7,10 @@ import theano
 import theano.tensor as T
 from theano.ifelse import ifelse
 #import theano.tensor.shared_randomstreams
-from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams
+try:
+    from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams
+except ImportError:
+    from theano.sandbox.rng_mrg import MRG_RandomStreams as CURAND_RandomStreams
 
 from output_losses import LogRegSS, MCL2HingeSS
 from NetLayers import HiddenLayer, JoinLayer, DAELayer
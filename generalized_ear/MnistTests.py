@@ -2,13 +2,21 @@
 # Testing scripts for MNIST experiments #
 #########################################
 
+import os
+import sys
 import numpy as np
 import theano
 import theano.tensor as T
 import theano.tensor.shared_randomstreams
 
 from EarNet import EarNet
-from load_data import load_udm, load_udm_ss, load_mnist
+# the data loaders and sweep runner are shared with the other packages (see
+# shared/README.md)
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (repo_dir in sys.path):
+    sys.path.append(repo_dir)
+from shared.load_data import load_udm, load_udm_ss, load_mnist, split_udm_ss, share_udm
+import shared.sweep_runner as SR
 import NetTrainers as NT
 
 def init_biases(NET, b_init=0.0):
@@ -25,29 +33,29 @@ def init_biases(NET, b_init=0.0):
 def train_ss_mlp(NET, sgd_params, datasets):
     """Run semi-supervised EA-regularized test."""
     # Run training on the given NET
-    NT.train_ss_mlp(NET=NET, \
+    result = NT.train_ss_mlp(NET=NET, \
         sgd_params=sgd_params, \
         datasets=datasets)
-    return
+    return result
 
 def train_mlp(NET, sgd_params, datasets):
     """Run mlp training test."""
     # Train the net
-    NT.train_mlp(NET=NET, \
+    result = NT.train_mlp(NET=NET, \
         sgd_params=sgd_params, \
         datasets=datasets)
-    return
+    return result
 
 def train_dae(NET, dae_layer, sgd_params, datasets):
     """Run DAE training test."""
     # Run denoising autoencoder training on the given layer of NET
-    NT.train_dae(NET=NET, \
+    result = NT.train_dae(NET=NET, \
         dae_layer=dae_layer, \
         sgd_params=sgd_params, \
         datasets=datasets)
-    return
+    return result
 
-def batch_test_ss_mlp(test_count=10, su_count=1000):
+def batch_test_ss_mlp(test_count=10, su_count=1000, proc_count=None, threads_per_proc=1):
     """Run multiple semisupervised learning tests."""
     # Set some reasonable sgd parameters
     sgd_params = {}
@@ -76,7 +84,8 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
     x_in = T.matrix('x_in')
 
     # Run tests with different sorts of regularization
-    for test_num in range(test_count):
+    def run_test(test_num, udm_data):
+        results = []
         # Run test with EAR regularization on unsupervised examples
         sgd_params['result_tag'] = "ss_sde_s{0:d}_t{1:d}".format(su_count, test_num)
         mlp_params['ear_type'] = 2
@@ -92,16 +101,24 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
         mlp_params['ear_lam'] = 2.0
         # Initialize a random number generator for this test
         rng = np.random.RandomState(test_num)
-        # Load some data to train/validate/test with
-        dataset = 'data/mnist.pkl.gz'
-        datasets = load_udm_ss(dataset, su_count, rng, zero_mean=True)
+        # Split the shared data to train/validate/test with
+        datasets = split_udm_ss(udm_data, su_count, rng)
         # Construct the EarNet object that we will be training
         NET = EarNet(rng=rng, input=x_in, params=mlp_params)
         init_biases(NET, b_init=0.1)
-        train_ss_mlp(NET, sgd_params, datasets)
-    return
-
-def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
+        return results
+
+    # Load the data once, and run the tests across local worker processes,
+    # with all results going into a single file.
+    sgd_params['results_file'] = os.devnull
+    udm_data = load_udm('data/mnist.pkl.gz', as_shared=False, zero_mean=True)
+    records = SR.run_sweep(run_test, range(test_count), udm_data, \
+            "ss_sde_s{0:d}".format(su_count), proc_count=proc_count, \
+            threads_per_proc=threads_per_proc)
+    return records
+
+def batch_test_ss_mlp_gentle(test_count=10, su_count=1000, proc_count=None, threads_per_proc=1):
     """Setup basic test for semisupervised EAR-regularized MLP."""
 
     # Set some reasonable sgd parameters
@@ -129,15 +146,15 @@ def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
     mlp_params['lam_l2a'] = 1e-2
     mlp_params['reg_all_obs'] = True
 
-    for test_num in range(test_count):
+    def run_test(test_num, udm_data):
+        results = []
         rng_seed = test_num
         sgd_params['result_tag'] = "ss_ear_gentle_s{0:d}_t{1:d}".format(su_count, test_num)
 
         # Initialize a random number generator for this test
         rng = np.random.RandomState(rng_seed)
-        # Load some data to train/validate/test with
-        dataset = 'data/mnist.pkl.gz'
-        datasets = load_udm_ss(dataset, su_count, rng, zero_mean=False)
+        # Split the shared data to train/validate/test with
+        datasets = split_udm_ss(udm_data, su_count, rng)
 
         # Construct the EarNet object that we will be training
         x_in = T.matrix('x_in')
@@ -152,31 +169,40 @@ def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
         sgd_params['start_rate'] = 0.1
         sgd_params['epochs'] = 5
         NET.set_ear_lam(0.0)
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         # Train with weak EAR regularization
         sgd_params['epochs'] = 10
         NET.set_ear_lam(1.0) # for EAR
         #NET.set_ear_lam(0.0) # for SDE
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         # Train with more EAR regularization
         sgd_params['epochs'] = 10
         NET.set_ear_lam(1.5) # for EAR
         #NET.set_ear_lam(0.0) # for SDE
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         # Train with more EAR regularization
         sgd_params['epochs'] = 15
         NET.set_ear_lam(2.0) # for EAR
         #NET.set_ear_lam(0.0) # for SDE
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         # Train with more EAR regularization
         sgd_params['epochs'] = 70
         sgd_params['start_rate'] = 0.05
         NET.set_ear_lam(3.0) # for EAR
         #NET.set_ear_lam(0.0) # for SDE
-        train_ss_mlp(NET, sgd_params, datasets)
-    return
-
-def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
+        return results
+
+    # Load the data once, and run the tests across local worker processes,
+    # with all results going into a single file.
+    sgd_params['results_file'] = os.devnull
+    udm_data = load_udm('data/mnist.pkl.gz', as_shared=False, zero_mean=False)
+    records = SR.run_sweep(run_test, range(test_count), udm_data, \
+            "ss_ear_gentle_s{0:d}".format(su_count), proc_count=proc_count, \
+            threads_per_proc=threads_per_proc)
+    return records
+
+def batch_test_ss_mlp_pt(test_count=10, su_count=1000, proc_count=None, threads_per_proc=1):
     """Setup basic test for semisupervised EAR-regularized MLP."""
     # Set some reasonable sgd parameters
     sgd_params = {}
@@ -202,15 +228,15 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
     mlp_params['lam_l2a'] = 1e-2
     mlp_params['reg_all_obs'] = True
 
-    for test_num in range(test_count):
+    def run_test(test_num, udm_data):
+        results = []
         rng_seed = test_num
         sgd_params['result_tag'] = "test_{0:d}".format(test_num)
 
         # Initialize a random number generator for this test
         rng = np.random.RandomState(rng_seed)
-        # Load some data to train/validate/test with
-        dataset = 'data/mnist.pkl.gz'
-        datasets = load_udm(dataset, zero_mean=False)
+        # Put the shared data into theano shared variables
+        datasets = share_udm(udm_data)
 
         # Construct the EarNet object that we will be training
         x_in = T.matrix('x_in')
@@ -230,10 +256,9 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
             print("==================================================")
             train_dae(NET, i, sgd_params, datasets)
 
-        # Load some data to train/validate/test with
+        # Split the shared data to train/validate/test with
         rng = np.random.RandomState(rng_seed)
-        dataset = 'data/mnist.pkl.gz'
-        datasets = load_udm_ss(dataset, su_count, rng, zero_mean=False)
+        datasets = split_udm_ss(udm_data, su_count, rng)
         # Run semisupervised training on the given MLP
         sgd_params['batch_size'] = 100
         sgd_params['start_rate'] = 0.04
@@ -241,7 +266,7 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
         sgd_params['top_only'] = True
         sgd_params['epochs'] = 5
         NET.set_ear_lam(0.0)
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         COMMENT="""
         # Train with no EAR regularization
         sgd_params['top_only'] = False
@@ -253,24 +278,33 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
         sgd_params['top_only'] = False
         sgd_params['epochs'] = 5
         NET.set_ear_lam(0.5)
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         # Train with weak EAR regularization
         sgd_params['epochs'] = 10
         NET.set_ear_lam(1.0)
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         # Train with more EAR regularization
         sgd_params['epochs'] = 15
         NET.set_ear_lam(1.5)
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         # Train with more EAR regularization
         sgd_params['epochs'] = 20
         NET.set_ear_lam(2.0)
-        train_ss_mlp(NET, sgd_params, datasets)
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
         # Train with more EAR regularization
         sgd_params['epochs'] = 100
         NET.set_ear_lam(3.0)
-        train_ss_mlp(NET, sgd_params, datasets)
-    return
+        results.append(train_ss_mlp(NET, sgd_params, datasets))
+        return results
+
+    # Load the data once, and run the tests across local worker processes,
+    # with all results going into a single file.
+    sgd_params['results_file'] = os.devnull
+    udm_data = load_udm('data/mnist.pkl.gz', as_shared=False, zero_mean=False)
+    records = SR.run_sweep(run_test, range(test_count), udm_data, \
+            "ss_ear_pt_s{0:d}".format(su_count), proc_count=proc_count, \
+            threads_per_proc=threads_per_proc)
+    return records
 
 def test_dropout_ala_original():
     """Run standard dropout training on MNIST with parameters to reproduce
@@ -3,12 +3,27 @@ import theano
 import theano.tensor as T
 from theano.ifelse import ifelse
 import theano.tensor.shared_randomstreams
-from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams
-from pylearn2.sandbox.cuda_convnet.filter_acts import FilterActs
-from pylearn2.sandbox.cuda_convnet.pool import MaxPool
-from theano.sandbox.cuda.basic_ops import gpu_contiguous
-# from theano.tensor.signal import downsample
-# from theano.tensor.nnet import conv
+try:
+    from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams
+except ImportError:
+    # No old-style CUDA backend, so use the MRG generator (which has the
+    # same uniform/normal interface and also runs on the CPU).
+    from theano.sandbox.rng_mrg import MRG_RandomStreams as CURAND_RandomStreams
+try:
+    from pylearn2.sandbox.cuda_convnet.filter_acts import FilterActs
+    from pylearn2.sandbox.cuda_convnet.pool import MaxPool
+    from theano.sandbox.cuda.basic_ops import gpu_contiguous
+    HAS_CUDA_CONVNET = True
+except ImportError:
+    HAS_CUDA_CONVNET = False
+try:
+    from theano.tensor.nnet import conv2d
+except ImportError:
+    from theano.tensor.nnet.conv import conv2d
+try:
+    from theano.tensor.signal.pool import pool_2d
+except ImportError:
+    from theano.tensor.signal.downsample import max_pool_2d as pool_2d
 
 ###############################
 # ACTIVATIONS AND OTHER STUFF #
@@ -226,6 +241,12 @@ class HiddenLayer(object):
 # COMBINED CONVOLUTION AND MAX-POOLING LAYER #
 ##############################################
 
+def default_conv_backend():
+    """Get the conv backend that ConvPoolLayer uses when none is given."""
+    if HAS_CUDA_CONVNET and theano.config.device.startswith('gpu'):
+        return 'cuda_convnet'
+    return 'cpu'
+
 class ConvPoolLayer(object):
     """
     A simple convolution --> max-pooling layer.
@@ -236,10 +257,15 @@ class ConvPoolLayer(object):
     filt_def should be a 4-tuple like (filt_count, in_chans, filt_def_1, filt_def_2)
 
     pool_def should be a 3-tuple like (pool_dim, pool_stride)
+
+    backend selects the convolution/pooling ops: 'cuda_convnet' uses
+    pylearn2's FilterActs/MaxPool (which work in c01b order), and 'cpu'
+    uses Theano's conv2d/pool_2d (which work in bc01 order). By default,
+    cuda_convnet is used if it is available and Theano is using a GPU.
     """
     def __init__(self, rng, input=None, filt_def=None, pool_def=(2, 2), \
     		activation=None, drop_rate=0., input_noise=0., bias_noise=0., \
-    		W=None, b=None, name="", W_scale=1.0):
+    		W=None, b=None, name="", W_scale=1.0, backend=None):
 
         # Setup a shared random generator for this layer
         #self.rng = theano.tensor.shared_randomstreams.RandomStreams( \
@@ -277,25 +303,19 @@ class ConvPoolLayer(object):
         b_init = np.zeros((filt_def[0],), dtype=theano.config.floatX) + 0.1
         self.b = theano.shared(value=b_init, name="{0:s}_b".format(name))
 
-        # convolve input feature maps with filters
-        input_c01b = self.noisy_input.dimshuffle(1, 2, 3, 0) # bc01 to c01b
-        filters_c01b = self.W.dimshuffle(1, 2, 3, 0) # bc01 to c01b
-        conv_op = FilterActs(stride=1, partial_sum=1)
-        contig_input = gpu_contiguous(input_c01b)
-        contig_filters = gpu_contiguous(filters_c01b)
-        conv_out_c01b = conv_op(contig_input, contig_filters)
-
-        if (bias_noise > 1e-4):
-        	noisy_conv_out_c01b = conv_out_c01b + self.rng.normal( \
-        			size=conv_out_c01b.shape, avg=0.0, std=bias_noise, \
-        			dtype=theano.config.floatX)
+        # convolve input feature maps with filters and downsample each
+        # feature map individually, using maxpooling
+        if backend is None:
+            backend = default_conv_backend()
+        self.backend = backend
+        if (backend == 'cuda_convnet'):
+            mp_out_bc01 = self._conv_pool_c01b(self.noisy_input, pool_def, \
+                    bias_noise)
+        elif (backend == 'cpu'):
+            mp_out_bc01 = self._conv_pool_bc01(self.noisy_input, pool_def, \
+                    bias_noise)
         else:
-        	noisy_conv_out_c01b = conv_out_c01b
-
-        # downsample each feature map individually, using maxpooling
-        pool_op = MaxPool(ds=pool_def[0], stride=pool_def[1])
-        mp_out_c01b = pool_op(noisy_conv_out_c01b)
-        mp_out_bc01 = mp_out_c01b.dimshuffle(3, 0, 1, 2) # c01b to bc01
+            raise ValueError("unknown conv backend: {0}".format(backend))
 
         # add the bias term. Since the bias is a vector (1D array), we first
         # reshape it to a tensor of shape (1,n_filters,1,1). Each bias will
@@ -310,6 +330,43 @@ class ConvPoolLayer(object):
 
         return
 
+    def _conv_pool_c01b(self, input, pool_def, bias_noise):
+        """Convolve and pool bc01 input with cuda_convnet, via c01b."""
+        if not HAS_CUDA_CONVNET:
+            raise ValueError("the cuda_convnet backend isn't available")
+        input_c01b = input.dimshuffle(1, 2, 3, 0) # bc01 to c01b
+        filters_c01b = self.W.dimshuffle(1, 2, 3, 0) # bc01 to c01b
+        conv_op = FilterActs(stride=1, partial_sum=1)
+        contig_input = gpu_contiguous(input_c01b)
+        contig_filters = gpu_contiguous(filters_c01b)
+        conv_out_c01b = conv_op(contig_input, contig_filters)
+        conv_out_c01b = self._add_bias_noise(conv_out_c01b, bias_noise)
+        pool_op = MaxPool(ds=pool_def[0], stride=pool_def[1])
+        mp_out_c01b = pool_op(conv_out_c01b)
+        mp_out_bc01 = mp_out_c01b.dimshuffle(3, 0, 1, 2) # c01b to bc01
+        return mp_out_bc01
+
+    def _conv_pool_bc01(self, input, pool_def, bias_noise):
+        """Convolve and pool bc01 input with Theano's (CPU-capable) ops."""
+        # FilterActs computes correlations, so flip the filters to make
+        # conv2d match it for the same W.
+        conv_out_bc01 = conv2d(input, self.W[:, :, ::-1, ::-1])
+        conv_out_bc01 = self._add_bias_noise(conv_out_bc01, bias_noise)
+        # MaxPool keeps partial windows at the border, as does pool_2d with
+        # ignore_border=False.
+        mp_out_bc01 = pool_2d(conv_out_bc01, (pool_def[0], pool_def[0]), \
+                False, (pool_def[1], pool_def[1]))
+        return mp_out_bc01
+
+    def _add_bias_noise(self, conv_out, bias_noise):
+        """Add gaussian noise to the conv filter responses (if desired)."""
+        if (bias_noise > 1e-4):
+            noisy_conv_out = conv_out + self.rng.normal(size=conv_out.shape, \
+                    avg=0.0, std=bias_noise, dtype=theano.config.floatX)
+        else:
+            noisy_conv_out = conv_out
+        return noisy_conv_out
+
     def _drop_from_input(self, input, p):
         """p is the probability of dropping elements of input."""
         # get a drop mask that drops things with probability p
@@ -6,10 +6,18 @@ For example ``tile_raster_images`` helps in generating a easy to grasp
 image from a set of samples or weights.
 """
 
+import os
+import sys
 import numpy as np
 import pylab as plt
 import PIL as PIL
 
+# PhaseProfiler is shared with the other packages (see shared/README.md)
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (repo_dir in sys.path):
+    sys.path.append(repo_dir)
+from shared.profiling import PhaseProfiler, wall_time
+
 class batch(object):
     def __init__(self,batch_size):
         self.batch_size = batch_size
@@ -1,10 +1,16 @@
+import os
+import sys
 import time
 import numpy as np
 import numpy.random as npr
 import theano
 import theano.tensor as T
 from theano.ifelse import ifelse
-from load_data import load_udm, load_udm_ss, load_mnist
+# the data loaders are shared with the other packages (see shared/README.md)
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (repo_dir in sys.path):
+    sys.path.append(repo_dir)
+from shared.load_data import load_udm, load_udm_ss, load_mnist
 from PeaNet import PeaNet
 from GenNet import GenNet, projected_moments
 from GCPair import GCPair
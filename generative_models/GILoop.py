@@ -3,6 +3,8 @@
 ###################################################################
 
 # basic python
+import os
+import sys
 import numpy as np
 import numpy.random as npr
 from collections import OrderedDict
@@ -461,7 +463,11 @@ class GILoop(object):
         return sample_output
 
 if __name__=="__main__":
-    from load_data import load_udm, load_udm_ss, load_mnist
+    # the data loaders are shared with the other packages (see shared/README.md)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if not (repo_dir in sys.path):
+        sys.path.append(repo_dir)
+    from shared.load_data import load_udm, load_udm_ss, load_mnist
     
     # Initialize a source of randomness
     rng = np.random.RandomState(1234)
@@ -0,0 +1,328 @@
+###############################################################################
+# Throughput benchmarks for the models in NLModels (and W2VSimple) and for   #
+# the kernels in CythonFuncs. Everything runs on synthetic corpora, with     #
+# Zipf-distributed word frequencies, so no training text is needed. Each run #
+# appends one record to a JSON-lines results file, for regression tracking.  #
+###############################################################################
+
+import os
+import sys
+import time
+import json
+import platform
+import multiprocessing as mp
+import numpy as np
+import numpy.random as npr
+
+import CythonFuncs as cf
+import CorpusUtils as cu
+from HelperFuncs import PhaseProfiler
+
+# kernels benchmarked by default (hsm_ff_bp runs the nsl_ff_bp kernel, with
+# the wide and mostly-negative key matrices that come from HSM codes)
+BENCH_KERNELS = ['w2v_ff_bp', 'cbow_ff_bp', 'nsl_ff_bp', 'hsm_ff_bp', \
+                 'lut_bp', 'ag_update_2d']
+# models benchmarked by default
+BENCH_MODELS = ['w2v', 'w2v_cbow', 'cam_ns', 'cam_hsm', 'cam_acl', 'pv', \
+                'w2v_simple']
+
+#############################
+# SYNTHETIC ZIPFIAN CORPORA #
+#############################
+
+def zipf_corpus(word_count, vocab_size=20000, zipf_s=1.0, mean_len=20, \
+                seed=0):
+    """
+    Make a corpus of about word_count words, as a list of sentences (lists of
+    word strings). The word with frequency rank r is drawn with probability
+    proportional to 1 / r**zipf_s, and sentence lengths are 2 + Poisson.
+    """
+    rng = npr.RandomState(seed)
+    probs = 1.0 / (np.arange(1, vocab_size+1) ** zipf_s)
+    cdf = np.cumsum(probs / np.sum(probs))
+    keys = np.searchsorted(cdf, rng.rand(int(word_count)))
+    keys = np.minimum(keys, vocab_size-1)
+    words = np.asarray(['w{0:d}'.format(i) for i in range(vocab_size)])
+    sentences = []
+    start = 0
+    while start < keys.size:
+        stop = start + 2 + rng.poisson(max(0, mean_len - 2))
+        sentences.append(words[keys[start:stop]].tolist())
+        start = stop
+    return sentences
+
+def corpus_data(sentences, min_count=2, max_phrases=100000):
+    """
+    Get the vocab dicts (from CorpusUtils.build_vocab()) and the phrases
+    (from CorpusUtils.sample_phrases()) that the models train on.
+    """
+    key_dicts = cu.build_vocab(sentences, min_count=min_count, \
+                               compute_hs_tree=True, compute_ns_table=True, \
+                               down_sample=1e-3)
+    phrases = cu.sample_phrases(sentences, key_dicts['words_to_keys'], \
+                                unk_word=key_dicts['unk_word'], \
+                                max_phrases=max_phrases)
+    return {'sentences': sentences, 'key_dicts': key_dicts, \
+            'phrases': phrases}
+
+#####################
+# KERNEL BENCHMARKS #
+#####################
+
+def bench_kernel(name, batch_size, vec_dim, thread_num, backend, \
+                 extra=None, min_seconds=0.5):
+    """
+    Time one kernel from the given backend, on a random problem with the given
+    batch size and vector dim, split over thread_num threads. The kernel is
+    called repeatedly until min_seconds have passed, after one warm-up call.
+    """
+    kernel_name = 'nsl_ff_bp' if (name == 'hsm_ff_bp') else name
+    if extra is None:
+        # pos/neg keys per row for w2v/nsl, and HSM code length for hsm
+        extra = {'w2v_ff_bp': 11, 'cbow_ff_bp': 11, 'nsl_ff_bp': 11, \
+                 'hsm_ff_bp': 16}.get(name, 0)
+    args = cf.KERNEL_SPECS[kernel_name][0](npr.RandomState(0), batch_size, \
+                                           vec_dim, extra)
+    func = cf.make_multithread(cf.raw_kernels(backend)[kernel_name], \
+                               thread_num)
+    func(*cf._copy_args(args)) # warm up, e.g. for jit compilation
+    # copy the problem for each call, but don't time the copying
+    call_count = 0
+    seconds = 0.0
+    while seconds < min_seconds:
+        run_args = cf._copy_args(args)
+        t1 = time.time()
+        func(*run_args)
+        seconds += time.time() - t1
+        call_count += 1
+    return {'bench': 'kernel', 'name': name, 'backend': backend, \
+            'batch_size': batch_size, 'vec_dim': vec_dim, 'extra': extra, \
+            'thread_num': thread_num, 'calls': call_count, \
+            'seconds': seconds, 'rows_per_sec': (call_count * batch_size) / \
+            seconds}
+
+####################
+# MODEL BENCHMARKS #
+####################
+
+def _model_trainer(name, data, batch_size, wv_dim, thread_num):
+    """
+    Make one of the models in NLModels, with samplers for its training data.
+    Returns the model, and a function train(batch_count) that trains it.
+    """
+    import NLModels as nlm
+    key_dicts = data['key_dicts']
+    phrases = data['phrases']
+    max_wv_key = max(key_dicts['words_to_keys'].values())
+    max_cv_key = len(phrases) + 1
+    max_hs_key = key_dicts['hs_tree']['max_code_key']
+    pos_sampler = cu.PhraseSampler(phrases, 6, thread_count=thread_num, \
+                                   seed=1, keep_probs=key_dicts['keep_probs'])
+    neg_sampler = cu.NegSampler(neg_table=key_dicts['ns_table'], \
+                                neg_count=10, seed=2)
+    if name in ['w2v', 'w2v_cbow']:
+        model = nlm.W2VModel(wv_dim, max_wv_key, cbow=(name == 'w2v_cbow'))
+        model.init_params(0.025)
+        train = lambda bc: model.train(pos_sampler, neg_sampler, \
+                                       batch_size, bc)
+    elif name in ['cam_ns', 'cam_hsm', 'cam_acl']:
+        model = nlm.CAModel(wv_dim, 10, max_wv_key, max_cv_key, \
+                            use_ns=(name != 'cam_hsm'), \
+                            max_hs_key=max_hs_key, \
+                            use_acl=(name == 'cam_acl'))
+        model.init_params(0.025)
+        var_param = key_dicts['hs_tree'] if (name == 'cam_hsm') \
+                else neg_sampler
+        train = lambda bc: model.train(pos_sampler, var_param, \
+                                       batch_size, bc)
+    elif name == 'pv':
+        model = nlm.PVModel(wv_dim, 25, max_wv_key+1, max_cv_key, \
+                            max_hs_key, pre_words=5)
+        model.init_params(0.02)
+        code_keys = key_dicts['hs_tree']['keys_to_code_keys']
+        code_signs = key_dicts['hs_tree']['keys_to_code_signs']
+        train = lambda bc: model.train(pos_sampler, code_keys, code_signs, \
+                                       batch_size, bc)
+    else:
+        raise ValueError("unknown model: {0:s}".format(name))
+    return model, train
+
+def bench_model(name, data, batch_size, wv_dim, thread_num, backend, \
+                batch_count=1000, profile=False):
+    """
+    Time batch_count minibatch updates of a model from NLModels, using kernels
+    from the given backend that are split over thread_num threads. If profile
+    is True, the record also gets the seconds spent in each training phase.
+    """
+    cf.set_default_backend(backend)
+    cf.set_thread_num(thread_num)
+    model, train = _model_trainer(name, data, batch_size, wv_dim, thread_num)
+    train(5) # warm up, e.g. for jit compilation and autotuning
+    if profile:
+        prof = PhaseProfiler(report_every=batch_count, tag=name)
+        model.set_profiler(prof)
+    t1 = time.time()
+    train(batch_count)
+    seconds = time.time() - t1
+    word_count = batch_size * batch_count
+    record = {'bench': 'model', 'name': name, 'backend': backend, \
+              'batch_size': batch_size, 'vec_dim': wv_dim, \
+              'thread_num': thread_num, 'words': word_count, \
+              'seconds': seconds, 'words_per_sec': word_count / seconds}
+    if profile:
+        record['phase_seconds'] = prof.total_seconds
+    return record
+
+def bench_w2v_simple(data, wv_dim, thread_num):
+    """
+    Time a pass of W2VSimple (skip-gram with HSM) over the corpus sentences,
+    with thread_num worker threads. The words counted are those that survived
+    subsampling, as reported by W2VSimple.train().
+    """
+    gensim_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+                              'gensim_code')
+    if not (gensim_dir in sys.path):
+        sys.path.append(gensim_dir)
+    import W2VSimple as w2vs
+    model = w2vs.W2VSimple(size=wv_dim, window=6, min_count=2, sample=1e-3, \
+                           workers=thread_num, sg=1, hs=1, negative=0)
+    model.build_vocab(data['sentences'])
+    t1 = time.time()
+    word_count = model.train(data['sentences'])
+    seconds = time.time() - t1
+    return {'bench': 'model', 'name': 'w2v_simple', \
+            'backend': 'cython', 'batch_size': None, \
+            'vec_dim': wv_dim, 'thread_num': thread_num, \
+            'words': word_count, 'seconds': seconds, \
+            'words_per_sec': word_count / seconds}
+
+##########################
+# BENCHMARK SUITE RUNNER #
+##########################
+
+def run_benchmarks(results_file='bench_results.jsonl', kernels=None, \
+                   models=None, backends=None, batch_sizes=[64, 256, 1024], \
+                   vec_dims=[50, 100, 200], thread_nums=[1, 2, 4], \
+                   word_count=1000000, vocab_size=20000, zipf_s=1.0, \
+                   batch_count=1000, tag=''):
+    """
+    Run each kernel and each model for all combinations of backend, batch
+    size, vector dim and thread count, and append a record for each run to
+    results_file (as JSON-lines).
+
+    Parameters:
+        results_file: file to append results to
+        kernels: kernels to time (default: BENCH_KERNELS)
+        models: models to time (default: BENCH_MODELS)
+        backends: kernel backends to time (default: all available ones)
+        batch_sizes: minibatch sizes to try
+        vec_dims: word vector dims to try
+        thread_nums: thread counts to try
+        word_count: number of words in the synthetic corpus
+        vocab_size: number of distinct words in the synthetic corpus
+        zipf_s: exponent of the corpus' Zipf distribution
+        batch_count: number of minibatch updates per model run
+        tag: free-form label recorded with each result (e.g. a git hash)
+    """
+    if kernels is None:
+        kernels = BENCH_KERNELS
+    if models is None:
+        models = BENCH_MODELS
+    if backends is None:
+        backends = cf.available_backends()
+    # every record says where and on what it ran
+    run_info = {'tag': tag, 'started': time.strftime('%Y-%m-%d %H:%M:%S'), \
+                'host': platform.node(), 'python': platform.python_version(), \
+                'numpy': np.__version__, 'cpu_count': mp.cpu_count(), \
+                'word_count': word_count, 'vocab_size': vocab_size, \
+                'zipf_s': zipf_s}
+    old_backend = cf.DEFAULT_BACKEND
+    old_thread_num = cf.THREAD_NUM
+    records = []
+    out_file = open(results_file, 'ab')
+    def write_record(record):
+        record.update(run_info)
+        out_file.write(json.dumps(record) + "\n")
+        out_file.flush()
+        print("{0:s} {1:s} ({2:s}): batch {3}, dim {4:d}, threads {5:d}: " \
+              "{6:.0f} {7:s}".format(record['bench'], record['name'], \
+              record['backend'], record['batch_size'], record['vec_dim'], \
+              record['thread_num'], record.get('words_per_sec', \
+              record.get('rows_per_sec')), ('words/sec' if \
+              (record['bench'] == 'model') else 'rows/sec')))
+        records.append(record)
+        return
+    # time the kernels on random problems
+    for name in kernels:
+        for backend in backends:
+            for batch_size in batch_sizes:
+                for vec_dim in vec_dims:
+                    for thread_num in thread_nums:
+                        write_record(bench_kernel(name, batch_size, vec_dim, \
+                                                  thread_num, backend))
+    # time the models on a synthetic corpus
+    if len(models) > 0:
+        data = corpus_data(zipf_corpus(word_count, vocab_size=vocab_size, \
+                                       zipf_s=zipf_s))
+    for name in models:
+        for vec_dim in vec_dims:
+            for thread_num in thread_nums:
+                if name == 'w2v_simple':
+                    write_record(bench_w2v_simple(data, vec_dim, thread_num))
+                    continue
+                for backend in backends:
+                    for batch_size in batch_sizes:
+                        write_record(bench_model(name, data, batch_size, \
+                                vec_dim, thread_num, backend, \
+                                batch_count=batch_count))
+    out_file.close()
+    cf.set_default_backend(old_backend)
+    cf.set_thread_num(old_thread_num)
+    return records
+
+def compare_results(results_file, base_tag, new_tag, max_drop=0.1):
+    """
+    Compare the runs recorded under base_tag and new_tag in results_file, and
+    print every benchmark whose throughput dropped by more than max_drop (as
+    a fraction of the base throughput). Returns the list of slowdowns.
+    """
+    runs = {base_tag: {}, new_tag: {}}
+    for line in open(results_file):
+        record = json.loads(line)
+        if record.get('tag') in runs:
+            bench_key = (record['bench'], record['name'], record['backend'], \
+                         record['batch_size'], record['vec_dim'], \
+                         record['thread_num'])
+            rate = record.get('words_per_sec', record.get('rows_per_sec'))
+            # keep the best of repeated runs, to reduce noise
+            runs[record['tag']][bench_key] = max(rate, \
+                    runs[record['tag']].get(bench_key, 0.0))
+    slowdowns = []
+    for (bench_key, base_rate) in sorted(runs[base_tag].items()):
+        if bench_key in runs[new_tag]:
+            drop = 1.0 - (runs[new_tag][bench_key] / base_rate)
+            if drop > max_drop:
+                slowdowns.append((bench_key, drop))
+                print("SLOWER BY {0:.1f}%: {1}".format(100.0 * drop, \
+                        bench_key))
+    return slowdowns
+
+if __name__=="__main__":
+    # a quick run of the full suite, which takes a few minutes
+    run_benchmarks(batch_sizes=[256], vec_dims=[100], thread_nums=[1, 4], \
+                   word_count=200000, batch_count=500)
+    #####
+    #####
+    #####
+
+
+
+
+
+
+
+
+
+##############
+# EYE BUFFER #
+##############
@@ -11,10 +11,13 @@
 
 import os
 import sys
+import gzip
+import bz2
 import heapq
 import time
 import random
 import itertools
+import threading
 try:
     from queue import Queue
 except ImportError:
@@ -29,26 +32,178 @@ from six.moves import xrange
 
 MAX_HSM_KEY = 12345678
 
+############################
+# STREAMING CORPUS READERS #
+############################
+
+# Bytes per decompressed block handed from the reader thread to the tokenizer,
+# and the number of blocks the reader thread may buffer ahead.
+READ_CHUNK_BYTES = 1 << 22
+READ_AHEAD_CHUNKS = 4
+# Line breaks are swapped for this token when mapping a whole block of text to
+# keys at once, so that its key marks the phrase boundaries in the key array.
+# The key is negative, so it can't clash with a real LUT key. A bare '\x01'
+# token in the source text would also end a phrase.
+LINE_BREAK = '\x01'
+LINE_BREAK_KEY = -1
+# Words missing from the vocabulary get this key when they're to be dropped.
+MISSING_KEY = -2
+
+if bytes is str:
+    def _native_str(b):
+        return b
+else:
+    def _native_str(b):
+        return b.decode('utf-8', 'replace')
+
+def open_text_file(fname):
+    """Open a plain, .gz, or .bz2 text file for reading bytes."""
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    if fname.endswith('.bz2'):
+        return bz2.BZ2File(fname, 'rb')
+    return open(fname, 'rb')
+
+def corpus_files(dirname):
+    """Get the (sorted) text files in dirname, or [dirname] for a file."""
+    if not os.path.isdir(dirname):
+        return [dirname]
+    fnames = [f for f in sorted(os.listdir(dirname)) if ((f.find('.txt') > -1) \
+            or f.endswith('.gz') or f.endswith('.bz2'))]
+    return [os.path.join(dirname, f) for f in fnames]
+
+def _read_chunks(source, chunk_bytes, chunk_queue, stop):
+    """Push blocks of decompressed bytes from source onto chunk_queue."""
+    try:
+        if hasattr(source, 'read'):
+            f = source
+        else:
+            f = open_text_file(source)
+        try:
+            while not stop.is_set():
+                chunk = f.read(chunk_bytes)
+                if not chunk:
+                    break
+                chunk_queue.put(chunk)
+        finally:
+            if not (f is source):
+                f.close()
+    except Exception as e:
+        chunk_queue.put(e)
+        return
+    chunk_queue.put(None)
+    return
+
+def iter_text_blocks(source, chunk_bytes=READ_CHUNK_BYTES):
+    """
+    Iterate over large blocks of whole lines from a plain/.gz/.bz2 text file.
+
+    source is a file name, or a file-like object opened for reading bytes.
+    File reads and decompression run in a background thread (zlib and bz2 both
+    release the GIL while working), which passes blocks of chunk_bytes to this
+    generator through a bounded queue. Each yielded block holds some number of
+    complete lines, joined by '\n' and without a trailing '\n'.
+    """
+    chunk_queue = Queue(maxsize=READ_AHEAD_CHUNKS)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_chunks, \
+            args=(source, chunk_bytes, chunk_queue, stop))
+    reader.daemon = True
+    reader.start()
+    tail = b''
+    try:
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            # split off the partial line at the end of this block, if any
+            block = tail + chunk
+            cut = block.rfind(b'\n')
+            if cut < 0:
+                tail = block
+                continue
+            tail = block[(cut+1):]
+            yield _native_str(block[:cut])
+        if len(tail) > 0:
+            yield _native_str(tail)
+    finally:
+        # let the reader thread finish if we stopped early
+        stop.set()
+        while not chunk_queue.empty():
+            chunk_queue.get_nowait()
+    return
+
+def block_key_phrases(block, get_key, unk_key=MISSING_KEY):
+    """
+    Map a block of lines to int32 keys in one pass, and cut it into phrases.
+
+    get_key(word, unk_key) gives the key for each word, and must give
+    LINE_BREAK_KEY for LINE_BREAK (e.g. the get() of a dict with that entry).
+    Words missing from the vocabulary get unk_key, or are dropped if unk_key
+    is MISSING_KEY. Returns one int32 array of keys for each line.
+    """
+    words = block.replace('\n', ' ' + LINE_BREAK + ' ').split()
+    keys = np.array([get_key(w, unk_key) for w in words], dtype=np.int32)
+    breaks = np.flatnonzero(keys == LINE_BREAK_KEY)
+    starts = np.concatenate(([0], breaks + 1))
+    ends = np.concatenate((breaks, [keys.size]))
+    phrases = [keys[starts[i]:ends[i]] for i in xrange(starts.size)]
+    if (unk_key == MISSING_KEY):
+        phrases = [p[p != MISSING_KEY] for p in phrases]
+    return phrases
+
 class SentenceFileIterator(object):
     """
     Iterator over all files in some directory.
 
     The directory passed to this object's constructor should contain only text
-    files. The text files will be parsed extremely naively, by simply treating
-    '\n' characters as delimiters between sentences/phrases/paragraphs, or
-    whatever, and then splitting each chunk of text on white space (i.e. by
-    applying *.split().
+    files, which may be compressed with gzip (*.gz) or bzip2 (*.bz2). The text
+    files will be parsed extremely naively, by simply treating '\n' characters
+    as delimiters between sentences/phrases/paragraphs, or whatever, and then
+    splitting each chunk of text on white space (i.e. by applying *.split().
+    A single file can be given in place of the directory.
     """
-    def __init__(self, dirname):
+    def __init__(self, dirname, chunk_bytes=READ_CHUNK_BYTES):
         self.dirname = dirname
+        self.chunk_bytes = chunk_bytes
         return
 
     def __iter__(self):
-        for fname in os.listdir(self.dirname):
-            if fname.find('.txt') > -1:
-                for line in open(os.path.join(self.dirname, fname)):
+        for fname in corpus_files(self.dirname):
+            for block in iter_text_blocks(fname, self.chunk_bytes):
+                for line in block.split('\n'):
                     yield line.split()
 
+class KeySentenceIterator(object):
+    """
+    Iterator over all files in some directory, yielding phrases as LUT keys.
+
+    This reads the same files as SentenceFileIterator, but maps the words to
+    their keys in words_to_keys on the fly and yields each phrase as an int32
+    array of keys, with out-of-vocabulary words mapped to unk_word's key. Each
+    block of text from the reader thread is tokenized and mapped in one pass,
+    after which it's cut into phrases at the line breaks. The yielded arrays
+    are views into the key array for their block.
+    """
+    def __init__(self, dirname, words_to_keys, unk_word='*UNK*', \
+                 chunk_bytes=READ_CHUNK_BYTES):
+        self.dirname = dirname
+        self.chunk_bytes = chunk_bytes
+        self.unk_key = words_to_keys[unk_word]
+        self.words_to_keys = dict(words_to_keys)
+        self.words_to_keys[LINE_BREAK] = LINE_BREAK_KEY
+        return
+
+    def __iter__(self):
+        get_key = self.words_to_keys.get
+        unk_key = self.unk_key
+        for fname in corpus_files(self.dirname):
+            for block in iter_text_blocks(fname, self.chunk_bytes):
+                for phrase in block_key_phrases(block, get_key, unk_key):
+                    yield phrase
+
 class Vocab(object):
     """
     A single vocabulary item, used internally when running build_vocab().
@@ -169,6 +324,10 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
     #           Unused entries in the key matrix are set to > MAX_HSM_KEY, and
     #           unused entries in the sign matrix are set to 0. This lets us
     #           use the "fixed-length" codes just like variable-length codes.
+    #
+    #   keep_probs: vector giving the retention probability for each word LUT
+    #               key, as computed for down_sample. PhraseSampler uses these
+    #               to subsample frequent words when drawing training pairs.
     #                            
     result = {}
     result['words_to_vocabs'] = words_to_vocabs
@@ -177,6 +336,7 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
     result['unk_word'] = '*UNK*'
     result['hs_tree'] = None
     result['ns_table'] = None
+    result['keep_probs'] = _make_keep_probs(words_to_vocabs)
     if compute_hs_tree:
         result['hs_tree'] = _create_binary_tree(words_to_vocabs)
     if compute_ns_table:
@@ -196,11 +356,23 @@ def _precalc_downsampling(w2v, down_sample=0.0):
     total_words = sum([v.count for v in itervalues(w2v)])
     for v in itervalues(w2v):
         prob = 1.0
-        if sample:
-            prob = np.sqrt(down_sample / (v.count / total_words))
+        if sample and (v.count > 0):
+            prob = np.sqrt(down_sample / (float(v.count) / total_words))
         v.sample_prob = min(prob, 1.0)
     return
 
+def _make_keep_probs(w2v):
+    """
+    Collect the retention probability for each word into a vector indexed by
+    the words' LUT keys.
+
+    Called from `build_vocab()`.
+    """
+    keep_probs = np.ones((len(w2v),), dtype=np.float32)
+    for v in itervalues(w2v):
+        keep_probs[v.index] = v.sample_prob
+    return keep_probs
+
 def _make_table(w2v, k2w, w2k, table_size=20000000, power=0.75):
     """
     Create a table using stored vocabulary word counts for drawing random words
@@ -287,6 +459,12 @@ def sample_phrases(text_stream, words_to_keys, unk_word='*UNK*', \
                     max_phrases=100000):
     phrases = []
     for text_blob in text_stream:
+        if isinstance(text_blob, np.ndarray):
+            # phrases from a KeySentenceIterator are already mapped to keys
+            phrases.append(text_blob.astype(np.uint32))
+            if len(phrases) >= max_phrases:
+                break
+            continue
         p_keys = np.zeros((len(text_blob),), dtype=np.uint32)
         for (i, word) in enumerate(text_blob):
             if word in words_to_keys:
@@ -302,158 +480,386 @@ def sample_phrases(text_stream, words_to_keys, unk_word='*UNK*', \
 # TRAINING EXAMPLE SAMPLING UTILS #
 ###################################
 
-@numba.jit("void(u4[:], i8, i8, i8, u4[:], u4[:], u4[:], u4[:])")
-def fast_pair_sample(phrase, max_window, i, repeats, anc_keys, pos_keys, rand_pool, ri):
-    phrase_len = phrase.size
-    for r in range(repeats):
-        j = i + r
-        a_idx = rand_pool[ri[0]] % phrase_len
-        ri[0] += 1
-        red_win = (rand_pool[ri[0]] % max_window) + 1
-        ri[0] += 1
-        c_min = a_idx - red_win
-        if (c_min < 0):
-            c_min = 0
-        c_max = a_idx + red_win
-        if (c_max >= phrase_len):
-            c_max = phrase_len - 1
-        c_span = c_max - c_min + 1
-        c_idx = a_idx
-        while (c_idx == a_idx):
-            c_idx = c_min + (rand_pool[ri[0]] % c_span)
-            ri[0] += 1
-        anc_keys[j] = phrase[a_idx]
-        pos_keys[j] = phrase[c_idx]
+# Constants for the counter-based RNG used by the compiled samplers. Each
+# random draw is a SplitMix64 hash of (seed + counter * golden gamma). Every
+# sample hashes its own stream seed from (sampler seed, sample counter), so a
+# sample can take as many draws as it needs (e.g. when subsampling), and any
+# range of samples can still be drawn independently of the others.
+RNG_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+RNG_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+RNG_MIX_2 = np.uint64(0x94D049BB133111EB)
+RNG_SHIFT_1 = np.uint64(30)
+RNG_SHIFT_2 = np.uint64(27)
+RNG_SHIFT_3 = np.uint64(31)
+RNG_SHIFT_F = np.uint64(11)
+RNG_UNIT_F = 1.0 / 2**53
+
+@numba.jit("u8(u8, u8)", nopython=True, nogil=True)
+def _rand_u64(seed, counter):
+    z = seed + (counter * RNG_GAMMA)
+    z = (z ^ (z >> RNG_SHIFT_1)) * RNG_MIX_1
+    z = (z ^ (z >> RNG_SHIFT_2)) * RNG_MIX_2
+    return z ^ (z >> RNG_SHIFT_3)
+
+@numba.jit("f8(u8, u8)", nopython=True, nogil=True)
+def _rand_f64(seed, counter):
+    # uniform draw from [0, 1), using the top 53 bits of a random u64
+    return np.float64(_rand_u64(seed, counter) >> RNG_SHIFT_F) * RNG_UNIT_F
+
+@numba.jit("i8(i8[:], i8)", nopython=True, nogil=True)
+def _find_phrase(offsets, t_idx):
+    # binary search for the phrase whose keys include flat position t_idx
+    lo = 0
+    hi = offsets.size - 1
+    while ((hi - lo) > 1):
+        mid = (lo + hi) // 2
+        if (offsets[mid] <= t_idx):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+@numba.jit("void(u4[:], i8[:], u4[:], f4[:], i8, u8, u8, i8, i8, u4[:], u4[:], u4[:])", \
+        nopython=True, nogil=True)
+def fast_pair_sample(keys, offsets, phrase_ids, keep_probs, max_window, seed, \
+        counter, i_start, i_stop, anc_keys, pos_keys, phrase_keys):
+    key_count = np.uint64(keys.size)
+    win_count = np.uint64(max_window)
+    subsample = (keep_probs.size > 0)
+    for j in range(i_start, i_stop):
+        s_seed = _rand_u64(seed, counter + np.uint64(j))
+        s_ctr = np.uint64(0)
+        keep = False
+        while not keep:
+            # a uniformly drawn key picks phrases in proportion to their length
+            t_idx = np.int64(_rand_u64(s_seed, s_ctr) % key_count)
+            p_idx = _find_phrase(offsets, t_idx)
+            p_start = offsets[p_idx]
+            p_stop = offsets[p_idx+1]
+            # draw a reduced window size, and clip the window to the phrase
+            red_win = np.int64(_rand_u64(s_seed, s_ctr + np.uint64(1)) % win_count) + 1
+            c_min = t_idx - red_win
+            if (c_min < p_start):
+                c_min = p_start
+            c_max = t_idx + red_win
+            if (c_max >= p_stop):
+                c_max = p_stop - 1
+            # draw a context position from the window, skipping the anchor
+            c_span = np.uint64(c_max - c_min)
+            c_idx = c_min + np.int64(_rand_u64(s_seed, s_ctr + np.uint64(2)) % c_span)
+            if (c_idx >= t_idx):
+                c_idx += 1
+            keep = True
+            if subsample:
+                # keep the pair only if both of its words survive subsampling
+                keep_prob = keep_probs[keys[t_idx]] * keep_probs[keys[c_idx]]
+                keep = (_rand_f64(s_seed, s_ctr + np.uint64(3)) < keep_prob)
+            s_ctr += np.uint64(4)
+        anc_keys[j] = keys[t_idx]
+        pos_keys[j] = keys[c_idx]
+        phrase_keys[j] = phrase_ids[p_idx]
     return
 
-@numba.jit("void(u4[:], i8, i8, u4[:], i8, u4[:,:], u4[:], u4[:])")
-def fast_seq_sample(phrase, gram_n, pad_key, i, repeats, key_seqs, rand_pool, ri):
-    phrase_len = phrase.size
-    for r in range(repeats):
-        j = i + r
-        # Get a random stopping point for the n-gram. For now, assume that
-        # n-grams containing fewer than 2 valid words, i.e. a context word and
-        # a predicted word, are not desired.
-        stop_idx = (rand_pool[ri[0]] % (phrase_len - 1)) + 1
-        ri[0] += 1
+@numba.jit("void(u4[:], i8[:], u4[:], f4[:], i8, u8, u8, i8, i8, u4[:,:], u4[:], u4[:], u4[:])", \
+        nopython=True, nogil=True)
+def fast_cbow_sample(keys, offsets, phrase_ids, keep_probs, max_window, seed, \
+        counter, i_start, i_stop, ctx_keys, ctx_lens, tgt_keys, phrase_keys):
+    key_count = np.uint64(keys.size)
+    win_count = np.uint64(max_window)
+    subsample = (keep_probs.size > 0)
+    for j in range(i_start, i_stop):
+        s_seed = _rand_u64(seed, counter + np.uint64(j))
+        s_ctr = np.uint64(0)
+        keep = False
+        while not keep:
+            t_idx = np.int64(_rand_u64(s_seed, s_ctr) % key_count)
+            p_idx = _find_phrase(offsets, t_idx)
+            p_start = offsets[p_idx]
+            p_stop = offsets[p_idx+1]
+            # draw a reduced window size, and clip the window to the phrase
+            red_win = np.int64(_rand_u64(s_seed, s_ctr + np.uint64(1)) % win_count) + 1
+            c_min = t_idx - red_win
+            if (c_min < p_start):
+                c_min = p_start
+            c_max = t_idx + red_win
+            if (c_max >= p_stop):
+                c_max = p_stop - 1
+            keep = True
+            if subsample:
+                # the target word has to survive subsampling
+                keep_prob = keep_probs[keys[t_idx]]
+                keep = (_rand_f64(s_seed, s_ctr + np.uint64(2)) < keep_prob)
+            # pack the surviving context words into the front of the row
+            c_count = 0
+            if keep:
+                for c_idx in range(c_min, c_max+1):
+                    if (c_idx != t_idx):
+                        c_keep = True
+                        if subsample:
+                            c_draw = s_ctr + np.uint64(3 + c_idx - c_min)
+                            c_keep = (_rand_f64(s_seed, c_draw) < \
+                                      keep_probs[keys[c_idx]])
+                        if c_keep:
+                            ctx_keys[j,c_count] = keys[c_idx]
+                            c_count += 1
+                keep = (c_count > 0)
+            s_ctr += np.uint64(4 + (2 * max_window))
+        ctx_lens[j] = c_count
+        tgt_keys[j] = keys[t_idx]
+        phrase_keys[j] = phrase_ids[p_idx]
+    return
+
+@numba.jit("void(u4[:], i8[:], u4[:], f4[:], i8, u4, u8, u8, i8, i8, u4[:,:], u4[:])", \
+        nopython=True, nogil=True)
+def fast_seq_sample(keys, offsets, phrase_ids, keep_probs, gram_n, pad_key, \
+        seed, counter, i_start, i_stop, key_seqs, phrase_keys):
+    key_count = np.uint64(keys.size)
+    subsample = (keep_probs.size > 0)
+    for j in range(i_start, i_stop):
+        s_seed = _rand_u64(seed, counter + np.uint64(j))
+        s_ctr = np.uint64(0)
+        keep = False
+        while not keep:
+            t_idx = np.int64(_rand_u64(s_seed, s_ctr) % key_count)
+            p_idx = _find_phrase(offsets, t_idx)
+            p_start = offsets[p_idx]
+            p_len = np.uint64(offsets[p_idx+1] - p_start)
+            # Get a random stopping point for the n-gram. For now, assume that
+            # n-grams containing fewer than 2 valid words, i.e. a context word
+            # and a predicted word, are not desired.
+            stop_idx = np.int64(_rand_u64(s_seed, s_ctr + np.uint64(1)) % (p_len - 1)) + 1
+            keep = True
+            if subsample:
+                # keep the n-gram only if its predicted word survives
+                keep_prob = keep_probs[keys[p_start+stop_idx]]
+                keep = (_rand_f64(s_seed, s_ctr + np.uint64(2)) < keep_prob)
+            s_ctr += np.uint64(3)
         # Get the start index of the n-gram (maybe negative)
         start_idx = stop_idx - gram_n + 1
-        cur_pos = 0
-        while (cur_pos < gram_n):
+        for cur_pos in range(gram_n):
             # Record the word LUT keys for this n-gram, substituting the
             # "padding key" as required due to phrase length
             if ((start_idx + cur_pos) < 0):
-                key_seqs[j,cur_pos] = pad_key[0]
+                key_seqs[j,cur_pos] = pad_key
             else:
-                key_seqs[j,cur_pos] = phrase[start_idx+cur_pos]
-            cur_pos += 1
+                key_seqs[j,cur_pos] = keys[p_start+start_idx+cur_pos]
+        phrase_keys[j] = phrase_ids[p_idx]
+    return
+
+def _run_chunked(sample_func, sample_count, thread_count, args):
+    """
+    Split sample indices [0, sample_count) into chunks, and run sample_func
+    on each chunk in its own thread. The samplers release the GIL, and each
+    sample gets its own RNG counter, so the chunks don't interact.
+    """
+    if (sample_count == 0):
+        return
+    thread_count = max(1, min(thread_count, sample_count))
+    chunk_len = (sample_count + (thread_count - 1)) // thread_count
+    bounds = [(i, min(i+chunk_len, sample_count)) \
+            for i in range(0, sample_count, chunk_len)]
+    threads = [threading.Thread(target=sample_func, args=(args[:-1] + b + args[-1])) \
+            for b in bounds[:-1]]
+    for thread in threads:
+        thread.start()
+    # Give the last chunk of work to the main thread
+    sample_func(*(args[:-1] + bounds[-1] + args[-1]))
+    for thread in threads:
+        thread.join()
     return
 
 class PhraseSampler:
     """
     This samples positive example pairs each comprising an anchor word and a
     near-by context word from its "skip-gram window". This can also samples
-    n_gram sequences from the managed collection of phrases.
+    n_gram sequences from the managed collection of phrases, and (for CBOW)
+    target words along with all the words in their window.
+
+    Phrases with fewer than 2 words have no valid pairs/n-grams, and are never
+    sampled. All samples for a request are drawn in one compiled call, which
+    releases the GIL and can be split over thread_count threads.
+
+    If keep_probs is given (e.g. the 'keep_probs' from build_vocab()), then
+    frequent words are subsampled: a pair is kept with probability equal to
+    the product of its words' keep_probs, and an n-gram is kept with the
+    keep_prob of its predicted word. A CBOW group keeps its target word with
+    its keep_prob, and each context word with its own keep_prob. Rejected
+    draws are simply redrawn.
     """
-    def __init__(self, phrase_list, max_window, max_phrase_key=50000):
+    def __init__(self, phrase_list, max_window, max_phrase_key=50000, \
+                 thread_count=1, seed=None, keep_probs=None):
         # phrase_list contains the phrases to sample from
         self.max_window = max_window
         self.phrase_list = phrase_list
-        self.phrase_table = self._make_table(self.phrase_list)
         self.max_phrase_key = min(len(self.phrase_list), max_phrase_key)
-        self.pt_size = self.phrase_table.size
+        self.thread_count = thread_count
+        self._flatten_phrases(self.phrase_list)
+        self.set_keep_probs(keep_probs)
+        # state for the counter-based RNG, which advances with each sample
+        if seed is None:
+            seed = npr.randint(0, high=2**31)
+        self.rng_seed = np.uint64(seed)
+        self.rng_counter = np.uint64(0)
         return
 
-    def _make_table(self, p_list, table_size=20000000):
+    def _flatten_phrases(self, p_list):
         """
-        Create a table for quickly drawing phrase indices in proportion to
-        the length of each phrase.
+        Concatenate the keys of all phrases with at least 2 words into one
+        array, with phrase boundaries given by self.offsets and the index of
+        each kept phrase in p_list given by self.phrase_ids.
         """
-        phrase_count = len(p_list)
-        phrase_lens = np.asarray([p.size for p in p_list]).astype(np.float64)
-        len_sum = np.sum(phrase_lens)
-        table = np.zeros((table_size,), dtype=np.uint32)
-        widx = 0
-        d1 = phrase_lens[0] / len_sum
-        for tidx in xrange(table_size):
-            table[tidx] = widx
-            if ((float(tidx) / table_size) > d1):
-                widx += 1
-                d1 += phrase_lens[widx] / len_sum
-            if widx >= phrase_count:
-                widx = phrase_count - 1
-        return table.astype(np.uint32)
+        phrase_ids = [i for (i, p) in enumerate(p_list) if (p.size >= 2)]
+        if (len(phrase_ids) == 0):
+            raise ValueError("PhraseSampler needs a phrase with 2+ words")
+        phrase_lens = np.asarray([p_list[i].size for i in phrase_ids])
+        self.phrase_ids = np.asarray(phrase_ids).astype(np.uint32)
+        self.offsets = np.zeros((len(phrase_ids) + 1,), dtype=np.int64)
+        self.offsets[1:] = np.cumsum(phrase_lens)
+        self.keys = np.concatenate([p_list[i] for i in phrase_ids])
+        self.keys = self.keys.astype(np.uint32)
+        return
+
+    def set_keep_probs(self, keep_probs=None):
+        """Set the per-word retention probabilities used for subsampling."""
+        if (keep_probs is None) or np.all(np.asarray(keep_probs) >= 1.0):
+            # an empty vector turns subsampling off in the compiled samplers
+            self.keep_probs = np.zeros((0,), dtype=np.float32)
+        else:
+            keep_probs = np.asarray(keep_probs, dtype=np.float32).ravel()
+            assert(keep_probs.size > np.max(self.keys))
+            assert(np.max(keep_probs[self.keys]) > 0.0)
+            self.keep_probs = keep_probs
+        return
+
+    def _next_counter(self, sample_count):
+        """Reserve RNG counter values for sample_count samples."""
+        counter = self.rng_counter
+        self.rng_counter = counter + np.uint64(sample_count)
+        return counter
 
     def sample_pairs(self, sample_count):
         """Draw a sample."""
         anc_keys = np.zeros((sample_count,), dtype=np.uint32)
         pos_keys = np.zeros((sample_count,), dtype=np.uint32)
         phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
-        # we will use a "precomputed" table of random ints, to save overhead
-        # on calls through numpy.random. the location of the next fresh random
-        # int in rand_pool is given by ri[0]
-        rand_pool = npr.randint(0, high=self.pt_size, \
-                size=(10*sample_count,)).astype(np.uint32)
-        ri = np.asarray([0]).astype(np.uint32) # index into rand_pool
-        repeats = 5
-        while not ((sample_count % repeats) == 0):
-            repeats -= 1
-        for i in range(0, sample_count, repeats):
-            pt_idx = rand_pool[ri[0]]
-            ri[0] = ri[0] + 1
-            phrase_keys[i:(i+repeats)] = self.phrase_table[pt_idx]
-            fast_pair_sample(self.phrase_list[phrase_keys[i]], self.max_window, \
-                             i, repeats, anc_keys, pos_keys, rand_pool, ri)
-        anc_keys = anc_keys.astype(np.uint32)
-        pos_keys = pos_keys.astype(np.uint32)
+        counter = self._next_counter(sample_count)
+        args = (self.keys, self.offsets, self.phrase_ids, self.keep_probs, \
+                self.max_window, self.rng_seed, counter, \
+                (anc_keys, pos_keys, phrase_keys))
+        _run_chunked(fast_pair_sample, sample_count, self.thread_count, args)
         phrase_keys = np.minimum(self.max_phrase_key, phrase_keys).astype(np.uint32)
         return [anc_keys, pos_keys, phrase_keys]
 
+    def sample_cbow(self, sample_count):
+        """
+        Draw a sample of (context window, target word) groups, for CBOW. Row
+        j of ctx_keys holds ctx_lens[j] context word keys, followed by 0s.
+        """
+        ctx_keys = np.zeros((sample_count, 2*self.max_window), dtype=np.uint32)
+        ctx_lens = np.zeros((sample_count,), dtype=np.uint32)
+        tgt_keys = np.zeros((sample_count,), dtype=np.uint32)
+        phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
+        counter = self._next_counter(sample_count)
+        args = (self.keys, self.offsets, self.phrase_ids, self.keep_probs, \
+                self.max_window, self.rng_seed, counter, \
+                (ctx_keys, ctx_lens, tgt_keys, phrase_keys))
+        _run_chunked(fast_cbow_sample, sample_count, self.thread_count, args)
+        phrase_keys = np.minimum(self.max_phrase_key, phrase_keys).astype(np.uint32)
+        return [ctx_keys, ctx_lens, tgt_keys, phrase_keys]
+
     def sample_ngrams(self, sample_count, gram_n=5, pad_key=None):
-        """Draw a sample."""
+        """
+        Draw a sample. Windows that run off the front of their phrase are
+        filled with pad_key, which must be given (e.g. the model's reserved
+        max_wv_key), since no key is safe to pad with for every vocabulary.
+        """
+        if pad_key is None:
+            raise ValueError("sample_ngrams needs a pad_key")
         key_seqs = np.zeros((sample_count, gram_n), dtype=np.uint32)
         phrase_keys = np.zeros((sample_count,), dtype=np.uint32)
-        pad_key = np.asarray([pad_key]).astype(np.uint32)
-        # we will use a "precomputed" table of random ints, to save overhead
-        # on calls through numpy.random. the location of the next fresh random
-        # int in rand_pool is given by ri[0]
-        rand_pool = npr.randint(0, high=self.pt_size, \
-                size=(10*sample_count,)).astype(np.uint32)
-        ri = np.asarray([0]).astype(np.uint32) # index into rand_pool
-        repeats = 5
-        while not ((sample_count % repeats) == 0):
-            repeats -= 1
-        for i in range(0, sample_count, repeats):
-            pt_idx = rand_pool[ri[0]]
-            ri[0] = ri[0] + 1
-            phrase_keys[i:(i+repeats)] = self.phrase_table[pt_idx]
-            fast_seq_sample(self.phrase_list[phrase_keys[i]], gram_n, pad_key, \
-                    i, repeats, key_seqs, rand_pool, ri)
-        key_seqs = key_seqs.astype(np.uint32)
+        counter = self._next_counter(sample_count)
+        args = (self.keys, self.offsets, self.phrase_ids, self.keep_probs, \
+                gram_n, np.uint32(pad_key), self.rng_seed, counter, \
+                (key_seqs, phrase_keys))
+        _run_chunked(fast_seq_sample, sample_count, self.thread_count, args)
         phrase_keys = np.minimum(self.max_phrase_key, phrase_keys).astype(np.uint32)
         return [key_seqs, phrase_keys]
 
+# Max draws for each negative, when rejecting negatives equal to the positive
+MAX_NEG_TRIES = 10
+
+@numba.jit("void(u4[:], u4[:], b1, u8, u8, i8, i8, u4[:,:])", nopython=True, \
+        nogil=True)
+def fast_neg_sample(neg_table, pos_keys, reject_pos, seed, counter, i_start, \
+        i_stop, pn_keys):
+    table_size = np.uint64(neg_table.size)
+    key_count = pn_keys.shape[1]
+    for j in range(i_start, i_stop):
+        s_seed = _rand_u64(seed, counter + np.uint64(j))
+        s_ctr = np.uint64(0)
+        pos_key = pos_keys[j]
+        pn_keys[j,0] = pos_key
+        for k in range(1, key_count):
+            neg_key = neg_table[_rand_u64(s_seed, s_ctr) % table_size]
+            s_ctr += np.uint64(1)
+            tries = 1
+            while reject_pos and (neg_key == pos_key) and (tries < MAX_NEG_TRIES):
+                neg_key = neg_table[_rand_u64(s_seed, s_ctr) % table_size]
+                s_ctr += np.uint64(1)
+                tries += 1
+            pn_keys[j,k] = neg_key
+    return
+
 class NegSampler:
     """
     This samples "contrastive words" for training via negative sampling.
+
+    sample_pn() writes the positive keys and their negatives straight into a
+    (batch, 1+neg_count) key matrix, as used by NSLayer/W2VLayer. That matrix
+    is reused between calls with the same shape, so it's only valid until the
+    next call. When reject_pos is True, negatives that match the positive key
+    in their row are redrawn (up to MAX_NEG_TRIES times).
     """
-    def __init__(self, neg_table=None, neg_count=10):
+    def __init__(self, neg_table=None, neg_count=10, reject_pos=False, \
+                 seed=None):
         # phrase_list contains the phrases to sample from 
-        self.neg_table = neg_table
+        self.neg_table = neg_table.astype(np.uint32, copy=False)
         self.neg_table_size = self.neg_table.size
         self.neg_count = neg_count
+        self.reject_pos = reject_pos
+        self.pn_keys = np.zeros((0, 0), dtype=np.uint32)
+        # state for the counter-based RNG, which advances with each sample
+        if seed is None:
+            seed = npr.randint(0, high=2**31)
+        self.rng_seed = np.uint64(seed)
+        self.rng_counter = np.uint64(0)
         return
 
     def sample(self, sample_count, neg_count=0):
         if (neg_count == 0):
             neg_count = self.neg_count
-        neg_keys = np.zeros((sample_count, neg_count), dtype=np.uint32)
-        neg_idx = npr.randint(0, high=self.neg_table_size, size=neg_keys.shape)
-        for i in range(neg_keys.shape[1]):
-            neg_keys[:,i] = self.neg_table[neg_idx[:,i]]
-        neg_keys = neg_keys.astype(np.uint32)
+        neg_idx = npr.randint(0, high=self.neg_table_size, \
+                size=(sample_count, neg_count))
+        neg_keys = self.neg_table.take(neg_idx)
         return neg_keys
 
+    def sample_pn(self, pos_keys, neg_count=0):
+        """
+        Get a matrix with pos_keys in column 0, followed by neg_count columns
+        of negative samples.
+        """
+        if (neg_count == 0):
+            neg_count = self.neg_count
+        pos_keys = np.asarray(pos_keys, dtype=np.uint32)
+        pn_shape = (pos_keys.size, neg_count + 1)
+        if not (self.pn_keys.shape == pn_shape):
+            self.pn_keys = np.zeros(pn_shape, dtype=np.uint32)
+        counter = self.rng_counter
+        self.rng_counter = counter + np.uint64(pos_keys.size)
+        fast_neg_sample(self.neg_table, pos_keys, self.reject_pos, \
+                self.rng_seed, counter, 0, pos_keys.size, self.pn_keys)
+        return self.pn_keys
+
 
 if __name__=="__main__":
     sentences = SentenceFileIterator('./training_text')
@@ -1,14 +1,7 @@
 from __future__ import absolute_import
 
-# try to compile and use the faster cython version
 import os
-from numpy import get_include
-import pyximport
-models_dir = os.path.dirname(__file__) or os.getcwd()
-pyximport.install(setup_args={"include_dirs": [models_dir, get_include()]})
-from CythonFuncsPyx import w2v_ff_bp_pyx, ag_update_2d_pyx, ag_update_1d_pyx, \
-                           lut_bp_pyx, nsl_ff_bp_pyx, acl_ff_bp_pyx, DO_INIT
-
+import time
 import numpy as np
 import numpy.random as npr
 import threading
@@ -48,17 +41,470 @@ def make_multithread(inner_func, numthreads):
         func = func_mt
     return func_mt
 
-##############################
-# NUMBA FUNCTION DEFINITIONS #
-##############################
+##############################################
+# ADAGRAD UPDATES WITH LOW PRECISION MOMENTS #
+##############################################
+
+# these match the constants used by the Cython updates
+ADA_EPS = 0.001
+ADA_RHO = 0.98
+
+def ag_update_half(row_idx, W, dW, mW, alpha):
+    """
+    Same update as ag_update_2d/1d, for moments mW stored as float16. The
+    touched rows of mW are widened to float32 for the update, and then
+    rounded back. row_idx must not contain repeated keys.
+    """
+    dW_r = dW[row_idx]
+    mW_r = (ADA_RHO * mW[row_idx].astype(np.float32)) + \
+            ((1.0 - ADA_RHO) * (dW_r * dW_r))
+    W[row_idx] -= alpha * (dW_r / (np.sqrt(mW_r) + ADA_EPS))
+    mW[row_idx] = mW_r
+    dW[row_idx] = 0.0
+    return
+
+def with_half_moms(ag_update_f32):
+    """Wrap a float32 adagrad update kernel to also take float16 moments."""
+    def ag_update(row_idx, W, dW, mW, alpha):
+        if (mW.dtype == np.float16):
+            ag_update_half(row_idx, W, dW, mW, alpha)
+        else:
+            ag_update_f32(row_idx, W, dW, mW, alpha)
+        return
+    return ag_update
+
+###########################
+# KERNEL BACKEND REGISTRY #
+################################################################################
+# NOTE: Each backend provides the same set of kernels, with the same call      #
+#       signatures: 'cython' uses the compiled CythonFuncsPyx module (built by #
+#       setup.py), and 'numba' uses the matching kernels in NumbaFuncs.py.     #
+#       Backend modules are only imported when first used.                     #
+#                                                                              #
+#       get_kernels(backend) gives a dict of multithreaded kernels, which the  #
+#       layers in NLMLayers take at construction. The default backend is set   #
+#       by the NLP_KERNEL_BACKEND environment variable, or is the first one of #
+#       cython/numba that's available. The 'auto' backend benchmarks all the   #
+#       available backends the first time each kernel is called for a given    #
+#       problem size, and uses the fastest one from then on.                   #
+################################################################################
+
+KERNEL_NAMES = ['w2v_ff_bp', 'cbow_ff_bp', 'w2v_loss', 'cbow_loss', \
+                'nsl_ff_bp', 'acl_ff_bp', 'lut_bp', 'cm_ff', 'cm_bp', \
+                'noise_ff', 'noise_bp', 'ag_update_2d', 'ag_update_1d']
+# kernels that aren't worth spreading over several threads
+KERNEL_THREADS = {'ag_update_1d': 1}
+
+def _load_cython():
+    import CythonFuncsPyx as cy_funcs
+    return dict((name, getattr(cy_funcs, name + '_pyx')) \
+                for name in KERNEL_NAMES)
+
+def _load_numba():
+    import NumbaFuncs as nb_funcs
+    return dict((name, getattr(nb_funcs, name + '_nb')) \
+                for name in KERNEL_NAMES)
+
+BACKEND_LOADERS = {'cython': _load_cython, 'numba': _load_numba}
+BACKEND_ORDER = ['cython', 'numba']
+RAW_KERNELS = {}  # single-threaded kernels, for each loaded backend
+MT_KERNELS = {}   # multithreaded kernels, for each loaded backend
+KERNEL_SETS = {}  # kernels handed out by get_kernels(), for each backend
+TUNED = {}        # backend picked by autotune_kernel(), for each problem
+
+def raw_kernels(backend):
+    """Get the single-threaded kernels for a backend, loading it if needed."""
+    if not (backend in RAW_KERNELS):
+        RAW_KERNELS[backend] = BACKEND_LOADERS[backend]()
+    return RAW_KERNELS[backend]
+
+def available_backends():
+    """Get the list of backends that can be loaded."""
+    backends = []
+    for backend in BACKEND_ORDER:
+        try:
+            raw_kernels(backend)
+            backends.append(backend)
+        except ImportError:
+            pass
+    return backends
+
+def default_backend():
+    """Get the backend to use when a layer doesn't ask for one."""
+    backend = os.environ.get('NLP_KERNEL_BACKEND', '')
+    if backend:
+        assert((backend == 'auto') or (backend in BACKEND_LOADERS))
+        return backend
+    for backend in BACKEND_ORDER:
+        try:
+            raw_kernels(backend)
+            return backend
+        except ImportError:
+            if backend == 'cython':
+                print("CythonFuncs: compiled kernels not found, trying " \
+                      "Numba kernels (run \"python setup.py build_ext " \
+                      "--inplace\" to build them)")
+    raise ImportError("no kernel backend is available")
+
+def set_default_backend(backend):
+    """
+    Set the backend used by layers that are created without one. This also
+    rebinds BACKEND, DEFAULT_KERNELS and the module-level kernels.
+    """
+    global DEFAULT_BACKEND
+    assert((backend == 'auto') or (backend in BACKEND_LOADERS))
+    get_kernels(backend) # fail here, before changing anything
+    DEFAULT_BACKEND = backend
+    _bind_default_kernels()
+    return
+
+def set_thread_num(thread_num):
+    """
+    Set how many threads the kernels split their work over. This only affects
+    kernels fetched from get_kernels() afterwards (i.e. layers created after
+    the call, and the module-level kernels), and it drops all autotuning
+    results.
+    """
+    global THREAD_NUM
+    THREAD_NUM = thread_num
+    MT_KERNELS.clear()
+    KERNEL_SETS.clear()
+    TUNED.clear()
+    _bind_default_kernels()
+    return
+
+def _mt_kernels(backend):
+    """Get the multithreaded (but otherwise raw) kernels for a backend."""
+    if not (backend in MT_KERNELS):
+        raw = raw_kernels(backend)
+        MT_KERNELS[backend] = dict((name, make_multithread(raw[name], \
+                KERNEL_THREADS.get(name, THREAD_NUM))) for name in KERNEL_NAMES)
+    return MT_KERNELS[backend]
+
+class AutoKernel:
+    """
+    Kernel that runs on whichever backend autotune_kernel() finds fastest,
+    for the size of the problem it's called with.
+    """
+    def __init__(self, name):
+        self.name = name
+        return
+
+    def __call__(self, *args):
+        size_key = KERNEL_SPECS[self.name][1](*args)
+        backend = autotune_kernel(self.name, *size_key)
+        return _mt_kernels(backend)[self.name](*args)
+
+def get_kernels(backend=None):
+    """
+    Get a dict of multithreaded kernels from the given backend ('cython',
+    'numba' or 'auto'), keyed by kernel name. If backend is None, use the
+    default_backend().
+    """
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if not (backend in KERNEL_SETS):
+        if backend == 'auto':
+            kernels = dict((name, AutoKernel(name)) for name in KERNEL_NAMES)
+        else:
+            kernels = dict(_mt_kernels(backend))
+        # hierarchical softmax uses the negative sampling kernel
+        kernels['hsm_ff_bp'] = kernels['nsl_ff_bp']
+        # float16 moments are updated by numpy, for all backends
+        kernels['ag_update_2d'] = with_half_moms(kernels['ag_update_2d'])
+        kernels['ag_update_1d'] = with_half_moms(kernels['ag_update_1d'])
+        KERNEL_SETS[backend] = kernels
+    return KERNEL_SETS[backend]
+
+#########################################
+# TEST PROBLEMS FOR TUNING AND CHECKING #
+#########################################
+
+def _f32(rng, *shape):
+    return (0.1 * rng.randn(*shape)).astype(np.float32)
+
+def _u32(rng, high, *shape):
+    return rng.randint(0, high, size=shape).astype(np.uint32)
+
+def _pn_sign(shape):
+    pn_sign = -np.ones(shape, dtype=np.float32)
+    pn_sign[:,0] = 1.0
+    return pn_sign
+
+def _w2v_args(rng, batch_size, vec_dim, pn_size, do_grad=1):
+    kc = 4 * batch_size + 16
+    return (_u32(rng, kc, batch_size), _u32(rng, kc, batch_size, pn_size), \
+            _pn_sign((batch_size, pn_size)), _f32(rng, kc, vec_dim), \
+            _f32(rng, kc, vec_dim), _f32(rng, kc), \
+            np.zeros((kc, vec_dim), dtype=np.float32), \
+            np.zeros((kc, vec_dim), dtype=np.float32), \
+            np.zeros((kc,), dtype=np.float32), \
+            np.zeros((1,), dtype=np.float32), do_grad)
+
+def _cbow_args(rng, batch_size, vec_dim, pn_size, do_grad=1):
+    kc = 4 * batch_size + 16
+    ctx_size = 8
+    return (_u32(rng, kc, batch_size, ctx_size), \
+            _u32(rng, ctx_size+1, batch_size), \
+            _u32(rng, kc, batch_size, pn_size), \
+            _pn_sign((batch_size, pn_size)), _f32(rng, kc, vec_dim), \
+            _f32(rng, kc, vec_dim), _f32(rng, kc), \
+            np.zeros((batch_size, vec_dim), dtype=np.float32), \
+            np.zeros((batch_size, vec_dim), dtype=np.float32), \
+            np.zeros((kc, vec_dim), dtype=np.float32), \
+            np.zeros((kc, vec_dim), dtype=np.float32), \
+            np.zeros((kc,), dtype=np.float32), \
+            np.zeros((batch_size,), dtype=np.float32), do_grad)
+
+def _w2v_loss_args(rng, batch_size, vec_dim, pn_size):
+    kc = 4 * batch_size + 16
+    return (_u32(rng, kc, batch_size), _u32(rng, kc, batch_size, pn_size), \
+            _pn_sign((batch_size, pn_size)), _f32(rng, kc, vec_dim), \
+            _f32(rng, kc, vec_dim), _f32(rng, kc), \
+            np.zeros((batch_size,), dtype=np.float32))
+
+def _cbow_loss_args(rng, batch_size, vec_dim, pn_size):
+    kc = 4 * batch_size + 16
+    ctx_size = 8
+    return (_u32(rng, kc, batch_size, ctx_size), \
+            _u32(rng, ctx_size+1, batch_size), \
+            _u32(rng, kc, batch_size, pn_size), \
+            _pn_sign((batch_size, pn_size)), _f32(rng, kc, vec_dim), \
+            _f32(rng, kc, vec_dim), _f32(rng, kc), \
+            np.zeros((batch_size, vec_dim), dtype=np.float32), \
+            np.zeros((batch_size,), dtype=np.float32))
+
+def _nsl_args(rng, batch_size, vec_dim, pn_size, do_grad=1):
+    kc = 4 * batch_size + 16
+    return (_u32(rng, kc, batch_size, pn_size), \
+            _pn_sign((batch_size, pn_size)), _f32(rng, batch_size, vec_dim), \
+            _f32(rng, kc, vec_dim), _f32(rng, kc), \
+            np.zeros((batch_size, vec_dim), dtype=np.float32), \
+            np.zeros((kc, vec_dim), dtype=np.float32), \
+            np.zeros((kc,), dtype=np.float32), \
+            np.zeros((batch_size, pn_size), dtype=np.float32), do_grad)
+
+def _lut_args(rng, batch_size, vec_dim, extra):
+    kc = 4 * batch_size + 16
+    return (_u32(rng, kc, batch_size), _f32(rng, batch_size, vec_dim), \
+            np.zeros((kc, vec_dim), dtype=np.float32))
+
+def _ag_2d_args(rng, batch_size, vec_dim, extra):
+    kc = 4 * batch_size + 16
+    rows = rng.permutation(kc)[:batch_size].astype(np.uint32)
+    return (rows, _f32(rng, kc, vec_dim), _f32(rng, kc, vec_dim), \
+            np.abs(_f32(rng, kc, vec_dim)), 0.01)
+
+def _ag_1d_args(rng, batch_size, vec_dim, extra):
+    kc = 4 * batch_size + 16
+    rows = rng.permutation(kc)[:batch_size].astype(np.uint32)
+    return (rows, _f32(rng, kc), _f32(rng, kc), np.abs(_f32(rng, kc)), 0.01)
+
+# x_extra makes X wider than Wm, as for PVModel's CMLayer (which doesn't
+# rescale, so only sig_mode 0/2 and do_Wm=0 make sense with x_extra > 0)
+def _cm_ff_args(rng, batch_size, vec_dim, bias_dim, use_bias=1, sig_mode=1, \
+                x_extra=0):
+    kc = 4 * batch_size + 16
+    x_dim = vec_dim + x_extra
+    return (_u32(rng, kc, batch_size), _f32(rng, batch_size, x_dim), \
+            _f32(rng, kc, vec_dim), _f32(rng, kc, bias_dim), \
+            np.zeros((batch_size, x_dim), dtype=np.float32), \
+            np.zeros((batch_size, x_dim + bias_dim), dtype=np.float32), \
+            use_bias, sig_mode)
+
+def _cm_bp_args(rng, batch_size, vec_dim, bias_dim, do_Wm=1, x_extra=0):
+    kc = 4 * batch_size + 16
+    x_dim = vec_dim + x_extra
+    return (_u32(rng, kc, batch_size), _f32(rng, batch_size, x_dim), \
+            rng.rand(batch_size, x_dim).astype(np.float32), \
+            _f32(rng, batch_size, x_dim + bias_dim), \
+            np.zeros((kc, vec_dim), dtype=np.float32), \
+            np.zeros((kc, bias_dim), dtype=np.float32), \
+            np.zeros((batch_size, x_dim), dtype=np.float32), do_Wm)
+
+def _noise_ff_args(rng, batch_size, vec_dim, extra, do_drop=1, \
+                   drop_rate=0.3, fuzz_c=0.1):
+    return (_f32(rng, batch_size, vec_dim), \
+            np.zeros((batch_size, vec_dim), dtype=np.uint8), \
+            np.zeros((batch_size, vec_dim), dtype=np.float32), \
+            12345, 0, do_drop, drop_rate, (1.0 / (1.0 - drop_rate)), fuzz_c)
+
+def _noise_bp_args(rng, batch_size, vec_dim, extra):
+    return (_f32(rng, batch_size, vec_dim), \
+            (rng.rand(batch_size, vec_dim) > 0.3).astype(np.uint8), \
+            np.zeros((batch_size, vec_dim), dtype=np.float32), (1.0 / 0.7))
+
+def _size_bucket(batch_size):
+    """Round batch_size up to a power of 2, to limit re-tuning."""
+    bucket = 1
+    while bucket < batch_size:
+        bucket = bucket * 2
+    return bucket
+
+# For each kernel: a function for making a test problem of a given size,
+# and a function for getting the (bucketed) size of a problem from the args
+# that the kernel was called with.
+KERNEL_SPECS = {
+    'w2v_ff_bp': (_w2v_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[3].shape[1], a[1].shape[1])),
+    'cbow_ff_bp': (_cbow_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[4].shape[1], a[2].shape[1])),
+    'w2v_loss': (_w2v_loss_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[3].shape[1], a[1].shape[1])),
+    'cbow_loss': (_cbow_loss_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[4].shape[1], a[2].shape[1])),
+    'nsl_ff_bp': (_nsl_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[2].shape[1], a[0].shape[1])),
+    'acl_ff_bp': (_nsl_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[2].shape[1], a[0].shape[1])),
+    'lut_bp': (_lut_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[1].shape[1], 0)),
+    'ag_update_2d': (_ag_2d_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[1].shape[1], 0)),
+    'ag_update_1d': (_ag_1d_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), 1, 0)),
+    'cm_ff': (_cm_ff_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[2].shape[1], a[3].shape[1])),
+    'cm_bp': (_cm_bp_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[4].shape[1], a[5].shape[1])),
+    'noise_ff': (_noise_ff_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[0].shape[1], 0)),
+    'noise_bp': (_noise_bp_args, lambda *a: \
+            (_size_bucket(a[0].shape[0]), a[0].shape[1], 0)),
+}
+
+def _copy_args(args):
+    return [(a.copy() if isinstance(a, np.ndarray) else a) for a in args]
+
+def autotune_kernel(name, batch_size, vec_dim, extra, trials=5):
+    """
+    Get the fastest available backend for the given kernel, for problems of
+    the given size. Results are cached, so each size is only timed once.
+    """
+    tune_key = (name, batch_size, vec_dim, extra)
+    if not (tune_key in TUNED):
+        args = KERNEL_SPECS[name][0](npr.RandomState(0), batch_size, \
+                                     vec_dim, extra)
+        best_backend = None
+        best_time = None
+        for backend in available_backends():
+            func = _mt_kernels(backend)[name]
+            func(*_copy_args(args)) # warm up, e.g. for jit compilation
+            t_min = None
+            for i in range(trials):
+                run_args = _copy_args(args)
+                t1 = time.time()
+                func(*run_args)
+                t = time.time() - t1
+                t_min = t if (t_min is None) else min(t_min, t)
+            if (best_time is None) or (t_min < best_time):
+                best_backend = backend
+                best_time = t_min
+        TUNED[tune_key] = best_backend
+    return TUNED[tune_key]
+
+# Problem sizes (batch_size, vec_dim, extra) used by check_backends(). The
+# odd sizes are there to catch kernels that only work for "nice" shapes.
+CHECK_SHAPES = [(64, 32, 6), (1, 7, 1), (131, 53, 11)]
+# For each kernel, the settings to check besides the defaults of its test
+# problem. These are the code paths the layers take outside of plain training.
+CHECK_OPTIONS = {
+    'w2v_ff_bp': [{'do_grad': 0}],
+    'cbow_ff_bp': [{'do_grad': 0}],
+    'nsl_ff_bp': [{'do_grad': 0}],
+    'acl_ff_bp': [{'do_grad': 0}],
+    'cm_ff': [{'sig_mode': 0}, {'sig_mode': 2}, {'use_bias': 0}, \
+              {'sig_mode': 0, 'x_extra': 9}, {'sig_mode': 2, 'x_extra': 9}],
+    'cm_bp': [{'do_Wm': 0}, {'do_Wm': 0, 'x_extra': 9}],
+    'noise_ff': [{'drop_rate': 0.0}, {'do_drop': 0}, {'fuzz_c': 0.0}],
+}
+
+def check_cases():
+    """
+    Get the list of test cases checked by check_backends(), as tuples
+    (name, batch_size, vec_dim, extra, options).
+    """
+    cases = []
+    for name in KERNEL_NAMES:
+        for options in ([{}] + CHECK_OPTIONS.get(name, [])):
+            for (batch_size, vec_dim, extra) in CHECK_SHAPES:
+                cases.append((name, batch_size, vec_dim, extra, options))
+    return cases
+
+def check_kernel(name, batch_size, vec_dim, extra, options=None, \
+                 backends=None, tol=1e-4):
+    """
+    Check that the given backends compute the same thing for one kernel. The
+    kernel is run single-threaded, on identical copies of a random test
+    problem made with the given options, and its outputs are compared with
+    the outputs of the first backend. Returns the largest (relative)
+    difference, and fails if it isn't below tol.
+    """
+    if options is None:
+        options = {}
+    if backends is None:
+        backends = available_backends()
+    assert (len(backends) >= 2), "can't compare backends, only {0:s} " \
+            "could be loaded".format(", ".join(backends) or "none")
+    args = KERNEL_SPECS[name][0](npr.RandomState(1), batch_size, vec_dim, \
+                                 extra, **options)
+    sp_idx = np.arange(len(args[0])).astype(np.uint32)
+    outputs = []
+    for backend in backends:
+        run_args = _copy_args(args)
+        raw_kernels(backend)[name](sp_idx, *run_args)
+        outputs.append([a for a in run_args if isinstance(a, np.ndarray)])
+    max_diff = 0.0
+    for out in outputs[1:]:
+        for (A_ref, A) in zip(outputs[0], out):
+            if (A.size > 0):
+                A_ref = A_ref.astype(np.float64)
+                diff = np.abs(A.astype(np.float64) - A_ref) / \
+                        (1.0 + np.abs(A_ref))
+                max_diff = max(max_diff, np.max(diff))
+    assert (max_diff < tol), "backends disagree on {0:s} {1}, options {2}: " \
+            "max diff {3:.2e}".format(name, (batch_size, vec_dim, extra), \
+            options, max_diff)
+    return max_diff
+
+def check_backends(tol=1e-4):
+    """
+    Check that all available backends compute the same thing, for every
+    case in check_cases(). This fails if fewer than two backends can be
+    loaded, since then there's nothing to compare. Returns a dict with the
+    largest (relative) difference for each kernel.
+    """
+    backends = available_backends()
+    max_diffs = {}
+    for (name, batch_size, vec_dim, extra, options) in check_cases():
+        max_diff = check_kernel(name, batch_size, vec_dim, extra, options, \
+                                backends=backends, tol=tol)
+        max_diffs[name] = max(max_diffs.get(name, 0.0), max_diff)
+    for name in KERNEL_NAMES:
+        print("{0:s}: max diff {1:.2e} over {2:s}".format(name, \
+                max_diffs[name], ", ".join(backends)))
+    return max_diffs
+
+###################
+# DEFAULT KERNELS #
+###################
+
+def _bind_default_kernels():
+    """
+    Bind BACKEND, DEFAULT_KERNELS and the module-level kernels (w2v_ff_bp,
+    cm_ff, etc.) to the current default backend and thread count.
+    """
+    global BACKEND, DEFAULT_KERNELS
+    BACKEND = DEFAULT_BACKEND
+    DEFAULT_KERNELS = get_kernels(DEFAULT_BACKEND)
+    globals().update(DEFAULT_KERNELS)
+    return
 
-w2v_ff_bp = make_multithread(w2v_ff_bp_pyx, THREAD_NUM)
-hsm_ff_bp = make_multithread(nsl_ff_bp_pyx, THREAD_NUM)
-nsl_ff_bp = make_multithread(nsl_ff_bp_pyx, THREAD_NUM)
-lut_bp = make_multithread(lut_bp_pyx, THREAD_NUM)
+DEFAULT_BACKEND = default_backend()
+_bind_default_kernels()
 
-ag_update_2d = make_multithread(ag_update_2d_pyx, THREAD_NUM)
-ag_update_1d = make_multithread(ag_update_1d_pyx, 1)
+if __name__ == "__main__":
+    check_backends()
 
 
 ##############
@@ -15,7 +15,7 @@ import cython
 import numpy as np
 cimport numpy as np
 
-from libc.math cimport exp, log, sqrt
+from libc.math cimport exp, log, sqrt, cos
 from libc.string cimport memset
 
 cdef extern from "voidptr.h":
@@ -26,6 +26,8 @@ from scipy.linalg import blas
 ctypedef np.float32_t REAL_t
 ctypedef np.uint32_t UI32_t
 ctypedef np.int32_t I32_t
+ctypedef np.uint8_t UI8_t
+ctypedef unsigned long long UI64_t
 
 DEF MAX_SENTENCE_LEN = 10000
 
@@ -37,12 +39,22 @@ ctypedef double (*snrm2_ptr) (const int *N, const float *X, const int *incX) nog
 ctypedef void (*sscal_ptr) (const int *N, const float *alpha, const float *X, const int *incX) nogil
 
 
+ctypedef REAL_t (*our_dot_ptr) (const int *N, const float *X, const int *incX, const float *Y, const int *incY) nogil
+
 ctypedef void (*cy_w2v_ff_bp_ptr) (
     const int sp_size, const UI32_t *sp_idx, const UI32_t *anc_keys,
     const int pn_size, const UI32_t *pn_keys, REAL_t *pn_sign,
     REAL_t *Wa, REAL_t *Wc, REAL_t *b, REAL_t *dWa, REAL_t *dWc, REAL_t *db,
     REAL_t *L, const int do_grad, const int vec_dim) nogil
 
+ctypedef void (*cy_cbow_ff_bp_ptr) (
+    const int sp_size, const UI32_t *sp_idx, const int ctx_size,
+    const UI32_t *ctx_keys, const UI32_t *ctx_lens,
+    const int pn_size, const UI32_t *pn_keys, REAL_t *pn_sign,
+    REAL_t *Wa, REAL_t *Wc, REAL_t *b, REAL_t *H, REAL_t *dH,
+    REAL_t *dWa, REAL_t *dWc, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil
+
 ctypedef void (*cy_nsl_ff_bp_ptr) (
     const int sp_size, const UI32_t *sp_idx,
     const int pn_size, const UI32_t *pn_keys, REAL_t *pn_sign,
@@ -64,7 +76,9 @@ cdef dsdot_ptr dsdot=<dsdot_ptr>PyCObject_AsVoidPtr(blas.sdot._cpointer)  # doub
 cdef snrm2_ptr snrm2=<snrm2_ptr>PyCObject_AsVoidPtr(blas.snrm2._cpointer)  # sqrt(x^2)
 cdef sscal_ptr sscal=<sscal_ptr>PyCObject_AsVoidPtr(blas.sscal._cpointer) # x = alpha * x
 
+cdef our_dot_ptr our_dot
 cdef cy_w2v_ff_bp_ptr cy_w2v_ff_bp
+cdef cy_cbow_ff_bp_ptr cy_cbow_ff_bp
 cdef cy_nsl_ff_bp_ptr cy_nsl_ff_bp
 cdef cy_acl_ff_bp_ptr cy_acl_ff_bp
 
@@ -74,6 +88,12 @@ cdef UI32_t MAX_HSM_KEY = <UI32_t>12345678
 cdef REAL_t ONEF = <REAL_t>1.0
 cdef REAL_t ADA_EPS = <REAL_t>0.001
 cdef REAL_t ADA_RHO = <REAL_t>0.98
+# constants for the SplitMix64 counter-based RNG (same as in CorpusUtils)
+cdef UI64_t RNG_GAMMA = <UI64_t>0x9E3779B97F4A7C15
+cdef UI64_t RNG_MIX_1 = <UI64_t>0xBF58476D1CE4E5B9
+cdef UI64_t RNG_MIX_2 = <UI64_t>0x94D049BB133111EB
+cdef double RNG_UNIT_F = 1.0 / 16777216.0
+cdef double TWO_PI = 6.283185307179586
 
 #############
 # W2V_FF_BP #
@@ -170,6 +190,258 @@ def w2v_ff_bp_pyx(sp_idx_p, anc_keys_p, pn_keys_p, pn_sign_p, Wa_p, Wc_p, b_p,
     return
 
 
+##############
+# CBOW_FF_BP #
+################################################################################
+# NOTE: This is the CBOW version of w2v_ff_bp. Each sample is a window of      #
+#       context words (the first ctx_lens[i] keys in row i of ctx_keys) and a  #
+#       row of +/- targets in pn_keys/pn_sign. The context words' rows of Wa   #
+#       are averaged into H[i], H[i] is used for one pass over the targets in  #
+#       Wc/b, and the gradient on H[i] (in dH[i]) is scattered back to each    #
+#       context word's row of dWa. Target keys >= MAX_HSM_KEY are skipped, so  #
+#       the targets can also be (padded) HSM codes and signs. The loss for     #
+#       each sample goes in L[i], so that threads don't share an accumulator.  #
+################################################################################
+
+cdef void cy_cbow_ff_bp0(
+    const int sp_size, const UI32_t *sp_idx, const int ctx_size,
+    const UI32_t *ctx_keys, const UI32_t *ctx_lens,
+    const int pn_size, const UI32_t *pn_keys, REAL_t *pn_sign,
+    REAL_t *Wa, REAL_t *Wc, REAL_t *b, REAL_t *H, REAL_t *dH,
+    REAL_t *dWa, REAL_t *dWc, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row1, row2
+    cdef REAL_t y, exp_pns_y, g, ctx_scale
+    cdef UI32_t a_key, c_key
+    cdef int sp_i, i, j, k, ctx_len
+
+    # update loop
+    for sp_i in range(sp_size):
+        i = <int>sp_idx[sp_i]
+        ctx_len = <int>ctx_lens[i]
+        L[i] = 0.0
+        if (ctx_len == 0):
+            continue
+        row1 = i * vec_dim # get the starting index of this sample's row in H
+        # average the context words' rows of Wa into H[i]
+        ctx_scale = ONEF / <REAL_t>ctx_len
+        memset(&H[row1], 0, vec_dim * cython.sizeof(REAL_t))
+        for k in range(ctx_len):
+            a_key = ctx_keys[i*ctx_size + k]
+            saxpy(&vec_dim, &ctx_scale, &Wa[a_key*vec_dim], &ONE, &H[row1], &ONE)
+        if (do_grad == 1):
+            memset(&dH[row1], 0, vec_dim * cython.sizeof(REAL_t))
+        # run the +/- predictions (NS or HSM codes) off of the average
+        for j in range(pn_size):
+            c_key = pn_keys[i*pn_size + j]
+            if (c_key < MAX_HSM_KEY):
+                row2 = c_key * vec_dim # get the starting index of target row (in Wc)
+                neg_label = -1.0 * pn_sign[i*pn_size + j]
+                # compute prediction y as np.dot(H[i], Wc[c_key].T) + b[c_key]
+                y = <REAL_t>dsdot(&vec_dim, &H[row1], &ONE, &Wc[row2], &ONE) + b[c_key]
+                exp_pns_y = <REAL_t>exp(neg_label * y)
+                L[i] = L[i] + log(1.0 + exp_pns_y) # add the loss on this target
+                if (do_grad == 1):
+                    # Compute gradient and update parameter gradient accumulators
+                    g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+                    saxpy(&vec_dim, &g, &H[row1], &ONE, &dWc[row2], &ONE)
+                    saxpy(&vec_dim, &g, &Wc[row2], &ONE, &dH[row1], &ONE)
+                    db[c_key] = db[c_key] + g
+        if (do_grad == 1):
+            # scatter the gradient on the average back to the context words
+            for k in range(ctx_len):
+                a_key = ctx_keys[i*ctx_size + k]
+                saxpy(&vec_dim, &ctx_scale, &dH[row1], &ONE, &dWa[a_key*vec_dim], &ONE)
+    return
+
+cdef void cy_cbow_ff_bp1(
+    const int sp_size, const UI32_t *sp_idx, const int ctx_size,
+    const UI32_t *ctx_keys, const UI32_t *ctx_lens,
+    const int pn_size, const UI32_t *pn_keys, REAL_t *pn_sign,
+    REAL_t *Wa, REAL_t *Wc, REAL_t *b, REAL_t *H, REAL_t *dH,
+    REAL_t *dWa, REAL_t *dWc, REAL_t *db,
+    REAL_t *L, const int do_grad, const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row1, row2
+    cdef REAL_t y, exp_pns_y, g, ctx_scale
+    cdef UI32_t a_key, c_key
+    cdef int sp_i, i, j, k, ctx_len
+
+    # update loop
+    for sp_i in range(sp_size):
+        i = <int>sp_idx[sp_i]
+        ctx_len = <int>ctx_lens[i]
+        L[i] = 0.0
+        if (ctx_len == 0):
+            continue
+        row1 = i * vec_dim # get the starting index of this sample's row in H
+        # average the context words' rows of Wa into H[i]
+        ctx_scale = ONEF / <REAL_t>ctx_len
+        memset(&H[row1], 0, vec_dim * cython.sizeof(REAL_t))
+        for k in range(ctx_len):
+            a_key = ctx_keys[i*ctx_size + k]
+            saxpy(&vec_dim, &ctx_scale, &Wa[a_key*vec_dim], &ONE, &H[row1], &ONE)
+        if (do_grad == 1):
+            memset(&dH[row1], 0, vec_dim * cython.sizeof(REAL_t))
+        # run the +/- predictions (NS or HSM codes) off of the average
+        for j in range(pn_size):
+            c_key = pn_keys[i*pn_size + j]
+            if (c_key < MAX_HSM_KEY):
+                row2 = c_key * vec_dim # get the starting index of target row (in Wc)
+                neg_label = -1.0 * pn_sign[i*pn_size + j]
+                # compute prediction y as np.dot(H[i], Wc[c_key].T) + b[c_key]
+                y = <REAL_t>sdot(&vec_dim, &H[row1], &ONE, &Wc[row2], &ONE) + b[c_key]
+                exp_pns_y = <REAL_t>exp(neg_label * y)
+                L[i] = L[i] + log(1.0 + exp_pns_y) # add the loss on this target
+                if (do_grad == 1):
+                    # Compute gradient and update parameter gradient accumulators
+                    g = neg_label * (exp_pns_y / (1.0 + exp_pns_y))
+                    saxpy(&vec_dim, &g, &H[row1], &ONE, &dWc[row2], &ONE)
+                    saxpy(&vec_dim, &g, &Wc[row2], &ONE, &dH[row1], &ONE)
+                    db[c_key] = db[c_key] + g
+        if (do_grad == 1):
+            # scatter the gradient on the average back to the context words
+            for k in range(ctx_len):
+                a_key = ctx_keys[i*ctx_size + k]
+                saxpy(&vec_dim, &ctx_scale, &dH[row1], &ONE, &dWa[a_key*vec_dim], &ONE)
+    return
+
+def cbow_ff_bp_pyx(sp_idx_p, ctx_keys_p, ctx_lens_p, pn_keys_p, pn_sign_p,
+                   Wa_p, Wc_p, b_p, H_p, dH_p, dWa_p, dWc_p, db_p, L_p,
+                   do_grad_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int ctx_size = <int>ctx_keys_p.shape[1]
+    cdef int pn_size = <int>pn_keys_p.shape[1]
+    cdef int do_grad = <int>do_grad_p
+    cdef int vec_dim = <int>Wa_p.shape[1]
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef UI32_t *ctx_keys = <UI32_t *>(np.PyArray_DATA(ctx_keys_p))
+    cdef UI32_t *ctx_lens = <UI32_t *>(np.PyArray_DATA(ctx_lens_p))
+    cdef UI32_t *pn_keys = <UI32_t *>(np.PyArray_DATA(pn_keys_p))
+    cdef REAL_t *pn_sign = <REAL_t *>(np.PyArray_DATA(pn_sign_p))
+    cdef REAL_t *Wa = <REAL_t *>(np.PyArray_DATA(Wa_p))
+    cdef REAL_t *Wc = <REAL_t *>(np.PyArray_DATA(Wc_p))
+    cdef REAL_t *b = <REAL_t *>(np.PyArray_DATA(b_p))
+    cdef REAL_t *H = <REAL_t *>(np.PyArray_DATA(H_p))
+    cdef REAL_t *dH = <REAL_t *>(np.PyArray_DATA(dH_p))
+    cdef REAL_t *dWa = <REAL_t *>(np.PyArray_DATA(dWa_p))
+    cdef REAL_t *dWc = <REAL_t *>(np.PyArray_DATA(dWc_p))
+    cdef REAL_t *db = <REAL_t *>(np.PyArray_DATA(db_p))
+    cdef REAL_t *L = <REAL_t *>(np.PyArray_DATA(L_p))
+
+    with nogil:
+        cy_cbow_ff_bp(sp_size, sp_idx, ctx_size, ctx_keys, ctx_lens, pn_size,
+                      pn_keys, pn_sign, Wa, Wc, b, H, dH, dWa, dWc, db, L,
+                      do_grad, vec_dim)
+    return
+
+
+###########################
+# FORWARD-ONLY W2V LOSSES #
+################################################################################
+# NOTE: These compute the same losses as w2v_ff_bp and cbow_ff_bp, but they    #
+#       don't take any gradient buffers, and they write the loss for sample i  #
+#       into L[i]. They're for evaluating held-out loss over large batches,    #
+#       split across threads. cbow_loss still needs H, as scratch space for    #
+#       the averaged context vectors. our_dot is sdot or dsdot, as picked by   #
+#       init(), cast to single precision.                                      #
+################################################################################
+
+cdef REAL_t our_dot_double(const int *N, const float *X, const int *incX,
+                           const float *Y, const int *incY) nogil:
+    return <REAL_t>dsdot(N, X, incX, Y, incY)
+
+cdef REAL_t our_dot_float(const int *N, const float *X, const int *incX,
+                          const float *Y, const int *incY) nogil:
+    return <REAL_t>sdot(N, X, incX, Y, incY)
+
+cdef void cy_pn_loss(
+    const int i, REAL_t *h, const int pn_size, const UI32_t *pn_keys,
+    REAL_t *pn_sign, REAL_t *Wc, REAL_t *b, REAL_t *L,
+    const int vec_dim) nogil:
+
+    # declarations
+    cdef REAL_t y, neg_label
+    cdef UI32_t c_key
+    cdef int j
+
+    # loss on the +/- targets in row i, for the anchor vector h
+    L[i] = 0.0
+    for j in range(pn_size):
+        c_key = pn_keys[i*pn_size + j]
+        if (c_key < MAX_HSM_KEY):
+            neg_label = -1.0 * pn_sign[i*pn_size + j]
+            y = our_dot(&vec_dim, h, &ONE, &Wc[c_key*vec_dim], &ONE) + b[c_key]
+            L[i] = L[i] + log(1.0 + exp(neg_label * y))
+    return
+
+def w2v_loss_pyx(sp_idx_p, anc_keys_p, pn_keys_p, pn_sign_p, Wa_p, Wc_p, b_p,
+                 L_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int pn_size = <int>pn_keys_p.shape[1]
+    cdef int vec_dim = <int>Wa_p.shape[1]
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef UI32_t *anc_keys = <UI32_t *>(np.PyArray_DATA(anc_keys_p))
+    cdef UI32_t *pn_keys = <UI32_t *>(np.PyArray_DATA(pn_keys_p))
+    cdef REAL_t *pn_sign = <REAL_t *>(np.PyArray_DATA(pn_sign_p))
+    cdef REAL_t *Wa = <REAL_t *>(np.PyArray_DATA(Wa_p))
+    cdef REAL_t *Wc = <REAL_t *>(np.PyArray_DATA(Wc_p))
+    cdef REAL_t *b = <REAL_t *>(np.PyArray_DATA(b_p))
+    cdef REAL_t *L = <REAL_t *>(np.PyArray_DATA(L_p))
+    cdef int sp_i, i
+
+    with nogil:
+        for sp_i in range(sp_size):
+            i = <int>sp_idx[sp_i]
+            cy_pn_loss(i, &Wa[anc_keys[i]*vec_dim], pn_size, pn_keys,
+                       pn_sign, Wc, b, L, vec_dim)
+    return
+
+def cbow_loss_pyx(sp_idx_p, ctx_keys_p, ctx_lens_p, pn_keys_p, pn_sign_p,
+                  Wa_p, Wc_p, b_p, H_p, L_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int ctx_size = <int>ctx_keys_p.shape[1]
+    cdef int pn_size = <int>pn_keys_p.shape[1]
+    cdef int vec_dim = <int>Wa_p.shape[1]
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef UI32_t *ctx_keys = <UI32_t *>(np.PyArray_DATA(ctx_keys_p))
+    cdef UI32_t *ctx_lens = <UI32_t *>(np.PyArray_DATA(ctx_lens_p))
+    cdef UI32_t *pn_keys = <UI32_t *>(np.PyArray_DATA(pn_keys_p))
+    cdef REAL_t *pn_sign = <REAL_t *>(np.PyArray_DATA(pn_sign_p))
+    cdef REAL_t *Wa = <REAL_t *>(np.PyArray_DATA(Wa_p))
+    cdef REAL_t *Wc = <REAL_t *>(np.PyArray_DATA(Wc_p))
+    cdef REAL_t *b = <REAL_t *>(np.PyArray_DATA(b_p))
+    cdef REAL_t *H = <REAL_t *>(np.PyArray_DATA(H_p))
+    cdef REAL_t *L = <REAL_t *>(np.PyArray_DATA(L_p))
+    cdef REAL_t ctx_scale
+    cdef long long row1
+    cdef int sp_i, i, k, ctx_len
+
+    with nogil:
+        for sp_i in range(sp_size):
+            i = <int>sp_idx[sp_i]
+            ctx_len = <int>ctx_lens[i]
+            if (ctx_len == 0):
+                L[i] = 0.0
+                continue
+            # average the context words' rows of Wa into H[i]
+            row1 = i * vec_dim
+            ctx_scale = ONEF / <REAL_t>ctx_len
+            memset(&H[row1], 0, vec_dim * cython.sizeof(REAL_t))
+            for k in range(ctx_len):
+                saxpy(&vec_dim, &ctx_scale, &Wa[ctx_keys[i*ctx_size + k]*vec_dim],
+                      &ONE, &H[row1], &ONE)
+            cy_pn_loss(i, &H[row1], pn_size, pn_keys, pn_sign, Wc, b, L,
+                       vec_dim)
+    return
+
+
 #############
 # NSL_FF_BP #
 ################################################################################
@@ -593,6 +865,268 @@ def lut_bp_pyx(sp_idx_p, row_idx_p, dLdY_p, dW_p):
         cy_lut_bp(sp_size, sp_idx, row_idx, dLdY, dW, vec_dim)
     return
 
+#################
+# CM_FF / CM_BP #
+################################################################################
+# NOTE: These functions implement feedforward and backprop for CMLayer, i.e.   #
+#       for the context modifier layer. For each row i of the minibatch, the   #
+#       forward pass gathers the context rows Wb[C[i]] and Wm[C[i]], and then  #
+#       writes Y[i] = [Wb[C[i]], S[i] * X[i]], where S[i] = sigmoid(Wm[C[i]]). #
+#       The backward pass scatters gradients straight into dWb/dWm, and writes #
+#       the gradient for X into dX.                                            #
+#                                                                              #
+#       Parameters passed to cm_ff_pyx:                                        #
+#         sp_idx_p: Numpy array of uint32 keys into the rows of C_p, X_p, S_p  #
+#                   and Y_p. This is used for multithreading, as above.        #
+#         C_p: Numpy array of uint32 keys into the rows of Wm_p and Wb_p       #
+#         X_p: Numpy matrix of float32 inputs to the layer                     #
+#         Wm_p, Wb_p: Numpy matrices of float32 params for the layer           #
+#         S_p: Numpy matrix of float32, to store the rescaling factors         #
+#         Y_p: Numpy matrix of float32, to store the layer output              #
+#         use_bias_p: int in {0, 1}. if it's 0, the bias part of Y is zeroed   #
+#         sig_mode_p: int in {0, 1, 2}. 0 => no rescaling (S = 1), 1 => S is   #
+#                     the sigmoid of Wm, and 2 => X is blocked (S = 0).        #
+#                                                                              #
+#       Parameters passed to cm_bp_pyx:                                        #
+#         sp_idx_p, C_p, X_p, S_p: same as for cm_ff_pyx                       #
+#         dLdY_p: Numpy matrix of float32 gradients on the layer output        #
+#         dWm_p, dWb_p: np.float32 gradient accumulators for Wm_p/Wb_p         #
+#         dX_p: Numpy matrix of float32, to store gradients on X_p             #
+#         do_Wm_p: int in {0, 1}. if it's 0, dWm_p is left untouched           #
+#                                                                              #
+################################################################################
+
+cdef void cy_cm_ff(
+    const int sp_size, const UI32_t *sp_idx, const UI32_t *C,
+    REAL_t *X, REAL_t *Wm, REAL_t *Wb, REAL_t *S, REAL_t *Y,
+    const int use_bias, const int sig_mode,
+    const int src_dim, const int wm_dim, const int bias_dim) nogil:
+
+    # declarations
+    cdef long long row_x, row_y, row_c, row_b
+    cdef int sp_i, k
+    cdef int out_dim = src_dim + bias_dim
+    cdef UI32_t i, c_key
+    cdef REAL_t s
+
+    # update loop
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        c_key = C[i]
+        row_x = i * src_dim
+        row_y = i * out_dim
+        row_c = c_key * wm_dim
+        row_b = c_key * bias_dim
+        # copy the context-adaptive bias into the front of Y[i]
+        if (use_bias == 1):
+            scopy(&bias_dim, &Wb[row_b], &ONE, &Y[row_y], &ONE)
+        else:
+            for k in range(bias_dim):
+                Y[row_y + k] = 0.0
+        # rescale X[i] into the back of Y[i]
+        for k in range(src_dim):
+            if (sig_mode == 1):
+                s = <REAL_t>(1.0 / (1.0 + exp(-Wm[row_c + k])))
+            elif (sig_mode == 0):
+                s = ONEF
+            else:
+                s = 0.0
+            S[row_x + k] = s
+            Y[row_y + bias_dim + k] = s * X[row_x + k]
+    return
+
+def cm_ff_pyx(sp_idx_p, C_p, X_p, Wm_p, Wb_p, S_p, Y_p, use_bias_p,
+              sig_mode_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int src_dim = <int>X_p.shape[1]
+    cdef int wm_dim = <int>Wm_p.shape[1]
+    cdef int bias_dim = <int>Wb_p.shape[1]
+    cdef int use_bias = <int>use_bias_p
+    cdef int sig_mode = <int>sig_mode_p
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef UI32_t *C = <UI32_t *>(np.PyArray_DATA(C_p))
+    cdef REAL_t *X = <REAL_t *>(np.PyArray_DATA(X_p))
+    cdef REAL_t *Wm = <REAL_t *>(np.PyArray_DATA(Wm_p))
+    cdef REAL_t *Wb = <REAL_t *>(np.PyArray_DATA(Wb_p))
+    cdef REAL_t *S = <REAL_t *>(np.PyArray_DATA(S_p))
+    cdef REAL_t *Y = <REAL_t *>(np.PyArray_DATA(Y_p))
+
+    with nogil:
+        cy_cm_ff(sp_size, sp_idx, C, X, Wm, Wb, S, Y, use_bias, sig_mode,
+                 src_dim, wm_dim, bias_dim)
+    return
+
+cdef void cy_cm_bp(
+    const int sp_size, const UI32_t *sp_idx, const UI32_t *C,
+    REAL_t *X, REAL_t *S, REAL_t *dLdY, REAL_t *dWm, REAL_t *dWb,
+    REAL_t *dX, const int do_Wm, const int src_dim, const int wm_dim,
+    const int bias_dim) nogil:
+
+    # declarations
+    cdef long long row_x, row_y, row_c, row_b
+    cdef int sp_i, k
+    cdef int out_dim = src_dim + bias_dim
+    cdef UI32_t i, c_key
+    cdef REAL_t s, g
+
+    # update loop
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        c_key = C[i]
+        row_x = i * src_dim
+        row_y = i * out_dim
+        row_c = c_key * wm_dim
+        row_b = c_key * bias_dim
+        # scatter the gradient on the bias part of Y[i] into dWb
+        saxpy(&bias_dim, &ONEF, &dLdY[row_y], &ONE, &dWb[row_b], &ONE)
+        # gradients for the rescaled part of Y[i]
+        for k in range(src_dim):
+            s = S[row_x + k]
+            g = dLdY[row_y + bias_dim + k]
+            if (do_Wm == 1):
+                dWm[row_c + k] += (ONEF - s) * X[row_x + k] * g
+            dX[row_x + k] = s * g
+    return
+
+def cm_bp_pyx(sp_idx_p, C_p, X_p, S_p, dLdY_p, dWm_p, dWb_p, dX_p, do_Wm_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int src_dim = <int>X_p.shape[1]
+    cdef int wm_dim = <int>dWm_p.shape[1]
+    cdef int bias_dim = <int>dWb_p.shape[1]
+    cdef int do_Wm = <int>do_Wm_p
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef UI32_t *C = <UI32_t *>(np.PyArray_DATA(C_p))
+    cdef REAL_t *X = <REAL_t *>(np.PyArray_DATA(X_p))
+    cdef REAL_t *S = <REAL_t *>(np.PyArray_DATA(S_p))
+    cdef REAL_t *dLdY = <REAL_t *>(np.PyArray_DATA(dLdY_p))
+    cdef REAL_t *dWm = <REAL_t *>(np.PyArray_DATA(dWm_p))
+    cdef REAL_t *dWb = <REAL_t *>(np.PyArray_DATA(dWb_p))
+    cdef REAL_t *dX = <REAL_t *>(np.PyArray_DATA(dX_p))
+
+    with nogil:
+        cy_cm_bp(sp_size, sp_idx, C, X, S, dLdY, dWm, dWb, dX, do_Wm,
+                 src_dim, wm_dim, bias_dim)
+    return
+
+#####################
+# NOISE_FF/NOISE_BP #
+################################################################################
+# NOTE: These functions implement feedforward and backprop for NoiseLayer. The #
+#       random draws come from a counter-based RNG, with each row of the       #
+#       minibatch hashing its own stream seed from (seed, counter + row). So,  #
+#       the noise for a given (seed, counter) doesn't depend on how the rows   #
+#       are split up among threads.                                            #
+#                                                                              #
+#       The forward pass computes Y = M * keep_scale * (X + fuzz_c * N(0,1)),  #
+#       where M is a uint8 keep/drop mask (all ones if do_drop is 0), and it   #
+#       stores M for use by the backward pass, dX = M * keep_scale * dY.       #
+#                                                                              #
+################################################################################
+
+cdef inline UI64_t rand_u64(UI64_t seed, UI64_t counter) nogil:
+    cdef UI64_t z = seed + (counter * RNG_GAMMA)
+    z = (z ^ (z >> 30)) * RNG_MIX_1
+    z = (z ^ (z >> 27)) * RNG_MIX_2
+    return z ^ (z >> 31)
+
+cdef inline double rand_unit(UI64_t seed, UI64_t counter) nogil:
+    # uniform on [0, 1), with float32 resolution
+    return <double>(rand_u64(seed, counter) >> 40) * RNG_UNIT_F
+
+cdef void cy_noise_ff(
+    const int sp_size, const UI32_t *sp_idx, REAL_t *X, UI8_t *M, REAL_t *Y,
+    const UI64_t seed, const UI64_t counter, const int do_drop,
+    const double drop_rate, const REAL_t keep_scale, const REAL_t fuzz_c,
+    const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row
+    cdef int sp_i, k
+    cdef UI32_t i
+    cdef UI64_t r_seed, r_ctr
+    cdef REAL_t fuzz
+    cdef double u1, u2
+
+    # update loop
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        row = i * vec_dim
+        r_seed = rand_u64(seed, counter + i)
+        for k in range(vec_dim):
+            r_ctr = <UI64_t>(3 * k)
+            if (do_drop == 1):
+                M[row + k] = 1 if (rand_unit(r_seed, r_ctr) >= drop_rate) else 0
+            else:
+                M[row + k] = 1
+            if (M[row + k] == 0):
+                Y[row + k] = 0.0
+            elif (fuzz_c > 0.0):
+                # Box-Muller, with u1 in (0, 1]
+                u1 = 1.0 - rand_unit(r_seed, r_ctr + 1)
+                u2 = rand_unit(r_seed, r_ctr + 2)
+                fuzz = <REAL_t>(sqrt(-2.0 * log(u1)) * cos(TWO_PI * u2))
+                Y[row + k] = keep_scale * (X[row + k] + (fuzz_c * fuzz))
+            else:
+                Y[row + k] = keep_scale * X[row + k]
+    return
+
+def noise_ff_pyx(sp_idx_p, X_p, M_p, Y_p, seed_p, counter_p, do_drop_p,
+                 drop_rate_p, keep_scale_p, fuzz_c_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int vec_dim = <int>X_p.shape[1]
+    cdef UI64_t seed = <UI64_t>seed_p
+    cdef UI64_t counter = <UI64_t>counter_p
+    cdef int do_drop = <int>do_drop_p
+    cdef double drop_rate = <double>drop_rate_p
+    cdef REAL_t keep_scale = <REAL_t>keep_scale_p
+    cdef REAL_t fuzz_c = <REAL_t>fuzz_c_p
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef REAL_t *X = <REAL_t *>(np.PyArray_DATA(X_p))
+    cdef UI8_t *M = <UI8_t *>(np.PyArray_DATA(M_p))
+    cdef REAL_t *Y = <REAL_t *>(np.PyArray_DATA(Y_p))
+
+    with nogil:
+        cy_noise_ff(sp_size, sp_idx, X, M, Y, seed, counter, do_drop,
+                    drop_rate, keep_scale, fuzz_c, vec_dim)
+    return
+
+cdef void cy_noise_bp(
+    const int sp_size, const UI32_t *sp_idx, REAL_t *dY, UI8_t *M, REAL_t *dX,
+    const REAL_t keep_scale, const int vec_dim) nogil:
+
+    # declarations
+    cdef long long row
+    cdef int sp_i, k
+    cdef UI32_t i
+
+    # update loop
+    for sp_i in range(sp_size):
+        i = sp_idx[sp_i]
+        row = i * vec_dim
+        for k in range(vec_dim):
+            if (M[row + k] == 0):
+                dX[row + k] = 0.0
+            else:
+                dX[row + k] = keep_scale * dY[row + k]
+    return
+
+def noise_bp_pyx(sp_idx_p, dY_p, M_p, dX_p, keep_scale_p):
+    # Define and cast minibatch problem parameters
+    cdef int sp_size = <int>sp_idx_p.shape[0]
+    cdef int vec_dim = <int>dY_p.shape[1]
+    cdef REAL_t keep_scale = <REAL_t>keep_scale_p
+    cdef UI32_t *sp_idx = <UI32_t *>(np.PyArray_DATA(sp_idx_p))
+    cdef REAL_t *dY = <REAL_t *>(np.PyArray_DATA(dY_p))
+    cdef UI8_t *M = <UI8_t *>(np.PyArray_DATA(M_p))
+    cdef REAL_t *dX = <REAL_t *>(np.PyArray_DATA(dX_p))
+
+    with nogil:
+        cy_noise_bp(sp_size, sp_idx, dY, M, dX, keep_scale, vec_dim)
+    return
+
 ###############
 # INIT, INNIT #
 ###############
@@ -601,7 +1135,9 @@ def init():
     """
     Bleep bloop: computer compute.
     """
+    global our_dot
     global cy_w2v_ff_bp
+    global cy_cbow_ff_bp
     global cy_nsl_ff_bp
     global cy_acl_ff_bp
 
@@ -616,12 +1152,16 @@ def init():
     d_res = dsdot(&size, x, &ONE, y, &ONE)
     p_res = <float *>&d_res
     if (abs(d_res - expected) < 0.0001):
+        our_dot = our_dot_double
         cy_w2v_ff_bp = cy_w2v_ff_bp0
+        cy_cbow_ff_bp = cy_cbow_ff_bp0
         cy_nsl_ff_bp = cy_nsl_ff_bp0
         cy_acl_ff_bp = cy_acl_ff_bp0
         return 0  # double
     elif (abs(p_res[0] - expected) < 0.0001):
+        our_dot = our_dot_float
         cy_w2v_ff_bp = cy_w2v_ff_bp1
+        cy_cbow_ff_bp = cy_cbow_ff_bp1
         cy_nsl_ff_bp = cy_nsl_ff_bp1
         cy_acl_ff_bp = cy_acl_ff_bp1
         return 1  # float
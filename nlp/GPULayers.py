@@ -18,7 +18,17 @@ MAX_HSM_KEY = 12345678
 #################################
 
 class FullLayer:
-    def __init__(self, in_dim=0, max_out_key=0):
+    """
+    Fully-connected softmax layer, with one row of W for each outcome.
+
+    With sample_count > 0, training uses a sampled softmax: each backprop
+    only touches the rows of W/b for the batch's targets and for
+    sample_count negatives drawn from sample_probs (uniform by default),
+    and apply_grad() only updates those rows. feedforward(X, dense=True)
+    still computes the full softmax inputs, e.g. for evaluation.
+    """
+    def __init__(self, in_dim=0, max_out_key=0, sample_count=0, \
+                 sample_probs=None):
         # Set dimension of incoming vectors and the number of outcomes for
         # which to perform prediction. Increment the requested prediction size
         # by 1, to accommodate 0 indexing.
@@ -27,26 +37,42 @@ class FullLayer:
         self.dim_output = out_dim
         # Initialize parameters, gradients, and adagrad "momentums"
         self.params = {}
-        self.params['W'] = 0.01 * gp.randn((in_dim, out_dim))
+        self.params['W'] = 0.01 * gp.randn((out_dim, in_dim))
         self.params['b'] = gp.zeros((1, out_dim))
         self.grads = {}
-        self.grads['W'] = gp.zeros((in_dim, out_dim))
+        self.grads['W'] = gp.zeros((out_dim, in_dim))
         self.grads['b'] = gp.zeros((1, out_dim))
         self.moms = {}
-        self.moms['W'] = gp.zeros((in_dim, out_dim))
+        self.moms['W'] = gp.zeros((out_dim, in_dim))
         self.moms['b'] = gp.zeros((1, out_dim))
+        # Set up sampling of "negative" outcomes for sampled softmax
+        self.set_sampling(sample_count, sample_probs)
         # Initialize temp vars to use during feedforward/backpropagation
         self.X = []
         self.Y = []
         self.Y_cat = []
         return
 
+    def set_sampling(self, sample_count=0, sample_probs=None):
+        """Set the number of negatives for sampled softmax (0 for dense)."""
+        self.sample_count = sample_count
+        if sample_probs is None:
+            sample_probs = ones((self.dim_output,))
+        sample_probs = np.asarray(sample_probs, dtype=np.float64).ravel()
+        assert(sample_probs.size == self.dim_output)
+        self.sample_probs = sample_probs / np.sum(sample_probs)
+        self.sample_cdf = np.cumsum(self.sample_probs)
+        # Keys whose rows were touched since the last apply_grad (if sampling)
+        self.grad_keys = []
+        return
+
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
-        self.params['W'] = w_scale * gp.randn((self.dim_input, self.dim_output))
-        self.grads['W'] = gp.zeros((self.dim_input, self.dim_output))
+        self.params['W'] = w_scale * gp.randn((self.dim_output, self.dim_input))
+        self.grads['W'] = gp.zeros((self.dim_output, self.dim_input))
         self.params['b'] = gp.zeros((1, self.dim_output))
         self.grads['b'] = gp.zeros((1, self.dim_output))
+        self.grad_keys = []
         return
 
     def clip_params(self, max_norm=10.0):
@@ -58,35 +84,100 @@ class FullLayer:
         self.params['W'] = M * m_scales[:,gp.newaxis]
         return
 
-    def feedforward(self, X):
-        """Run feedforward for this layer."""
+    def feedforward(self, X, dense=None):
+        """Run feedforward for this layer.
+
+        When sampling, the softmax inputs are computed during backprop (for
+        the sampled outcomes only), and this returns None, unless dense is
+        True. dense defaults to True iff sampling is off.
+        """
         # Cleanup debris from any previous feedforward
         self._cleanup()
         # Do new feedforward...
+        if dense is None:
+            dense = (self.sample_count == 0)
         self.X = gp.garray(X)
-        self.Y = gp.dot(self.X, self.params['W']) + self.params['b']
+        if dense:
+            self.Y = gp.dot(self.X, self.params['W'].T) + self.params['b']
+        else:
+            self.Y = None
         return self.Y
 
     def backprop(self, Y_cat, L_ary=None, return_on_gpu=False):
-        """Backprop through softmax using the given target predictions."""
-        # Compute gradient of cross-entropy objective, based on the given
-        # target predictions and the most recent feedforward information.
-        L, dLdY = self.xent_loss_and_grad(self.Y, Y_cat.astype(np.uint32))
-        # Backprop cross-ent grads to get grads w.r.t. layer parameters
-        dLdW = gp.dot(self.X.T, dLdY)
-        dLdb = gp.sum(dLdY, axis=0)
-        dLdb = dLdb[gp.newaxis,:]
-        self.grads['W'] += dLdW
-        self.grads['b'] += dLdb
-        # Backprop cross-ent grads to get grads w.r.t. layer input
-        dLdX = gp.dot(dLdY, self.params['W'].T)
+        """Backprop through softmax using the given target predictions.
+
+        Y_cat should be a vector of integer target outcomes, one per row of
+        the most recent feedforward input.
+        """
+        Y_cat = np.asarray(Y_cat, dtype=np.int32).ravel()
+        if self.Y is None:
+            L, dLdX = self._sampled_backprop(Y_cat)
+        else:
+            L, dLdX = self._dense_backprop(Y_cat)
         # Return gradients w.r.t. to input, either on or off the GPU
         if not return_on_gpu:
             dLdX = gp.as_numpy_array(dLdX).astype(np.float32)
         # Write loss into L_ary if it was given
-        L_ary[0] = L
+        if L_ary is not None:
+            L_ary[0] = L
         return dLdX
 
+    def _dense_backprop(self, Y_cat):
+        """Backprop the full softmax, without building one-hot targets.
+
+        The target terms of the cross-entropy gradient only involve the
+        target rows of W/b, so they're handled by gathering those rows.
+        """
+        W = self.params['W']
+        Y_sm = self.safe_softmax(self.Y)
+        # Get loss from the target outcomes' inputs to the softmax
+        W_t = W[Y_cat]
+        Y_t = gp.sum(self.X * W_t, axis=1) + self.params['b'].ravel()[Y_cat]
+        Y_max = gp.max(self.Y, axis=1)
+        Y_lse = Y_max + gp.log(gp.sum(gp.exp(self.Y - Y_max[:,gp.newaxis]), axis=1))
+        L = gp.sum(Y_lse - Y_t)
+        # Backprop the softmax part of the gradient
+        self.grads['W'] += gp.dot(Y_sm.T, self.X)
+        self.grads['b'] += gp.sum(Y_sm, axis=0)[gp.newaxis,:]
+        dLdX = gp.dot(Y_sm, W) - W_t
+        # Subtract the target part, merging rows with the same target
+        (keys, S) = self._target_scatter(Y_cat)
+        self._add_rows(self.grads['W'], keys, -1.0 * gp.dot(S.T, self.X))
+        self._add_rows(self.grads['b'].ravel(), keys, -1.0 * gp.sum(S, axis=0))
+        return [L, dLdX]
+
+    def _sampled_backprop(self, Y_cat):
+        """Backprop a sampled softmax over the targets and some negatives."""
+        neg_keys = np.searchsorted(self.sample_cdf, npr.rand(self.sample_count))
+        neg_keys = np.minimum(neg_keys, self.dim_output - 1)
+        keys = np.unique(np.concatenate((Y_cat, neg_keys))).astype(np.int32)
+        Y_pos = np.searchsorted(keys, Y_cat)
+        # Compute softmax inputs for the sampled outcomes, corrected for
+        # their expected number of occurrences in the sample.
+        log_q = np.log(np.maximum(self.sample_count * self.sample_probs[keys], 1e-8))
+        W_s = self.params['W'][keys]
+        b_s = self.params['b'].ravel()[keys] - gp.garray(log_q)
+        Y_s = gp.dot(self.X, W_s.T) + b_s[gp.newaxis,:]
+        L, dLdY = self.xent_loss_and_grad(Y_s, Y_pos)
+        # Backprop to the sampled rows and to the input
+        self._add_rows(self.grads['W'], keys, gp.dot(dLdY.T, self.X))
+        self._add_rows(self.grads['b'].ravel(), keys, gp.sum(dLdY, axis=0))
+        self.grad_keys.append(keys)
+        dLdX = gp.dot(dLdY, W_s)
+        return [L, dLdX]
+
+    def _target_scatter(self, Y_cat):
+        """Get the unique targets, and a (batch x unique) one-hot matrix."""
+        keys, inv = np.unique(Y_cat, return_inverse=True)
+        S = zeros((Y_cat.size, keys.size))
+        S[np.arange(Y_cat.size), inv] = 1.0
+        return [keys, gp.garray(S)]
+
+    def _add_rows(self, M, keys, dM):
+        """Add the rows of dM into the given (unique) rows of M, in place."""
+        M[keys] = M[keys] + dM
+        return
+
     def safe_softmax(self, Y):
         """Compute a reasonably (numerically) safe softmax."""
         Y_max = gp.max(Y, axis=1)
@@ -98,7 +189,11 @@ class FullLayer:
         return Y_sm
 
     def xent_loss_and_grad(self, Yh, Y_cat):
-        """Cross-entropy loss for predictions Yh given targets Y_cat."""
+        """Cross-entropy loss for predictions Yh given targets Y_cat.
+
+        This builds one-hot targets, so it's only meant for the (narrow)
+        softmax inputs of sampled outcomes.
+        """
         # Convert from categorical classes to "one-hot" target vectors
         Y_ind = zeros(Yh.shape)
         Y_ind[np.arange(Y_ind.shape[0]), Y_cat] = 1.0
@@ -117,7 +212,14 @@ class FullLayer:
         return
 
     def apply_grad(self, learn_rate=1e-2,):
-        """Apply the current accumulated gradients, with adagrad."""
+        """Apply the current accumulated gradients, with adagrad.
+
+        After sampled backprops, only the touched rows are updated.
+        """
+        if len(self.grad_keys) > 0:
+            keys = np.unique(np.concatenate(self.grad_keys))
+            self._apply_row_grad(keys, learn_rate)
+            return
         # Update the adagrad "momentums"
         self.moms['W'] = (0.95 * self.moms['W']) + (0.05 * self.grads['W']**2.0)
         self.moms['b'] = (0.95 * self.moms['b']) + (0.05 * self.grads['b']**2.0)
@@ -130,10 +232,24 @@ class FullLayer:
         self.reset_grads()
         return
 
+    def _apply_row_grad(self, keys, learn_rate):
+        """Apply adagrad updates to (and reset grads for) the given rows."""
+        for (M, G, mom) in [(self.params['W'], self.grads['W'], self.moms['W']), \
+                (self.params['b'].ravel(), self.grads['b'].ravel(), \
+                 self.moms['b'].ravel())]:
+            G_k = G[keys]
+            mom_k = (0.95 * mom[keys]) + (0.05 * G_k**2.0)
+            mom[keys] = mom_k
+            M[keys] = M[keys] - (learn_rate * (G_k / (gp.sqrt(mom_k) + ADA_EPS)))
+            G[keys] = 0.0 * G_k
+        self.grad_keys = []
+        return
+
     def reset_grads(self):
         """Reset the gradient accumulators for this layer."""
         self.grads['W'] = 0.0 * self.grads['W']
         self.grads['b'] = 0.0 * self.grads['b']
+        self.grad_keys = []
         return
 
     def reset_moms(self, ada_init=1e-3):
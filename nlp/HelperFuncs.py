@@ -1,9 +1,17 @@
 from __future__ import absolute_import
 
+import os
+import sys
 import numpy as np
 import numpy.random as npr
 import numba
 
+# PhaseProfiler is shared with the Theano trainers (see shared/README.md)
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (repo_dir in sys.path):
+    sys.path.append(repo_dir)
+from shared.profiling import PhaseProfiler, wall_time
+
 ###########################
 # GENERATE TYPED MATRICES #
 ###########################
@@ -17,12 +25,180 @@ def ones(shape, dtype=np.float32):
 def zeros(shape, dtype=np.float32):
     return np.zeros(shape, dtype=dtype)
 
+def fill_randn(M, scale=1.0, chunk_rows=65536):
+    """
+    Fill M in place with scale * N(0,1) samples, chunk_rows rows at a time.
+
+    This draws the same values as scale * randn(M.shape), without building
+    full-size temporaries for huge tables.
+    """
+    if (scale == 0.0):
+        M.fill(0.0)
+        return M
+    M_2d = M.reshape((M.shape[0], -1))
+    for s_idx in range(0, M_2d.shape[0], chunk_rows):
+        e_idx = min(s_idx + chunk_rows, M_2d.shape[0])
+        M_2d[s_idx:e_idx] = npr.randn(e_idx - s_idx, M_2d.shape[1])
+        M_2d[s_idx:e_idx] *= scale
+    return M
+
+
+###################################
+# QUANTIZED EMBEDDING TABLE STUFF #
+###################################
+
+class QuantizedLUT(object):
+    """
+    Read-only int8 copy of an embedding table, with a float32 scale per row.
+
+    Row i of the source table is approximated by scales[i] * codes[i]. Lookups
+    and cosine similarity queries run over the int8 codes block_rows rows at a
+    time, so a float32 copy of the full table is never rebuilt.
+    """
+    def __init__(self, W=None, block_rows=65536):
+        self.block_rows = block_rows
+        self.codes = np.zeros((0, 0), dtype=np.int8)
+        self.scales = np.zeros((0,), dtype=np.float32)
+        self.norms = np.zeros((0,), dtype=np.float32)
+        if not (W is None):
+            self.quantize(W)
+        return
+
+    def quantize(self, W):
+        """Quantize the rows of W, and record their (dequantized) norms."""
+        row_count = W.shape[0]
+        self.codes = np.zeros(W.shape, dtype=np.int8)
+        self.scales = np.zeros((row_count,), dtype=np.float32)
+        self.norms = np.zeros((row_count,), dtype=np.float32)
+        for b_start in range(0, row_count, self.block_rows):
+            b_end = min(b_start + self.block_rows, row_count)
+            Wb = np.asarray(W[b_start:b_end], dtype=np.float32)
+            scales = np.max(np.abs(Wb), axis=1) / 127.0
+            scales[scales == 0.0] = 1.0
+            codes = np.rint(Wb / scales[:,np.newaxis])
+            codes = np.clip(codes, -127, 127).astype(np.int8)
+            self.codes[b_start:b_end] = codes
+            self.scales[b_start:b_end] = scales
+            self.norms[b_start:b_end] = scales * \
+                    np.sqrt(np.sum(codes.astype(np.float32)**2.0, axis=1))
+        return
+
+    def lookup(self, keys):
+        """Get dequantized float32 rows for the given keys."""
+        keys = np.asarray(keys)
+        return self.codes[keys].astype(np.float32) * \
+                self.scales[keys][...,np.newaxis]
+
+    def nearest(self, Q, count=10, exclude_keys=None):
+        """
+        Get the count rows with highest cosine similarity to each row of Q.
+
+        Returns [near_keys, near_sims], both of shape (Q.shape[0], count),
+        sorted by decreasing similarity. If exclude_keys is given, row i of Q
+        won't match the key exclude_keys[i] (e.g. the query word itself).
+        """
+        Q = np.asarray(Q, dtype=np.float32).reshape((-1, self.codes.shape[1]))
+        Q = Q / (np.sqrt(np.sum(Q**2.0, axis=1, keepdims=True)) + 1e-5)
+        q_count = Q.shape[0]
+        near_keys = np.zeros((q_count, 0), dtype=np.int64)
+        near_sims = np.zeros((q_count, 0), dtype=np.float32)
+        for b_start in range(0, self.codes.shape[0], self.block_rows):
+            b_end = min(b_start + self.block_rows, self.codes.shape[0])
+            # similarities between Q and this block of rows, using the scales
+            # and norms to avoid dequantizing the block
+            S = np.dot(Q, self.codes[b_start:b_end].astype(np.float32).T)
+            S *= (self.scales[b_start:b_end] / \
+                    (self.norms[b_start:b_end] + 1e-5))[np.newaxis,:]
+            if not (exclude_keys is None):
+                ex_keys = np.asarray(exclude_keys).ravel() - b_start
+                ex_rows = np.flatnonzero((ex_keys >= 0) & (ex_keys < S.shape[1]))
+                S[ex_rows, ex_keys[ex_rows]] = -np.inf
+            # merge the best matches from this block with those found so far
+            all_keys = np.hstack((near_keys, \
+                    np.tile(np.arange(b_start, b_end), (q_count, 1))))
+            all_sims = np.hstack((near_sims, S))
+            if all_sims.shape[1] > count:
+                best = np.argpartition(-all_sims, count - 1, axis=1)[:,:count]
+                all_keys = np.take_along_axis(all_keys, best, axis=1)
+                all_sims = np.take_along_axis(all_sims, best, axis=1)
+            near_keys, near_sims = all_keys, all_sims
+        order = np.argsort(-near_sims, axis=1)
+        near_keys = np.take_along_axis(near_keys, order, axis=1)
+        near_sims = np.take_along_axis(near_sims, order, axis=1)
+        return [near_keys, near_sims]
+
+    def nearest_keys(self, keys, count=10):
+        """Get the count nearest rows to each of the given rows."""
+        keys = np.asarray(keys).ravel()
+        return self.nearest(self.lookup(keys), count=count, exclude_keys=keys)
+
+    def save(self, f_name):
+        """Save the codes, scales and norms to an .npz file."""
+        np.savez(f_name, codes=self.codes, scales=self.scales, norms=self.norms)
+        return
+
+    def load(self, f_name):
+        """Load codes, scales and norms from an .npz file made by save()."""
+        npz = np.load(f_name)
+        self.codes = npz['codes']
+        self.scales = npz['scales']
+        self.norms = npz['norms']
+        return
 
 ################################
 # TRAINING DATA SAMPLING STUFF #
 ################################
 
-def rand_word_seqs(phrase_list, seq_count, seq_len, null_key):
+def flatten_phrases(phrase_list, min_len=1):
+    """Flatten a list of phrases into one key array with phrase offsets.
+
+    Phrases with fewer than min_len keys (and empty ones) are dropped. Returns
+    [keys, offsets, phrase_ids], where keys[offsets[i]:offsets[i+1]] holds
+    the i'th kept phrase, which is phrase_list[phrase_ids[i]]. Callers that
+    sample from the same phrases many times can flatten them once, and pass
+    the result to the rand_* samplers as flat (with min_len=2 for the pair
+    samplers, which need a context word for each anchor).
+    """
+    min_len = max(1, min_len)
+    phrase_ids = [i for (i, p) in enumerate(phrase_list) if (len(p) >= min_len)]
+    if (len(phrase_ids) == 0):
+        raise ValueError("no phrases with {0:d}+ keys".format(min_len))
+    phrase_lens = np.asarray([len(phrase_list[i]) for i in phrase_ids], \
+            dtype=np.int64)
+    offsets = np.zeros((phrase_lens.size + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum(phrase_lens)
+    keys = np.concatenate([np.asarray(phrase_list[i]).ravel() \
+            for i in phrase_ids])
+    phrase_ids = np.asarray(phrase_ids).astype(np.uint32)
+    return [keys, offsets, phrase_ids]
+
+def _rand_phrase_positions(offsets, phrase_ids, samp_count):
+    """Sample kept phrases uniformly, and a uniform position in each phrase.
+
+    Returns [phrase_keys, phrase_starts, phrase_lens, positions], where
+    phrase_keys are indices into the unflattened phrase list.
+    """
+    p_idx = npr.randint(0, high=(offsets.size - 1), size=(samp_count,))
+    phrase_starts = offsets[p_idx]
+    phrase_lens = offsets[p_idx + 1] - phrase_starts
+    positions = (npr.rand(samp_count) * phrase_lens).astype(np.int64)
+    return [phrase_ids[p_idx], phrase_starts, phrase_lens, positions]
+
+def _rand_context_positions(a_idx, c_min, c_max):
+    """Sample positions uniformly from [c_min, c_max], excluding a_idx.
+
+    This draws from the window without the anchor, and then shifts draws at
+    or past the anchor up by one, which matches rejection sampling.
+    """
+    c_span = c_max - c_min
+    if np.any(c_span < 1):
+        raise ValueError("flat has phrases with only one key, flatten them " \
+                "with min_len=2")
+    c_idx = c_min + (npr.rand(a_idx.size) * c_span).astype(np.int64)
+    c_idx = c_idx + (c_idx >= a_idx)
+    return c_idx
+
+def rand_word_seqs(phrase_list, seq_count, seq_len, null_key, flat=None):
     """Sample LUT key n-grams from a list of phrases.
 
     Given a list of phrases, where each phrase is described by a list of
@@ -30,28 +206,22 @@ def rand_word_seqs(phrase_list, seq_count, seq_len, null_key):
     sequences, where n is given by seq_len. The sampled n-grams are only
     constrained to have their final item inside the source phrase. When any
     of the first n-1 items in a sampled sequence are not in the source phrase,
-    they are assigned the key given by null_key.
+    they are assigned the key given by null_key. Empty phrases are skipped.
+    If flat is given, it should be flatten_phrases(phrase_list), which then
+    isn't recomputed.
     """
-    phrase_count = len(phrase_list)
-    seq_keys = np.zeros((seq_count, seq_len), dtype=np.uint32)
-    phrase_keys = np.zeros((seq_count,), dtype=np.uint32)
-    for i in range(seq_count):
-        phrase_keys[i] = npr.randint(0, phrase_count)
-        phrase = phrase_list[phrase_keys[i]]
-        phrase_len = len(phrase)
-        final_key = npr.randint(0, phrase_len)
-        seq_keys[i,-1] = phrase[final_key]
-        for j in range(seq_len-1):
-            preceding_key = final_key - seq_len + j + 1
-            if (preceding_key < 0):
-                seq_keys[i,j] = null_key
-            else:
-                seq_keys[i,j] = phrase[preceding_key]
-    seq_keys = seq_keys.astype(np.uint32)
+    keys, offsets, phrase_ids = flatten_phrases(phrase_list) \
+            if (flat is None) else flat
+    phrase_keys, phrase_starts, phrase_lens, final_idx = \
+            _rand_phrase_positions(offsets, phrase_ids, seq_count)
+    seq_idx = final_idx[:,np.newaxis] + np.arange((1 - seq_len), 1)
+    in_phrase = (seq_idx >= 0)
+    seq_idx = phrase_starts[:,np.newaxis] + (seq_idx * in_phrase)
+    seq_keys = np.where(in_phrase, keys[seq_idx], null_key).astype(np.uint32)
     phrase_keys = phrase_keys.astype(np.uint32)
     return [seq_keys, phrase_keys]
 
-def rand_word_pairs(phrase_list, pair_count, context_size):
+def rand_word_pairs(phrase_list, pair_count, context_size, flat=None):
     """Sample anchor/context LUT key pairs for skip-gram training.
 
     Parameters:
@@ -60,33 +230,27 @@ def rand_word_pairs(phrase_list, pair_count, context_size):
         context_size: half-width of context window to sample positives from
             NOTE: Samples are always drawn uniformly from within a context
                   window that was already clipped to fit the source phrase.
+        flat: optional flatten_phrases(phrase_list, min_len=2), to avoid
+              recomputing it (phrases with fewer than 2 keys are skipped)
     Outputs:
         anchor_keys: vector of np.uint32 (samp_count,)
         context_keys: vector of np.uint32 (samp_count,)
         phrase_keys: vector of np.uint32 (samp_count,)
     """
-    phrase_count = len(phrase_list)
-    anchor_keys = np.zeros((pair_count,), dtype=np.uint32)
-    context_keys = np.zeros((pair_count,), dtype=np.uint32)
-    phrase_keys = np.zeros((pair_count,), dtype=np.uint32)
-    for i in range(pair_count):
-        phrase_keys[i] = npr.randint(0, phrase_count)
-        phrase = phrase_list[phrase_keys[i]]
-        phrase_len = len(phrase)
-        a_idx = npr.randint(0, phrase_len)
-        c_max = min((a_idx+context_size+1), phrase_len)
-        c_min = max((a_idx-context_size), 0)
-        c_idx = a_idx
-        while (c_idx == a_idx):
-            c_idx = npr.randint(c_min, c_max)
-        anchor_keys[i] = phrase[a_idx]
-        context_keys[i] = phrase[c_idx]
-    anchor_keys = anchor_keys.astype(np.uint32)
-    context_keys = context_keys.astype(np.uint32)
-    phrase_keys =  phrase_keys.astype(np.uint32)
+    keys, offsets, phrase_ids = flatten_phrases(phrase_list, min_len=2) \
+            if (flat is None) else flat
+    phrase_keys, phrase_starts, phrase_lens, a_idx = \
+            _rand_phrase_positions(offsets, phrase_ids, pair_count)
+    c_max = np.minimum((a_idx + context_size + 1), phrase_lens) - 1
+    c_min = np.maximum((a_idx - context_size), 0)
+    c_idx = _rand_context_positions(a_idx, c_min, c_max)
+    anchor_keys = keys[phrase_starts + a_idx].astype(np.uint32)
+    context_keys = keys[phrase_starts + c_idx].astype(np.uint32)
+    phrase_keys = phrase_keys.astype(np.uint32)
     return [anchor_keys, context_keys, phrase_keys]
 
-def rand_pos_neg(phrase_list, all_words, samp_count, context_size, neg_count):
+def rand_pos_neg(phrase_list, all_words, samp_count, context_size, neg_count, \
+                 flat=None):
     """Sample LUT key tuples for skip-gram training via negative sampling.
 
     Parameters:
@@ -95,42 +259,28 @@ def rand_pos_neg(phrase_list, all_words, samp_count, context_size, neg_count):
         samp_count: number of training tuples of LUT keys to sample
         context_size: half-width of context window to sample positives from
         neg_count: number of negative samples to draw for each positive one
+        flat: optional flatten_phrases(phrase_list, min_len=2), to avoid
+              recomputing it (phrases with fewer than 2 keys are skipped)
     Outputs:
         anchor_keys: vector of np.uint32 (samp_count,)
         pos_keys: vector of np.uint32 (samp_count,)
         neg_keys: matrix of np.uint32 (samp_count, neg_count)
         phrase_keys: vector of np.uint32 (samp_count,)
     """
-    phrase_count = len(phrase_list)
-    #max_len = np.max(np.asarray([p.size for p in phrase_list]))
-    #phrase_probs = np.asarray([float(p.size) / max_len for p in phrase_list])
-    word_count = len(all_words)
-    anchor_keys = np.zeros((samp_count,), dtype=np.uint32)
-    pos_keys = np.zeros((samp_count,), dtype=np.uint32)
-    neg_keys = np.zeros((samp_count,neg_count), dtype=np.uint32)
-    phrase_keys = np.zeros((samp_count,), dtype=np.uint32)
-    for i in range(samp_count):
-        phrase_keys[i] = npr.randint(0, high=phrase_count)
-        # rejection sample phrases in proprtion to their length
-        #while (npr.rand() > phrase_probs[phrase_keys[i]]):
-        #    phrase_keys[i] = npr.randint(0, high=phrase_count)
-        phrase = phrase_list[phrase_keys[i]]
-        phrase_len = len(phrase)
-        a_idx = npr.randint(0, high=phrase_len)
-        c_max = min((a_idx+context_size), phrase_len-1)
-        c_min = max((a_idx-context_size), 0)
-        c_idx = a_idx
-        while (c_idx == a_idx):
-            c_idx = npr.randint(c_min, high=(c_max+1))
-        # Record the anchor word and its positive context word
-        anchor_keys[i] = phrase[a_idx]
-        pos_keys[i] = phrase[c_idx]
-        # Sample a random negative example from the full word list
-        n_idx = npr.randint(0, high=word_count, size=(1,neg_count))
-        neg_keys[i,:] = all_words[n_idx]
-    anchor_keys = anchor_keys.astype(np.uint32)
-    pos_keys = pos_keys.astype(np.uint32)
-    neg_keys = neg_keys.astype(np.uint32)
+    keys, offsets, phrase_ids = flatten_phrases(phrase_list, min_len=2) \
+            if (flat is None) else flat
+    all_words = np.asarray(all_words).ravel()
+    phrase_keys, phrase_starts, phrase_lens, a_idx = \
+            _rand_phrase_positions(offsets, phrase_ids, samp_count)
+    c_max = np.minimum((a_idx + context_size), (phrase_lens - 1))
+    c_min = np.maximum((a_idx - context_size), 0)
+    c_idx = _rand_context_positions(a_idx, c_min, c_max)
+    # Record the anchor words and their positive context words
+    anchor_keys = keys[phrase_starts + a_idx].astype(np.uint32)
+    pos_keys = keys[phrase_starts + c_idx].astype(np.uint32)
+    # Sample random negative examples from the full word list
+    n_idx = npr.randint(0, high=all_words.size, size=(samp_count, neg_count))
+    neg_keys = all_words[n_idx].astype(np.uint32)
     phrase_keys = phrase_keys.astype(np.uint32)
     return [anchor_keys, pos_keys, neg_keys, phrase_keys]
 
@@ -180,11 +330,9 @@ class PNSampler:
         return
 
     def sample_negatives(self, sample_count):
-        neg_keys = np.zeros((sample_count,self.neg_count), dtype=np.uint32)
-        neg_idx = npr.randint(0, high=self.neg_table_size, size=neg_keys.shape)
-        for i in range(neg_keys.shape[1]):
-            neg_keys[:,i] = self.neg_table[neg_idx[:,i]]
-        neg_keys = neg_keys.astype(np.uint32)
+        neg_idx = npr.randint(0, high=self.neg_table_size, \
+                size=(sample_count, self.neg_count))
+        neg_keys = self.neg_table.ravel()[neg_idx].astype(np.uint32)
         return neg_keys
 
     def sample(self, sample_count):
@@ -6,32 +6,168 @@ import numpy.random as npr
 import numexpr as ne
 
 # Imports of my stuff
-from HelperFuncs import randn, ones, zeros
-from CythonFuncs import w2v_ff_bp, nsl_ff_bp, lut_bp, \
-                        ag_update_2d, ag_update_1d, hsm_ff_bp
+from HelperFuncs import randn, ones, zeros, fill_randn, QuantizedLUT, \
+                        PhaseProfiler
+from CythonFuncs import get_kernels
 
 # UH OH, GLOBAL PARAMS (TODO: GET RID OF THESE!)
 ADA_EPS = 1e-3
 MAX_HSM_KEY = 12345678
 
+########################################
+# LAZY REGULARIZATION/CLIPPING HELPERS #
+########################################
+
+class LazyL2:
+    """
+    Lazy row-wise l2 decay (i.e. shrinkage) for LUT-style parameters.
+
+    decay() records a shrink step for every row in O(1), by accumulating the
+    log of the shrink factors. Each row remembers the total at which it was
+    last brought up to date, and catch_up() applies the decay a row has
+    missed since then. So, rows should be caught up right before they are
+    read or updated, and the cost of regularization scales with the number
+    of rows touched rather than with the size of the table.
+    """
+    def __init__(self, row_count):
+        self.log_scale = 0.0
+        self.row_log_scale = np.zeros((row_count,), dtype=np.float64)
+        return
+
+    def decay(self, lam_l2):
+        """Shrink all rows by a factor of (1 - lam_l2), lazily."""
+        self.log_scale += np.log(1.0 - lam_l2)
+        return
+
+    def catch_up(self, params, rows=None):
+        """Apply pending decay to the given rows (default: all) of params."""
+        if rows is None:
+            rows = slice(None)
+        row_scales = np.exp(self.log_scale - self.row_log_scale[rows])
+        if np.all(row_scales == 1.0):
+            return
+        row_scales = row_scales.astype(np.float32)
+        for P in params:
+            if (P.ndim == 1):
+                P[rows] *= row_scales
+            else:
+                P[rows] *= row_scales[:,np.newaxis]
+        self.row_log_scale[rows] = self.log_scale
+        return
+
+    def reset(self):
+        """Drop any pending decay, e.g. after reinitializing params."""
+        self.row_log_scale[:] = self.log_scale
+        return
+
+class LazyFill:
+    """
+    Lazy (re)filling of some tables with a constant, e.g. when resetting the
+    gradient or adagrad moment tables of a layer.
+
+    fill(..., lazy=True) just marks every row as stale, in O(1). catch_up()
+    fills the stale rows among those given, so tables should be caught up
+    right before their rows are used, like with LazyL2.
+    """
+    def __init__(self, row_count):
+        self.epoch = 0
+        self.value = 0.0
+        self.dirty = False
+        self.row_epochs = np.zeros((row_count,), dtype=np.int32)
+        return
+
+    def fill(self, tables, value, lazy=False):
+        """Fill all rows of tables with value, in place or lazily."""
+        self.epoch += 1
+        self.value = value
+        if lazy:
+            self.dirty = True
+        else:
+            for T in tables:
+                T.fill(value)
+            self.row_epochs.fill(self.epoch)
+            self.dirty = False
+        return
+
+    def catch_up(self, tables, rows=None):
+        """Apply any pending fill to the given rows (default: all)."""
+        if not self.dirty:
+            return
+        if rows is None:
+            stale = np.flatnonzero(self.row_epochs < self.epoch)
+            self.dirty = False
+        else:
+            rows = np.asarray(rows).ravel()
+            stale = rows[self.row_epochs[rows] < self.epoch]
+        if (stale.size > 0):
+            for T in tables:
+                T[stale] = self.value
+            self.row_epochs[stale] = self.epoch
+        return
+
+    def clear(self):
+        """Drop any pending fill, e.g. after the tables were set directly."""
+        self.row_epochs.fill(self.epoch)
+        self.dirty = False
+        return
+
+def clip_rows(M, max_norm, rows=None):
+    """Bound L2 norm of the given rows (default: all) of M, in place."""
+    if rows is None:
+        rows = slice(None)
+    R = M[rows]
+    r_scales = max_norm / np.sqrt(np.sum(R**2.0, axis=1) + 1e-5)
+    M[rows] = R * np.minimum(r_scales, 1.0)[:,np.newaxis]
+    return
+
 ###########################
 # NEGATIVE SAMPLING LAYER #
 ###########################
 
+def pn_keys_and_signs(pos_keys, neg_keys, sign_buf):
+    """
+    Get the (batch, 1+neg_count) matrix of positive and negative keys, and
+    the matching target sign matrix, with +1 for the positives (column 0) and
+    -1 for the negatives. If neg_keys is None, then pos_keys is assumed to
+    already hold the full key matrix (e.g. from sample_pn()). sign_buf is the
+    sign matrix returned by the previous call, which is reused if it has the
+    right shape, so callers should keep it (e.g. one per layer).
+    """
+    if neg_keys is None:
+        pn_keys = pos_keys
+    else:
+        pn_keys = np.hstack((pos_keys[:,np.newaxis], neg_keys))
+    pn_keys = pn_keys.astype(np.uint32, copy=False)
+    if (sign_buf.shape != pn_keys.shape):
+        sign_buf = -1.0 * ones(pn_keys.shape)
+        sign_buf[:,0] = 1.0
+    return [pn_keys, sign_buf]
+
 class NSLayer:
-    def __init__(self, in_dim=0, max_out_key=0):
+    def __init__(self, in_dim=0, max_out_key=0, mom_dtype=np.float32, \
+                 backend=None):
+        # Get the kernels to use (see CythonFuncs.get_kernels())
+        self.kernels = get_kernels(backend)
         # Record and initialize layer parameters
         self.dim_input = in_dim
         self.key_count = max_out_key + 1 # assume 0 is a key
+        self.mom_dtype = mom_dtype
         self.params = {}
-        self.params['W'] = 0.01 * randn((self.key_count, in_dim))
+        self.params['W'] = fill_randn(zeros((self.key_count, in_dim)), 0.01)
         self.params['b'] = zeros((self.key_count,))
         self.grads = {}
         self.grads['W'] = zeros((self.key_count, in_dim))
         self.grads['b'] = zeros((self.key_count,))
         self.moms = {}
-        self.moms['W'] = zeros((self.key_count, in_dim))
-        self.moms['b'] = zeros((self.key_count,))
+        self.moms['W'] = zeros((self.key_count, in_dim), dtype=mom_dtype)
+        self.moms['b'] = zeros((self.key_count,), dtype=mom_dtype)
+        # l2 decay is applied lazily, and touched rows of W are clipped to
+        # max_norm after each update (if it's not None)
+        self.lazy_l2 = LazyL2(self.key_count)
+        self.max_norm = None
+        # resets of the grads and moms can be lazy, too
+        self.lazy_grads = LazyFill(self.key_count)
+        self.lazy_moms = LazyFill(self.key_count)
         # Set temp vars to use in feedforward/backprop
         self.X = []
         self.Y = []
@@ -39,53 +175,60 @@ class NSLayer:
         self.dLdY = []
         self.samp_keys = []
         self.grad_idx = []
+        # target signs for the keys, reallocated when the batch shape changes
+        self.pn_sign = zeros((0, 0))
+        # kernel for the combined feedforward/backprop
+        self.ff_bp_func = self.kernels['nsl_ff_bp']
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
-        self.params['W'] = w_scale * randn((self.key_count, self.dim_input))
-        self.grads['W'] = zeros((self.key_count, self.dim_input))
-        self.params['b'] = zeros((self.key_count,))
-        self.grads['b'] = zeros((self.key_count,))
+        fill_randn(self.params['W'], w_scale)
+        self.params['b'].fill(0.0)
+        self.lazy_grads.fill([self.grads['W'], self.grads['b']], 0.0)
+        self.lazy_l2.reset()
         return
 
-    def clip_params(self, max_norm=5.0):
+    def clip_params(self, max_norm=5.0, rows=None):
         """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        clip_rows(self.params['W'], max_norm, rows)
         return
 
-    def ff_bp(self, X, pos_samples, neg_samples, do_grad=True):
-        """Perform feedforward and then backprop for this layer."""
+    def ff_bp(self, X, pos_samples, neg_samples=None, do_grad=True):
+        """
+        Perform feedforward and then backprop for this layer.
+
+        If neg_samples is None, pos_samples should be a key matrix with the
+        positives in column 0, as given by NegSampler.sample_pn().
+        """
         # check array types, to avoid "silent" type errors in Cython code
         assert(type(X[0,0]) == np.float32)
-        assert(type(pos_samples[0]) == np.uint32)
-        assert(type(neg_samples[0,0]) == np.uint32)
+        assert(pos_samples.dtype == np.uint32)
+        assert((neg_samples is None) or (neg_samples.dtype == np.uint32))
+        # record inputs and keys for positive/negative examples
+        samp_keys, self.pn_sign = pn_keys_and_signs(pos_samples, \
+                neg_samples, self.pn_sign)
         # check for valid input shapes
         assert(X.shape[1] == self.params['W'].shape[1])
-        assert(pos_samples.shape[0] == X.shape[0])
-        assert(neg_samples.shape[0] == X.shape[0])
+        assert(samp_keys.shape[0] == X.shape[0])
         # check that requested target keys are all valid
-        assert(np.max(pos_samples) < self.key_count)
-        assert(np.max(neg_samples) < self.key_count)
+        assert(np.max(samp_keys) < self.key_count)
         # cleanup debris from any previous feedforward
         self._cleanup()
         # change from boolean to int, for Cython code
         do_grad = 1 if do_grad else 0
-        # record inputs and keys for positive/negative examples
-        pos_samples = pos_samples[:,np.newaxis]
-        samp_keys = np.hstack((pos_samples, neg_samples))
-        samp_sign = -1.0 * ones(samp_keys.shape)
-        samp_sign[:,0] = 1.0
+        # bring the rows we'll use up to date with any pending l2 decay, and
+        # with any pending reset of their gradients
+        self.lazy_l2.catch_up([self.params['W'], self.params['b']], \
+                samp_keys.ravel())
+        self.lazy_grads.catch_up([self.grads['W'], self.grads['b']], \
+                samp_keys.ravel())
         # do feedforward and backprop all in one go
         L = zeros(samp_keys.shape)
         dLdX = zeros(X.shape)
-        nsl_ff_bp(samp_keys, samp_sign, X, self.params['W'], self.params['b'], \
-                  dLdX, self.grads['W'], self.grads['b'], L, do_grad)
+        self.ff_bp_func(samp_keys, self.pn_sign, X, self.params['W'], \
+                        self.params['b'], dLdX, self.grads['W'], \
+                        self.grads['b'], L, do_grad)
         # derp dorp
         L = np.sum(L)
         if do_grad:
@@ -98,32 +241,39 @@ class NSLayer:
 
     def l2_regularize(self, lam_l2=1e-5):
         """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
-        self.params['b'] -= lam_l2 * self.params['b']
+        self.lazy_l2.decay(lam_l2)
         return 1
 
+    def flush_l2(self):
+        """Apply all pending l2 decay, before reading the full params."""
+        self.lazy_l2.catch_up([self.params['W'], self.params['b']])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
+        ag_update_2d = self.kernels['ag_update_2d']
+        ag_update_1d = self.kernels['ag_update_1d']
         nz_idx = self.grad_idx[self.grad_idx < self.key_count]
+        self.lazy_grads.catch_up([self.grads['W'], self.grads['b']], nz_idx)
+        self.lazy_moms.catch_up([self.moms['W'], self.moms['b']], nz_idx)
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
         ag_update_1d(nz_idx, self.params['b'], self.grads['b'], \
                      self.moms['b'], learn_rate)
+        if not (self.max_norm is None):
+            clip_rows(self.params['W'], self.max_norm, nz_idx)
         self.grad_idx = []
         return
 
-    def reset_moms(self, ada_init=1e-3):
+    def reset_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.lazy_moms.fill([self.moms['W'], self.moms['b']], ada_init, lazy)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
+    def reset_grads_and_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.grads['b'] = (0.0 * self.grads['b'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.lazy_grads.fill([self.grads['W'], self.grads['b']], 0.0, lazy)
+        self.lazy_moms.fill([self.moms['W'], self.moms['b']], ada_init, lazy)
         return
 
     def _cleanup(self):
@@ -135,24 +285,56 @@ class NSLayer:
         self.dLdY = []
         return
 
+##########################
+# AUTO-CONTRASTIVE LAYER #
+##########################
+
+class ACLayer(NSLayer):
+    """
+    Output layer with the "auto-contrastive" loss from acl_ff_bp_pyx. Each
+    negative is contrasted against the positive, with loss
+
+        -log(f_p / (c + f_p + f_n)), where f_* = exp(W[key].x + b[key]),
+
+    summed over the negatives. Keys are laid out like for NSLayer, with the
+    positive in column 0, so this is a drop-in replacement for NSLayer.
+    """
+    def __init__(self, in_dim=0, max_out_key=0, mom_dtype=np.float32, \
+                 backend=None):
+        NSLayer.__init__(self, in_dim=in_dim, max_out_key=max_out_key, \
+                         mom_dtype=mom_dtype, backend=backend)
+        self.ff_bp_func = self.kernels['acl_ff_bp']
+        return
+
 #################################################
 # HIERARCHICAL SOFTMAX LAYER -- VERY INCOMPLETE #
 #################################################
 
 class HSMLayer:
-    def __init__(self, in_dim=0, max_hs_key=0):
+    def __init__(self, in_dim=0, max_hs_key=0, mom_dtype=np.float32, \
+                 backend=None):
+        # Get the kernels to use (see CythonFuncs.get_kernels())
+        self.kernels = get_kernels(backend)
         # Record and initialize some layer parameters
         self.dim_input = in_dim
         self.key_count = max_hs_key + 1 # assume 0 is a key
+        self.mom_dtype = mom_dtype
         self.params = {}
-        self.params['W'] = 0.01 * randn((self.key_count, in_dim))
+        self.params['W'] = fill_randn(zeros((self.key_count, in_dim)), 0.01)
         self.params['b'] = zeros((self.key_count,))
         self.grads = {}
         self.grads['W'] = zeros((self.key_count, in_dim))
         self.grads['b'] = zeros((self.key_count,))
         self.moms = {}
-        self.moms['W'] = zeros((self.key_count, in_dim))
-        self.moms['b'] = zeros((self.key_count,))
+        self.moms['W'] = zeros((self.key_count, in_dim), dtype=mom_dtype)
+        self.moms['b'] = zeros((self.key_count,), dtype=mom_dtype)
+        # l2 decay is applied lazily, and touched rows of W are clipped to
+        # max_norm after each update (if it's not None)
+        self.lazy_l2 = LazyL2(self.key_count)
+        self.max_norm = None
+        # resets of the grads and moms can be lazy, too
+        self.lazy_grads = LazyFill(self.key_count)
+        self.lazy_moms = LazyFill(self.key_count)
         # Set temp vars to use in feedforward/backprop
         self.X = []
         self.Y = []
@@ -163,20 +345,15 @@ class HSMLayer:
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
-        self.params['W'] = w_scale * randn((self.key_count, self.dim_input))
-        self.grads['W'] = zeros((self.key_count, self.dim_input))
-        self.params['b'] = zeros((self.key_count,))
-        self.grads['b'] = zeros((self.key_count,))
+        fill_randn(self.params['W'], w_scale)
+        self.params['b'].fill(0.0)
+        self.lazy_grads.fill([self.grads['W'], self.grads['b']], 0.0)
+        self.lazy_l2.reset()
         return
 
-    def clip_params(self, max_norm=5.0):
+    def clip_params(self, max_norm=5.0, rows=None):
         """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        clip_rows(self.params['W'], max_norm, rows)
         return
 
     def ff_bp(self, X, code_keys, code_signs, do_grad=True):
@@ -185,6 +362,7 @@ class HSMLayer:
         By setting do_grad to False, we can just compute the loss, without
         making modifications to the gradient accumulators (i.e. no backprop).
         """
+        hsm_ff_bp = self.kernels['hsm_ff_bp']
         # check array types, to avoid "silent" type errors in Cython code
         assert(type(X[0,0]) == np.float32)
         assert(type(code_keys[0,0]) == np.uint32)
@@ -197,6 +375,12 @@ class HSMLayer:
         self._cleanup()
         # change from boolean to int, for Cython code
         do_grad = 1 if do_grad else 0
+        # bring the rows we'll use up to date with any pending l2 decay, and
+        # with any pending reset of their gradients
+        used_keys = code_keys.ravel()
+        used_keys = used_keys[used_keys < self.key_count]
+        self.lazy_l2.catch_up([self.params['W'], self.params['b']], used_keys)
+        self.lazy_grads.catch_up([self.grads['W'], self.grads['b']], used_keys)
         # do feedforward and backprop all in one go
         dLdX = zeros(X.shape)
         L_cy = zeros(code_keys.shape)
@@ -216,32 +400,39 @@ class HSMLayer:
 
     def l2_regularize(self, lam_l2=1e-5):
         """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
-        self.params['b'] -= lam_l2 * self.params['b']
+        self.lazy_l2.decay(lam_l2)
         return 1
 
+    def flush_l2(self):
+        """Apply all pending l2 decay, before reading the full params."""
+        self.lazy_l2.catch_up([self.params['W'], self.params['b']])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
+        ag_update_2d = self.kernels['ag_update_2d']
+        ag_update_1d = self.kernels['ag_update_1d']
         nz_idx = self.grad_idx[self.grad_idx < self.key_count]
+        self.lazy_grads.catch_up([self.grads['W'], self.grads['b']], nz_idx)
+        self.lazy_moms.catch_up([self.moms['W'], self.moms['b']], nz_idx)
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
         ag_update_1d(nz_idx, self.params['b'], self.grads['b'], \
                      self.moms['b'], learn_rate)
+        if not (self.max_norm is None):
+            clip_rows(self.params['W'], self.max_norm, nz_idx)
         self.grad_idx = []
         return
 
-    def reset_moms(self, ada_init=1e-3):
+    def reset_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.lazy_moms.fill([self.moms['W'], self.moms['b']], ada_init, lazy)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
+    def reset_grads_and_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.grads['b'] = (0.0 * self.grads['b'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.lazy_grads.fill([self.grads['W'], self.grads['b']], 0.0, lazy)
+        self.lazy_moms.fill([self.moms['W'], self.moms['b']], ada_init, lazy)
         return
 
     def _cleanup(self):
@@ -257,15 +448,26 @@ class HSMLayer:
 #######################
 
 class LUTLayer:
-    def __init__(self, max_key, embed_dim, n_gram=1):
+    def __init__(self, max_key, embed_dim, n_gram=1, mom_dtype=np.float32, \
+                 backend=None):
+        # Get the kernels to use (see CythonFuncs.get_kernels())
+        self.kernels = get_kernels(backend)
         # Set stuff for managing this type of layer
         self.key_count = max_key + 1 # add 1 to accommodate 0 indexing
+        self.mom_dtype = mom_dtype
         self.params = {}
-        self.params['W'] = 0.01 * randn((self.key_count, embed_dim))
+        self.params['W'] = fill_randn(zeros((self.key_count, embed_dim)), 0.01)
         self.grads = {}
         self.grads['W'] = zeros(self.params['W'].shape)
         self.moms = {}
-        self.moms['W'] = zeros(self.params['W'].shape)
+        self.moms['W'] = zeros(self.params['W'].shape, dtype=mom_dtype)
+        # l2 decay is applied lazily, and touched rows of W are clipped to
+        # max_norm after each update (if it's not None)
+        self.lazy_l2 = LazyL2(self.key_count)
+        self.max_norm = None
+        # resets of the grads and moms can be lazy, too
+        self.lazy_grads = LazyFill(self.key_count)
+        self.lazy_moms = LazyFill(self.key_count)
         self.grad_idx = set()
         self.embed_dim = embed_dim
         self.n_gram = n_gram
@@ -275,18 +477,14 @@ class LUTLayer:
 
     def init_params(self, w_scale=0.01):
         """Randomly initialize the weights in this layer."""
-        self.params['W'] = w_scale * randn((self.key_count, self.embed_dim))
-        self.grads['W'] = zeros((self.key_count, self.embed_dim))
+        fill_randn(self.params['W'], w_scale)
+        self.lazy_grads.fill([self.grads['W']], 0.0)
+        self.lazy_l2.reset()
         return
 
-    def clip_params(self, max_norm=5.0):
+    def clip_params(self, max_norm=5.0, rows=None):
         """Bound L2 (row-wise) norm of W by max_norm."""
-        M = self.params['W']
-        m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-        mask = (m_scales < 1.0)
-        mask = mask.astype(np.float32) # why is explicit cast needed?
-        m_scales = (m_scales * mask) + (1.0 - mask)
-        self.params['W'] = M * m_scales[:,np.newaxis]
+        clip_rows(self.params['W'], max_norm, rows)
         return
 
     def feedforward(self, X):
@@ -299,6 +497,10 @@ class LUTLayer:
         self._cleanup()
         # Record the incoming list of row indices to extract
         self.X = X.astype(np.uint32)
+        # Bring the rows to extract up to date with any pending l2 decay, and
+        # with any pending reset of their gradients
+        self.lazy_l2.catch_up([self.params['W']], self.X.ravel())
+        self.lazy_grads.catch_up([self.grads['W']], self.X.ravel())
         # Use look-up table to generate the desired sequences
         if (self.n_gram == 1):
             self.Y = self.params['W'].take(self.X, axis=0)
@@ -313,6 +515,7 @@ class LUTLayer:
     def backprop(self, dLdY):
         """Backprop through this layer.
         """
+        lut_bp = self.kernels['lut_bp']
         assert(np.max(self.X) < self.key_count)
         self.grad_idx.update(self.X.ravel())
         # Add the gradients to the gradient accumulator
@@ -327,28 +530,43 @@ class LUTLayer:
 
     def l2_regularize(self, lam_l2=1e-5):
         """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
+        self.lazy_l2.decay(lam_l2)
         return 1
 
+    def flush_l2(self):
+        """Apply all pending l2 decay, before reading the full params."""
+        self.lazy_l2.catch_up([self.params['W']])
+        return
+
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
+        ag_update_2d = self.kernels['ag_update_2d']
         nz_idx = np.asarray([i for i in self.grad_idx]).astype(np.uint32)
+        self.lazy_grads.catch_up([self.grads['W']], nz_idx)
+        self.lazy_moms.catch_up([self.moms['W']], nz_idx)
         ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
                      self.moms['W'], learn_rate)
+        if not (self.max_norm is None):
+            clip_rows(self.params['W'], self.max_norm, nz_idx)
         self.grad_idx = set()
         return
 
-    def reset_moms(self, ada_init=1e-3):
+    def reset_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
+        self.lazy_moms.fill([self.moms['W']], ada_init, lazy)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
+    def reset_grads_and_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
+        self.lazy_grads.fill([self.grads['W']], 0.0, lazy)
+        self.lazy_moms.fill([self.moms['W']], ada_init, lazy)
         return
 
+    def export_int8(self):
+        """Get an int8 copy of the LUT, for lookups and similarity queries."""
+        self.flush_l2()
+        return QuantizedLUT(self.params['W'])
+
     def _cleanup(self):
         """Cleanup temporary feedforward/backprop stuff."""
         self.X = []
@@ -360,9 +578,13 @@ class LUTLayer:
 ##########################
 
 class CMLayer:
-    def __init__(self, max_key=0, source_dim=0, bias_dim=0, do_rescale=False):
+    def __init__(self, max_key=0, source_dim=0, bias_dim=0, do_rescale=False, \
+                 mom_dtype=np.float32, backend=None):
+        # Get the kernels to use (see CythonFuncs.get_kernels())
+        self.kernels = get_kernels(backend)
         # Set stuff for managing this type of layer
         self.key_count = max_key + 1 # add 1 to accommodate 0 indexing
+        self.mom_dtype = mom_dtype
         self.source_dim = source_dim
         self.bias_dim = bias_dim
         self.do_rescale = do_rescale # set to True for magical fun
@@ -373,13 +595,25 @@ class CMLayer:
         self.grads['Wm'] = zeros(self.params['Wm'].shape)
         self.grads['Wb'] = zeros(self.params['Wb'].shape)
         self.moms = {}
-        self.moms['Wm'] = zeros(self.params['Wm'].shape)
-        self.moms['Wb'] = zeros(self.params['Wb'].shape)
+        self.moms['Wm'] = zeros(self.params['Wm'].shape, dtype=mom_dtype)
+        self.moms['Wb'] = zeros(self.params['Wb'].shape, dtype=mom_dtype)
+        # l2 decay is applied lazily, and touched rows of Wm/Wb are clipped
+        # to max_norm after each update (if it's not None)
+        self.lazy_Wm = LazyL2(self.key_count)
+        self.lazy_Wb = LazyL2(self.key_count)
+        self.max_norm = None
+        # resets of the grads and moms can be lazy, too
+        self.lazy_grads = LazyFill(self.key_count)
+        self.lazy_moms = LazyFill(self.key_count)
         self.grad_idx = set()
+        # Output buffers for the fused feedforward/backprop kernels, which
+        # are reallocated only when the batch size changes
+        self.Y_buf = zeros((0, self.bias_dim + self.source_dim))
+        self.S_buf = zeros((0, self.source_dim))
+        self.dX_buf = zeros((0, self.source_dim))
         # Set common stuff for all types layers
         self.X = []
         self.C = []
-        self.Wm_exp = []
         self.Wm_sig = []
         self.Y = []
         self.dLdX = []
@@ -389,27 +623,26 @@ class CMLayer:
     def init_params(self, w_scale=0.01, param='Wb'):
         """Randomly initialize the weights in this layer."""
         assert((param == 'Wb') or (param == 'Wm'))
+        # bring the other param's grads up to date, so that we can clear the
+        # grads for this param directly
+        self.lazy_grads.catch_up([self.grads['Wm'], self.grads['Wb']])
+        fill_randn(self.params[param], w_scale)
+        self.grads[param].fill(0.0)
         if param == 'Wm':
-            self.params['Wm'] = w_scale * randn((self.key_count, self.source_dim))
-            self.grads['Wm'] = zeros(self.params['Wm'].shape)
+            self.lazy_Wm.reset()
         else:
-            self.params['Wb'] = w_scale * randn((self.key_count, self.bias_dim))
-            self.grads['Wb'] = zeros(self.params['Wb'].shape)
+            self.lazy_Wb.reset()
         return
 
-    def clip_params(self, Wm_norm=5.0, Wb_norm=5.0):
+    def clip_params(self, Wm_norm=5.0, Wb_norm=5.0, rows=None):
         """Bound L2 (row-wise) norm of Wm and Wb by max_norm."""
         for (param, max_norm) in zip(['Wm','Wb'],[Wm_norm, Wb_norm]):
-            M = self.params[param]
-            m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-            mask = (m_scales < 1.0)
-            mask = mask.astype(np.float32) # why is explicit cast needed?
-            m_scales = (m_scales * mask) + (1.0 - mask)
-            self.params[param] = M * m_scales[:,np.newaxis]
+            clip_rows(self.params[param], max_norm, rows)
         return
 
     def norm_info(self, param_name='Wm'):
         """Diagnostic info about norms of W's rows."""
+        self.flush_l2()
         M = self.params[param_name]
         row_norms = np.sqrt(np.sum(M**2.0, axis=1))
         men_n = np.mean(row_norms)
@@ -419,62 +652,79 @@ class CMLayer:
         info = {'mean': men_n, 'min': min_n, 'median': med_n, 'max': max_n}
         return info
 
+    def _batch_bufs(self, batch_size, in_dim):
+        """Get output buffers with room for a batch of the given size."""
+        if (self.S_buf.shape != (batch_size, in_dim)):
+            self.Y_buf = zeros((batch_size, self.bias_dim + in_dim))
+            self.S_buf = zeros((batch_size, in_dim))
+            self.dX_buf = zeros((batch_size, in_dim))
+        return self.Y_buf, self.S_buf, self.dX_buf
+
     def feedforward(self, X, C):
         """Run feedforward for this layer.
+
+        The returned matrix is a buffer owned by this layer, which will be
+        overwritten by the next call to feedforward.
         """
+        cm_ff = self.kernels['cm_ff']
         # Cleanup debris from any previous feedforward
         self._cleanup()
         assert ((self.bias_dim >= 5) or (self.source_dim >= 5))
         # Record the incoming list of row indices to extract
-        self.X = X
-        self.C = C.astype(np.uint32)
-        # Extract the relevant bias parameter rows
-        Wb = self.params['Wb'].take(C, axis=0)
-        if (self.bias_dim < 5):
-            # No context-adaptive bias term should be applied if self.bias_dim
-            # is < 5. I.e. only information coming up from the word LUT, and
-            # possibly rescaled by this layer, should be used in prediction.
-            Wb = zeros(Wb.shape)
-        # Get the feature re-weighting and bias adjustment parameters
+        self.X = np.ascontiguousarray(X, dtype=np.float32)
+        self.C = np.ascontiguousarray(C, dtype=np.uint32)
+        # Bring the rows to extract up to date with any pending l2 decay, and
+        # with any pending reset of their gradients
+        self.lazy_Wm.catch_up([self.params['Wm']], self.C.ravel())
+        self.lazy_Wb.catch_up([self.params['Wb']], self.C.ravel())
+        self.lazy_grads.catch_up([self.grads['Wm'], self.grads['Wb']], \
+                self.C.ravel())
+        # No context-adaptive bias term should be applied if self.bias_dim
+        # is < 5. I.e. only information coming up from the word LUT, and
+        # possibly rescaled by this layer, should be used in prediction.
+        use_bias = 1 if (self.bias_dim >= 5) else 0
+        # Information from the word LUT should not pass through this
+        # layer when source_dim < 5 and we're rescaling. In this case, we
+        # assume that we are meant to do prediction using only the
+        # context-adaptive biases.
         if self.do_rescale:
-            Wm = self.params['Wm'].take(C, axis=0)
-            self.Wm_exp = ne.evaluate('exp(Wm)', optimization='aggressive')
-            self.Wm_sig = self.Wm_exp / (1.0 + self.Wm_exp)
-            if (self.source_dim < 5):
-                # Information from the word LUT should not pass through this
-                # layer. When source_dim < 5, we assume that we are meant to
-                # do prediction using only the context-adaptive biases.
-                self.Wm_exp = ones(Wm.shape)
-                self.Wm_sig = zeros(Wm.shape)
+            # the rescaling params only fit inputs of width source_dim
+            assert (self.X.shape[1] == self.source_dim)
+            sig_mode = 1 if (self.source_dim >= 5) else 2
         else:
-            self.Wm_sig = ones(X.shape)
-        # Modify X by augmenting a multi-dimensional bias and rescaling
-        self.Y = np.hstack((Wb, (X * self.Wm_sig)))
+            sig_mode = 0
+        # Gather, rescale and concatenate, straight into the output buffer
+        self.Y, self.Wm_sig, self.dLdX = self._batch_bufs(self.X.shape[0], \
+                                                          self.X.shape[1])
+        cm_ff(self.C, self.X, self.params['Wm'], self.params['Wb'], \
+              self.Wm_sig, self.Y, use_bias, sig_mode)
         return self.Y
 
     def backprop(self, dLdY):
         """Backprop through this layer.
+
+        The returned matrix is a buffer owned by this layer, which will be
+        overwritten by the next call to backprop.
         """
+        cm_bp = self.kernels['cm_bp']
         # Add the gradients to the gradient accumulators
         assert (np.max(self.C) < self.key_count)
         self.grad_idx.update(self.C.ravel())
-        self.dLdY = dLdY
-        dLdYb, dLdYw = np.hsplit(dLdY, [self.bias_dim])
-        dLdYb = dLdYb.copy() # copy, because hsplit leaves the new arrays in
-                             # the same memory as the split array, which is
-                             # not good for the BLAS calls used by the Cython
-                             # version of lut_bp, which expect input arrays
-                             # that are in contiguous memory
-        if self.do_rescale:
-            dLdW = (self.Wm_sig / self.Wm_exp) * self.X * dLdYw
-            lut_bp(self.C, dLdW, self.grads['Wm'])
-        lut_bp(self.C, dLdYb, self.grads['Wb'])
-        dLdX = self.Wm_sig * dLdYw
-        return dLdX
+        self.dLdY = np.ascontiguousarray(dLdY, dtype=np.float32)
+        # Scatter the gradients for the bias and rescaling parameters straight
+        # into the accumulators, and compute the gradient for the input. When
+        # source_dim < 5 the input is blocked, so there's no grad for Wm.
+        do_Wm = 1 if (self.do_rescale and (self.source_dim >= 5)) else 0
+        cm_bp(self.C, self.X, self.Wm_sig, self.dLdY, self.grads['Wm'], \
+              self.grads['Wb'], self.dLdX, do_Wm)
+        return self.dLdX
 
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
+        ag_update_2d = self.kernels['ag_update_2d']
         nz_idx = np.asarray([i for i in self.grad_idx]).astype(np.uint32)
+        self.lazy_grads.catch_up([self.grads['Wm'], self.grads['Wb']], nz_idx)
+        self.lazy_moms.catch_up([self.moms['Wm'], self.moms['Wb']], nz_idx)
         # Information from the word LUT should not pass through this
         # layer when source_dim < 5. In this case, we assume that we
         # will do prediction using only the context-adaptive biases.
@@ -488,34 +738,38 @@ class CMLayer:
         b_rate = learn_rate if (self.bias_dim >= 5) else 0.0
         ag_update_2d(nz_idx, self.params['Wb'], self.grads['Wb'], \
                      self.moms['Wb'], b_rate)
+        if not (self.max_norm is None):
+            self.clip_params(self.max_norm, self.max_norm, nz_idx)
         self.grad_idx = set()
         return
 
     def l2_regularize(self, lam_Wm=1e-5, lam_Wb=1e-5):
         """Add gradients for l2 regularization."""
-        self.params['Wm'] -= lam_Wm * self.params['Wm']
-        self.params['Wb'] -= lam_Wb * self.params['Wb']
+        self.lazy_Wm.decay(lam_Wm)
+        self.lazy_Wb.decay(lam_Wb)
         return 1
 
-    def reset_moms(self, ada_init=1e-3):
+    def flush_l2(self):
+        """Apply all pending l2 decay, before reading the full params."""
+        self.lazy_Wm.catch_up([self.params['Wm']])
+        self.lazy_Wb.catch_up([self.params['Wb']])
+        return
+
+    def reset_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.moms['Wm'] = (0.0 * self.moms['Wm']) + ada_init
-        self.moms['Wb'] = (0.0 * self.moms['Wb']) + ada_init
+        self.lazy_moms.fill([self.moms['Wm'], self.moms['Wb']], ada_init, lazy)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
+    def reset_grads_and_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.grads['Wm'] = (0.0 * self.grads['Wm'])
-        self.grads['Wb'] = (0.0 * self.grads['Wb'])
-        self.moms['Wm'] = (0.0 * self.moms['Wm']) + ada_init
-        self.moms['Wb'] = (0.0 * self.moms['Wb']) + ada_init
+        self.lazy_grads.fill([self.grads['Wm'], self.grads['Wb']], 0.0, lazy)
+        self.lazy_moms.fill([self.moms['Wm'], self.moms['Wb']], ada_init, lazy)
         return
 
     def _cleanup(self):
         """Cleanup temporary feedforward/backprop stuff."""
         self.X = []
         self.Y = []
-        self.Wm_exp = []
         self.Wm_sig = []
         self.dLdX = []
         self.dLdY = []
@@ -526,12 +780,24 @@ class CMLayer:
 ##########################
 
 class NoiseLayer:
-    def __init__(self, drop_rate=0.0, fuzz_scale=0.0):
+    def __init__(self, drop_rate=0.0, fuzz_scale=0.0, seed=None, backend=None):
+        # Get the kernels to use (see CythonFuncs.get_kernels())
+        self.kernels = get_kernels(backend)
         # Set stuff required for managing this type of layer
-        self.dYdX = []
         self.drop_rate = drop_rate
         self.drop_scale = 1.0 / (1.0 - drop_rate)
         self.fuzz_scale = fuzz_scale
+        # Noise comes from a counter-based RNG, so it's fully determined by
+        # the seed and the number of rows fed forward so far
+        if seed is None:
+            seed = npr.randint(0, high=2**31)
+        self.rng_seed = seed
+        self.rng_counter = 0
+        # Keep/drop mask and output buffers, which are reallocated only when
+        # the batch shape changes
+        self.M_buf = np.zeros((0, 0), dtype=np.uint8)
+        self.Y_buf = zeros((0, 0))
+        self.dX_buf = zeros((0, 0))
         # Set stuff common to all layer types
         self.X = []
         self.Y = []
@@ -545,40 +811,59 @@ class NoiseLayer:
         self.fuzz_scale = fuzz_scale
         return
 
+    def _noise_settings(self):
+        """Get (do_drop, keep_scale, fuzz_c) for the noise kernels."""
+        do_drop = (self.drop_rate > 1e-4)
+        keep_scale = self.drop_scale if do_drop else 1.0
+        fuzz_c = 0.0
+        if (self.fuzz_scale > 1e-4):
+            fuzz_c = self.fuzz_scale / self.drop_scale
+        return do_drop, keep_scale, fuzz_c
+
     def feedforward(self, X):
         """Perform feedforward through this layer.
+
+        When there's any noise to apply, the returned matrix is a buffer
+        owned by this layer, which will be overwritten by the next call to
+        feedforward.
         """
+        noise_ff = self.kernels['noise_ff']
         # Cleanup debris from any previous feedforward
         self._cleanup()
-        # Record (a pointer to) the passed input
-        self.X = X
-        # Generate and apply a dropout mask to the input
-        if (self.drop_rate > 1e-4):
-            drop_mask = self.drop_scale * \
-                    (npr.rand(self.X.shape[0], self.X.shape[1]) > self.drop_rate)
-        else:
-            drop_mask = ones((self.X.shape[0], self.X.shape[1]))
-        self.dYdX = drop_mask
-        if (self.fuzz_scale > 1e-4):
-            fuzz_bump = (self.fuzz_scale / self.drop_scale) * \
-                    npr.randn(self.X.shape[0], self.X.shape[1])
-            self.Y = drop_mask * (self.X + fuzz_bump)
-        else:
-            self.Y = drop_mask * self.X
-        return self.Y.astype(np.float32)
+        self.X = np.ascontiguousarray(X, dtype=np.float32)
+        do_drop, keep_scale, fuzz_c = self._noise_settings()
+        if not (do_drop or (fuzz_c > 0.0)):
+            self.Y = self.X
+            return self.Y
+        if (self.Y_buf.shape != self.X.shape):
+            self.M_buf = np.zeros(self.X.shape, dtype=np.uint8)
+            self.Y_buf = zeros(self.X.shape)
+            self.dX_buf = zeros(self.X.shape)
+        # Draw the mask and fuzz, and apply them, in a single pass
+        noise_ff(self.X, self.M_buf, self.Y_buf, self.rng_seed, \
+                 self.rng_counter, int(do_drop), self.drop_rate, \
+                 keep_scale, fuzz_c)
+        self.rng_counter += self.X.shape[0]
+        self.Y = self.Y_buf
+        return self.Y
 
     def backprop(self, dLdY):
         """Perform backprop through this layer.
         """
+        noise_bp = self.kernels['noise_bp']
         # Backprop is just multiplication by the mask from feedforward
-        dLdX = dLdY * self.dYdX
-        return dLdX.astype(np.float32)
+        if (self.Y is self.X):
+            return np.ascontiguousarray(dLdY, dtype=np.float32)
+        do_drop, keep_scale, fuzz_c = self._noise_settings()
+        self.dLdY = np.ascontiguousarray(dLdY, dtype=np.float32)
+        noise_bp(self.dLdY, self.M_buf, self.dX_buf, keep_scale)
+        return self.dX_buf
 
     def _cleanup(self):
         """Clear all temp variables for this layer."""
         self.X = []
         self.Y = []
-        self.dYdX = []
+        self.dLdY = []
         return
 
 #########################
@@ -622,129 +907,258 @@ class TanhLayer:
 ################################
 
 class W2VLayer:
-    def __init__(self, max_word_key=0, word_dim=0, lam_l2=1e-3):
+    def __init__(self, max_word_key=0, word_dim=0, lam_l2=1e-3, \
+                 mom_dtype=np.float32, backend=None):
+        # Get the kernels to use (see CythonFuncs.get_kernels())
+        self.kernels = get_kernels(backend)
         # Set basic layer parameters. The max_word_key passed as an argument
         # is incremented by 1 to accommodate 0 indexing.
         self.word_dim = word_dim
         self.word_count = max_word_key + 1
         # Initialize arrays for tracking parameters, gradients, and
-        # adagrad "momentums" (i.e. sums of squared gradients).
+        # adagrad "momentums" (i.e. sums of squared gradients). The moments
+        # can be stored as float16, to save memory for large vocabularies.
+        self.mom_dtype = mom_dtype
         self.params = {}
-        self.params['Wa'] = 0.01 * randn((self.word_count, word_dim))
-        self.params['Wc'] = 0.01 * randn((self.word_count, word_dim))
+        self.params['Wa'] = fill_randn(zeros((self.word_count, word_dim)), 0.01)
+        self.params['Wc'] = fill_randn(zeros((self.word_count, word_dim)), 0.01)
         self.params['b'] = zeros((self.word_count,))
         self.grads = {}
         self.grads['Wa'] = zeros((self.word_count, word_dim))
         self.grads['Wc'] = zeros((self.word_count, word_dim))
         self.grads['b'] = zeros((self.word_count,))
         self.moms = {}
-        self.moms['Wa'] = zeros((self.word_count, word_dim))
-        self.moms['Wc'] = zeros((self.word_count, word_dim))
-        self.moms['b'] = zeros((self.word_count,))
-        # Set l2 regularization parameter
+        self.moms['Wa'] = zeros((self.word_count, word_dim), dtype=mom_dtype)
+        self.moms['Wc'] = zeros((self.word_count, word_dim), dtype=mom_dtype)
+        self.moms['b'] = zeros((self.word_count,), dtype=mom_dtype)
+        # Set l2 regularization parameter. The l2 decay is applied lazily,
+        # and touched rows of Wa/Wc are clipped to max_norm after each update
+        # (if it's not None).
         self.lam_l2 = lam_l2
+        self.lazy_Wa = LazyL2(self.word_count)
+        self.lazy_Wc = LazyL2(self.word_count)
+        self.max_norm = None
+        # resets of the grads and moms can be lazy, too. Wa's rows are used
+        # by anchor words, and Wc/b's rows by the predicted words.
+        self.lazy_grads_a = LazyFill(self.word_count)
+        self.lazy_grads_c = LazyFill(self.word_count)
+        self.lazy_moms_a = LazyFill(self.word_count)
+        self.lazy_moms_c = LazyFill(self.word_count)
         # Initialize sets for tracking which words we have trained
         self.trained_Wa = set()
         self.trained_Wc = set()
+        # Buffers for the averaged context vectors (and their gradients) in
+        # CBOW batches, which are reallocated only when the batch size changes
+        self.H_buf = zeros((0, word_dim))
+        self.dH_buf = zeros((0, word_dim))
+        self.L_buf = zeros((0,))
+        # target signs for the pos/neg keys, reallocated when their shape
+        # changes
+        self.pn_sign = zeros((0, 0))
+        # Timers for the phases of batch_train*(), which are off by default
+        # (a W2VModel shares its profiler with this layer)
+        self.prof = PhaseProfiler(enabled=False)
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
         """Randomly initialize the weights in this layer."""
-        self.params['Wa'] = w_scale * randn((self.word_count, self.word_dim))
-        self.grads['Wa'] = zeros((self.word_count, self.word_dim))
-        self.moms['Wa'] = zeros((self.word_count, self.word_dim)) + 1e-3
-        self.params['Wc'] = w_scale * randn((self.word_count, self.word_dim))
-        self.grads['Wc'] = zeros((self.word_count, self.word_dim))
-        self.moms['Wc'] = zeros((self.word_count, self.word_dim)) + 1e-3
-        self.params['b'] = zeros((self.word_count,))
-        self.grads['b'] = zeros((self.word_count,))
-        self.moms['b'] = zeros((self.word_count,)) + 1e-3
+        fill_randn(self.params['Wa'], w_scale)
+        fill_randn(self.params['Wc'], w_scale)
+        self.params['b'].fill(0.0)
+        self.reset_grads_and_moms(ada_init=1e-3)
+        self.lazy_Wa.reset()
+        self.lazy_Wc.reset()
         return
 
-    def clip_params(self, max_norm=5.0):
+    def clip_params(self, max_norm=5.0, Wa_rows=None, Wc_rows=None):
         """Bound L2 (row-wise) norm of Wa and Wc by max_norm."""
-        for param in ['Wa', 'Wc']:
-            M = self.params[param]
-            m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
-            mask = (m_scales < 1.0)
-            mask = mask.astype(np.float32) # why is explicit cast needed?
-            m_scales = (m_scales * mask) + (1.0 - mask)
-            self.params[param] = M * m_scales[:,np.newaxis]
+        clip_rows(self.params['Wa'], max_norm, Wa_rows)
+        clip_rows(self.params['Wc'], max_norm, Wc_rows)
         return
 
     def l2_regularize(self, lam_l2=1e-5):
         """Add gradients for l2 regularization. And compute loss."""
-        self.params['Wa'] -= lam_l2 * self.params['Wa']
-        self.params['Wc'] -= lam_l2 * self.params['Wc']
+        self.lazy_Wa.decay(lam_l2)
+        self.lazy_Wc.decay(lam_l2)
         return 1
 
-    def batch_train(self, anc_idx, pos_idx, neg_idx, learn_rate=1e-3):
+    def flush_l2(self):
+        """Apply all pending l2 decay, before reading the full params."""
+        self.lazy_Wa.catch_up([self.params['Wa']])
+        self.lazy_Wc.catch_up([self.params['Wc']])
+        return
+
+    def batch_train(self, anc_idx, pos_idx, neg_idx=None, learn_rate=1e-3):
         """Perform a batch update of all parameters based on the given sets
-        of anchor, positive example, and negative example indices.
+        of anchor, positive example, and negative example indices. If neg_idx
+        is None, pos_idx should hold positives and negatives, as given by
+        NegSampler.sample_pn().
         """
+        w2v_ff_bp = self.kernels['w2v_ff_bp']
         # Force incoming LUT indices to the right type (i.e. np.uint32)
-        anc_idx = anc_idx.astype(np.uint32)
-        pos_idx = pos_idx[:,np.newaxis]
-        pn_idx = np.hstack((pos_idx, neg_idx)).astype(np.uint32)
-        pn_sign = -1.0 * ones(pn_idx.shape)
-        pn_sign[:,0] = 1.0
+        anc_idx = anc_idx.astype(np.uint32, copy=False)
+        pn_idx, pn_sign = self._pn_keys_and_signs(pos_idx, neg_idx)
+        prof = self.prof
+        prof.start('reg')
+        self._catch_up_l2(anc_idx, pn_idx)
+        prof.stop('reg')
+        prof.start('update')
+        self._catch_up_grads(anc_idx, pn_idx)
+        prof.stop('update')
         L = zeros((1,))
         # Do feedforward and backprop through the predictor/predictee tables
+        prof.start('ff_bp')
         w2v_ff_bp(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
                   self.params['Wc'], self.params['b'], self.grads['Wa'], \
                   self.grads['Wc'], self.grads['b'], L, 1)
+        prof.stop('ff_bp')
         L = L[0]
         # Apply gradients to (touched only) look-up-table parameters
-        a_mod_idx = np.unique(anc_idx)
-        c_mod_idx = np.unique(pn_idx)
+        prof.start('update')
+        self._apply_grads(np.unique(anc_idx), np.unique(pn_idx), learn_rate)
+        prof.stop('update')
+        return L
+
+    def batch_train_cbow(self, ctx_idx, ctx_lens, pos_idx, neg_idx=None, \
+                         learn_rate=1e-3):
+        """Perform a CBOW batch update of all parameters. Row i of ctx_idx
+        holds the keys of the ctx_lens[i] words in a target word's window
+        (followed by padding), as given by PhraseSampler.sample_cbow(). The
+        target words and their negatives are given by pos_idx and neg_idx,
+        like for batch_train(). The context words' rows of Wa are averaged
+        into a single anchor vector for each target.
+        """
+        cbow_ff_bp = self.kernels['cbow_ff_bp']
+        ctx_idx = ctx_idx.astype(np.uint32, copy=False)
+        ctx_lens = ctx_lens.astype(np.uint32, copy=False)
+        pn_idx, pn_sign = self._pn_keys_and_signs(pos_idx, neg_idx)
+        # only the packed (non-padding) context keys are used
+        ctx_mask = np.arange(ctx_idx.shape[1]) < ctx_lens[:,np.newaxis]
+        anc_idx = ctx_idx[ctx_mask]
+        prof = self.prof
+        prof.start('reg')
+        self._catch_up_l2(anc_idx, pn_idx)
+        prof.stop('reg')
+        prof.start('update')
+        self._catch_up_grads(anc_idx, pn_idx)
+        prof.stop('update')
+        H, dH, L = self._cbow_bufs(ctx_idx.shape[0])
+        # Do feedforward and backprop through the predictor/predictee tables
+        prof.start('ff_bp')
+        cbow_ff_bp(ctx_idx, ctx_lens, pn_idx, pn_sign, self.params['Wa'], \
+                   self.params['Wc'], self.params['b'], H, dH, \
+                   self.grads['Wa'], self.grads['Wc'], self.grads['b'], L, 1)
+        prof.stop('ff_bp')
+        L = np.sum(L)
+        # Apply gradients to (touched only) look-up-table parameters
+        prof.start('update')
+        self._apply_grads(np.unique(anc_idx), np.unique(pn_idx), learn_rate)
+        prof.stop('update')
+        return L
+
+    def _pn_keys_and_signs(self, pos_idx, neg_idx):
+        """Get the pos/neg key matrix and its signs, reusing self.pn_sign."""
+        pn_idx, self.pn_sign = pn_keys_and_signs(pos_idx, neg_idx, \
+                self.pn_sign)
+        return [pn_idx, self.pn_sign]
+
+    def _cbow_bufs(self, batch_size):
+        """Get the averaged context buffers for a CBOW batch of this size."""
+        if (self.H_buf.shape[0] != batch_size):
+            self.H_buf = zeros((batch_size, self.word_dim))
+            self.dH_buf = zeros((batch_size, self.word_dim))
+            self.L_buf = zeros((batch_size,))
+        return self.H_buf, self.dH_buf, self.L_buf
+
+    def _apply_grads(self, a_mod_idx, c_mod_idx, learn_rate):
+        """Apply adagrad updates to the given (unique) rows of Wa and Wc/b."""
+        ag_update_2d = self.kernels['ag_update_2d']
+        ag_update_1d = self.kernels['ag_update_1d']
+        self.lazy_moms_a.catch_up([self.moms['Wa']], a_mod_idx)
+        self.lazy_moms_c.catch_up([self.moms['Wc'], self.moms['b']], c_mod_idx)
         ag_update_2d(a_mod_idx, self.params['Wa'], self.grads['Wa'], \
                 self.moms['Wa'], learn_rate)
         ag_update_2d(c_mod_idx, self.params['Wc'], self.grads['Wc'], \
                 self.moms['Wc'], learn_rate)
         ag_update_1d(c_mod_idx, self.params['b'], self.grads['b'], \
                 self.moms['b'], learn_rate)
-        return L
+        if not (self.max_norm is None):
+            self.clip_params(self.max_norm, a_mod_idx, c_mod_idx)
+        return
 
-    def batch_test(self, anc_idx, pos_idx, neg_idx):
+    def batch_test(self, anc_idx, pos_idx, neg_idx=None):
         """Run a batch through the model, computing losses but not grads.
         """
-        anc_idx = anc_idx.astype(np.uint32)
-        pos_idx = pos_idx[:,np.newaxis]
-        pn_idx = np.hstack((pos_idx, neg_idx)).astype(np.uint32)
-        pn_sign = ones(pn_idx.shape)
-        pn_sign[:,0] = -1.0
-        L = zeros((1,))
-        # Do feedforward and backprop through the predictor/predictee tables
-        w2v_ff_bp(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
-               self.params['Wc'], self.params['b'], self.grads['Wa'], \
-               self.grads['Wc'], self.grads['b'], L, 0)
-        self.grads['Wa'] = 0.0 * self.grads['Wa']
-        self.grads['Wc'] = 0.0 * self.grads['Wc']
-        self.grads['b'] = 0.0 * self.grads['b']
-        L = L[0]
+        return np.sum(self.batch_loss(anc_idx, pos_idx, neg_idx))
+
+    def batch_loss(self, anc_idx, pos_idx, neg_idx=None):
+        """Get the loss for each of a batch of anchor/target examples (given
+        like for batch_train()). This only runs feedforward, so it doesn't
+        touch the grads, and it can be used on large (e.g. held-out) batches.
+        """
+        w2v_loss = self.kernels['w2v_loss']
+        anc_idx = anc_idx.astype(np.uint32, copy=False)
+        pn_idx, pn_sign = self._pn_keys_and_signs(pos_idx, neg_idx)
+        self._catch_up_l2(anc_idx, pn_idx)
+        L = zeros((anc_idx.shape[0],))
+        w2v_loss(anc_idx, pn_idx, pn_sign, self.params['Wa'], \
+                 self.params['Wc'], self.params['b'], L)
         return L
 
-    def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization."""
-        self.params['Wa'] -= lam_l2 * self.params['Wa']
-        self.params['Wc'] -= lam_l2 * self.params['Wc']
+    def batch_test_cbow(self, ctx_idx, ctx_lens, pos_idx, neg_idx=None):
+        """Run a CBOW batch through the model, computing losses but not grads.
+        """
+        L = self.batch_loss_cbow(ctx_idx, ctx_lens, pos_idx, neg_idx)
+        return np.sum(L)
+
+    def batch_loss_cbow(self, ctx_idx, ctx_lens, pos_idx, neg_idx=None):
+        """Get the loss for each of a batch of CBOW examples (given like for
+        batch_train_cbow()), running feedforward only.
+        """
+        cbow_loss = self.kernels['cbow_loss']
+        ctx_idx = ctx_idx.astype(np.uint32, copy=False)
+        ctx_lens = ctx_lens.astype(np.uint32, copy=False)
+        pn_idx, pn_sign = self._pn_keys_and_signs(pos_idx, neg_idx)
+        ctx_mask = np.arange(ctx_idx.shape[1]) < ctx_lens[:,np.newaxis]
+        self._catch_up_l2(ctx_idx[ctx_mask], pn_idx)
+        H = zeros((ctx_idx.shape[0], self.word_dim))
+        L = zeros((ctx_idx.shape[0],))
+        cbow_loss(ctx_idx, ctx_lens, pn_idx, pn_sign, self.params['Wa'], \
+                  self.params['Wc'], self.params['b'], H, L)
+        return L
+
+    def _catch_up_l2(self, anc_idx, pn_idx):
+        """Bring the rows used by a batch up to date with pending l2 decay."""
+        self.lazy_Wa.catch_up([self.params['Wa']], anc_idx.ravel())
+        self.lazy_Wc.catch_up([self.params['Wc']], pn_idx.ravel())
         return
 
-    def reset_moms(self, ada_init=1e-3):
+    def _catch_up_grads(self, anc_idx, pn_idx):
+        """Bring the grads for rows a batch will train up to date with any
+        pending (lazy) reset.
+        """
+        self.lazy_grads_a.catch_up([self.grads['Wa']], anc_idx.ravel())
+        self.lazy_grads_c.catch_up([self.grads['Wc'], self.grads['b']], \
+                pn_idx.ravel())
+        return
+
+    def export_int8(self, param='Wa'):
+        """Get an int8 copy of Wa/Wc, for lookups and similarity queries."""
+        assert((param == 'Wa') or (param == 'Wc'))
+        self.flush_l2()
+        return QuantizedLUT(self.params[param])
+
+    def reset_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.moms['Wa'] = (0.0 * self.moms['Wa']) + ada_init
-        self.moms['Wc'] = (0.0 * self.moms['Wc']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.lazy_moms_a.fill([self.moms['Wa']], ada_init, lazy)
+        self.lazy_moms_c.fill([self.moms['Wc'], self.moms['b']], ada_init, lazy)
         return
 
-    def reset_grads_and_moms(self, ada_init=1e-3):
+    def reset_grads_and_moms(self, ada_init=1e-3, lazy=False):
         """Reset the gradient accumulators for this layer."""
-        self.grads['Wa'] = (0.0 * self.grads['Wa']) + ada_init
-        self.grads['Wc'] = (0.0 * self.grads['Wc']) + ada_init
-        self.grads['b'] = (0.0 * self.grads['b']) + ada_init
-        self.moms['Wa'] = (0.0 * self.moms['Wa']) + ada_init
-        self.moms['Wc'] = (0.0 * self.moms['Wc']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.lazy_grads_a.fill([self.grads['Wa']], 0.0, lazy)
+        self.lazy_grads_c.fill([self.grads['Wc'], self.grads['b']], 0.0, lazy)
+        self.reset_moms(ada_init, lazy)
         return
 
 ###################################
@@ -1,8 +1,10 @@
+import time
 import numpy as np
 import numpy.random as npr
 import NLMLayers as nlml
 import cPickle as pickle
-from HelperFuncs import zeros, ones, randn, rand_word_seqs
+from HelperFuncs import zeros, ones, randn, rand_word_seqs, QuantizedLUT, \
+                        PhaseProfiler
 import CorpusUtils as cu
 
 class PVModel:
@@ -41,7 +43,7 @@ class PVModel:
         self.lam_wv = lam_wv
         self.lam_cv = lam_cv
         self.lam_cl = lam_cl
-        self.reg_freq = 20
+        self.reg_freq = 1 # l2 decay is lazy, so it's cheap to do every batch
         # Set noise layer parameters (for better regularization, perhaps)
         self.drop_rate = 0.0
         self.fuzz_scale = 0.0
@@ -57,6 +59,8 @@ class PVModel:
         self.class_layer = nlml.HSMLayer(\
                 in_dim=(self.cv_dim + (self.pre_words * self.wv_dim)), \
                 max_hs_key=self.max_hs_key)
+        # Per-phase timers for training, off unless set_profiler() is called
+        self.prof = PhaseProfiler(enabled=False)
         return
 
     def set_noise(self, drop_rate=0.0, fuzz_scale=0.0):
@@ -74,11 +78,16 @@ class PVModel:
         self.class_layer.init_params(weight_scale)
         return
 
-    def reset_moms(self, ada_init=1e-3):
+    def reset_moms(self, ada_init=1e-3, lazy=False):
         """Reset the adagrad "momentums" in each layer."""
-        self.word_layer.reset_moms(ada_init)
-        self.context_layer.reset_moms(ada_init)
-        self.class_layer.reset_moms(ada_init)
+        self.word_layer.reset_moms(ada_init, lazy)
+        self.context_layer.reset_moms(ada_init, lazy)
+        self.class_layer.reset_moms(ada_init, lazy)
+        return
+
+    def set_profiler(self, prof):
+        """Time the phases of training with the given PhaseProfiler."""
+        self.prof = prof
         return
 
     def batch_update(self, pre_keys, post_code_keys, post_code_signs, \
@@ -97,27 +106,36 @@ class PVModel:
             train_cls: train the hierarchical softmax parameters
             learn_rate: learning rate to use in parameter updates
         """
+        prof = self.prof
         # Feedforward through look-up-table, noise, and prediction layers
+        prof.start('ff')
         Xw = self.word_layer.feedforward(pre_keys)
         Xc = self.context_layer.feedforward(Xw, phrase_keys)
         Xn = self.noise_layer.feedforward(Xc)
+        prof.stop('ff')
 
         # Turn the corner with feedforward and backprop at class layer
+        prof.start('ff_bp')
         dLdXn, L = self.class_layer.ff_bp(Xn, post_code_keys, \
                 post_code_signs, do_grad=True)
+        prof.stop('ff_bp')
 
         # Backprop through remaining layers
+        prof.start('bp')
         dLdXc = self.noise_layer.backprop(dLdXn)
         dLdXw = self.context_layer.backprop(dLdXc)
         self.word_layer.backprop(dLdXw)
+        prof.stop('bp')
 
         # Apply the gradient updates computed during backprop
+        prof.start('update')
         if train_ctx:
             self.context_layer.apply_grad(learn_rate=learn_rate)
         if train_lut:
             self.word_layer.apply_grad(learn_rate=learn_rate)
         if train_cls:
             self.class_layer.apply_grad(learn_rate=learn_rate)
+        prof.stop('update')
         return L
 
     def train(self, ngram_sampler, hsm_code_keys, hsm_code_signs, batch_size, \
@@ -139,22 +157,25 @@ class PVModel:
             learn_rate: learning rate to use for updates
         """
         L = 0.0
-        self.word_layer.reset_moms(ada_init=1.0)
-        self.context_layer.reset_moms(ada_init=1.0)
-        self.class_layer.reset_moms(ada_init=1.0)
+        # resets are lazy, so only rows that get trained are touched
+        self.reset_moms(ada_init=1.0, lazy=True)
         pad_key = np.asarray([0]).astype(np.uint32)
+        prof = self.prof
         print("Training all parameters:")
         for b in range(batch_count):
+            prof.start('sample')
             [seq_keys, phrase_keys] = ngram_sampler.sample_ngrams( \
                 batch_size, gram_n=self.pre_words+1, pad_key=self.max_wv_key)
             pre_keys = seq_keys[:,0:-1]
             post_keys = seq_keys[:,-1]
             post_code_keys = hsm_code_keys.take(post_keys,axis=0)
             post_code_signs = hsm_code_signs.take(post_keys,axis=0)
+            prof.stop('sample')
             L += self.batch_update(pre_keys, post_code_keys, post_code_signs, \
                     phrase_keys, train_ctx=train_ctx, train_lut=train_lut, \
                     train_cls=train_cls, learn_rate=learn_rate)
-            # apply l2 regularization, but not every round (to save flops)
+            # apply l2 regularization (lazily, to touched rows only)
+            prof.start('reg')
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 reg_rate = learn_rate * self.reg_freq
                 if train_lut:
@@ -164,6 +185,9 @@ class PVModel:
                 if train_ctx:
                     self.context_layer.l2_regularize(lam_Wm=(reg_rate*self.lam_cv), \
                                                     lam_Wb=(reg_rate*self.lam_cv))
+            prof.stop('reg')
+            prof.count('samples', batch_size)
+            prof.end_batch()
             # diagnostic display stuff...
             if ((b > 1) and ((b % 1000) == 0)):
                 Wm_info = self.context_layer.norm_info('Wm')
@@ -173,6 +197,7 @@ class PVModel:
                 obs_count = 250.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        prof.flush()
         return
 
     def infer_context_vectors(self, ngram_sampler, hsm_code_keys, hsm_code_signs, \
@@ -202,22 +227,29 @@ class PVModel:
         # Update the context vectors in the new context layer for some number
         # of minibatch update rounds
         L = 0.0
+        prof = self.prof
         print("Training new context vectors:")
         for b in range(batch_count):
+            prof.start('sample')
             seq_keys, phrase_keys = ngram_sampler.sample_ngrams(batch_size, \
                     gram_n=self.pre_words+1, pad_key=self.max_wv_key)
             pre_keys = seq_keys[:,0:-1]
             post_keys = seq_keys[:,-1]
             post_code_keys = hsm_code_keys.take(post_keys,axis=0)
             post_code_signs = hsm_code_signs.take(post_keys,axis=0)
+            prof.stop('sample')
             L += self.batch_update(pre_keys, post_code_keys, post_code_signs, \
                     phrase_keys, train_ctx=True, train_lut=False, \
                     train_cls=False, learn_rate=learn_rate)
-            # apply l2 regularization, but not every round (to save flops)
+            # apply l2 regularization (lazily, to touched rows only)
+            prof.start('reg')
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 reg_rate = learn_rate * self.reg_freq
                 self.context_layer.l2_regularize(lam_Wm=(reg_rate*self.lam_cv), \
                                                  lam_Wb=(reg_rate*self.lam_cv))
+            prof.stop('reg')
+            prof.count('samples', batch_size)
+            prof.end_batch()
             # diagnostic display stuff...
             if ((b > 1) and ((b % 1000) == 0)):
                 Wm_info = self.context_layer.norm_info('Wm')
@@ -227,6 +259,7 @@ class PVModel:
                 obs_count = 250.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        prof.flush()
         # Set self.context_layer back to what it was prior to retraining
         self.word_layer.reset_grads()
         self.context_layer = prev_context_layer
@@ -248,6 +281,8 @@ class CAModel:
       max_wv_key: max key of a valid word in the word LUT
       max_cv_key: max key of a valid context in the context LUT
       use_ns: if True, use negative sanpling, otherwise use HSM
+      use_acl: if True (and use_ns), train the prediction layer with the
+               auto-contrastive loss rather than the negative sampling loss
       lam_wv: l2 regularization parameter for word vectors
       lam_cv: l2 regularization parameter for context vectors
       lam_ns: l2 regularization parameter for negative sampling layer
@@ -258,18 +293,20 @@ class CAModel:
           Gaussian "weight fuzzing" noise for stronger regularization.
     """
     def __init__(self, wv_dim, cv_dim, max_wv_key, max_cv_key, use_ns=True, \
-                 max_hs_key=0, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4):
+                 max_hs_key=0, lam_wv=1e-4, lam_cv=1e-4, lam_cl=1e-4, \
+                 use_acl=False):
         # Record options/parameters
         self.wv_dim = wv_dim
         self.cv_dim = cv_dim
         self.max_wv_key = max_wv_key
         self.max_cv_key = max_cv_key
         self.use_ns = use_ns
+        self.use_acl = use_acl
         self.max_hs_key = max_hs_key
         self.lam_wv = lam_wv
         self.lam_cv = lam_cv
         self.lam_cl = lam_cl
-        self.reg_freq = 20 # number of batches between regularization updates
+        self.reg_freq = 1 # l2 decay is lazy, so it's cheap to do every batch
         # Set noise layer parameters (for better regularization)
         self.drop_rate = 0.0
         self.fuzz_scale = 0.0
@@ -283,13 +320,20 @@ class CAModel:
                                           do_rescale=True)
         self.noise_layer = nlml.NoiseLayer(drop_rate=self.drop_rate, \
                                            fuzz_scale=self.fuzz_scale)
-        if self.use_ns:
+        if self.use_acl:
+            # the auto-contrastive layer uses the same pos/neg keys as NS
+            assert(self.use_ns)
+            self.class_layer = nlml.ACLayer(in_dim=(self.cv_dim+self.wv_dim), \
+                                            max_out_key=self.max_wv_key)
+        elif self.use_ns:
             self.class_layer = nlml.NSLayer(in_dim=(self.cv_dim+self.wv_dim), \
                                             max_out_key=self.max_wv_key)
         else:
             assert(self.max_hs_key > 0)
             self.class_layer = nlml.HSMLayer(in_dim=(self.cv_dim+self.wv_dim), \
                                              max_hs_key=self.max_hs_key)
+        # Per-phase timers for training, off unless set_profiler() is called
+        self.prof = PhaseProfiler(enabled=False)
         return
 
     def init_params(self, weight_scale=0.05):
@@ -299,11 +343,16 @@ class CAModel:
         self.class_layer.init_params(weight_scale)
         return
 
-    def reset_moms(self, ada_init=1e-3):
+    def reset_moms(self, ada_init=1e-3, lazy=False):
         """Reset the adagrad "momentums" in each layer."""
-        self.word_layer.reset_moms(ada_init)
-        self.context_layer.reset_moms(ada_init)
-        self.class_layer.reset_moms(ada_init)
+        self.word_layer.reset_moms(ada_init, lazy)
+        self.context_layer.reset_moms(ada_init, lazy)
+        self.class_layer.reset_moms(ada_init, lazy)
+        return
+
+    def set_profiler(self, prof):
+        """Time the phases of training with the given PhaseProfiler."""
+        self.prof = prof
         return
 
     def set_noise(self, drop_rate=0.0, fuzz_scale=0.0):
@@ -323,8 +372,9 @@ class CAModel:
         Parameters:
             anc_keys: word LUT keys for the anchor words
             if self.use_ns:
-                param_1: LUT keys for positive prediction targets
-                param_2: LUT keys for negative prediction targets
+                param_1: LUT keys for positive prediction targets, or a
+                         matrix of positive/negative keys from sample_pn()
+                param_2: LUT keys for negative prediction targets, or None
             else:
                 param_1: LUT keys for HSM codes
                 param_2: Target classes (+1/-1) for HSM codes
@@ -336,7 +386,9 @@ class CAModel:
             train_cls: train the classification layer parameters
             learn_rate: learning rate for adagrad updates
         """
+        prof = self.prof
         # Feedforward through the various layers of this model
+        prof.start('ff')
         Xb = self.word_layer.feedforward(anc_keys)
         Xc = self.context_layer.feedforward(Xb, phrase_keys)
         if self.use_tanh:
@@ -344,11 +396,15 @@ class CAModel:
         else:
             Xt = Xc
         Xn = self.noise_layer.feedforward(Xt)
+        prof.stop('ff')
 
         # Turn the corner with feedforward and backprop at class layer
+        prof.start('ff_bp')
         dLdXn, L = self.class_layer.ff_bp(Xn, param_1, param_2, do_grad=True)
+        prof.stop('ff_bp')
 
         # Backprop through layers based on feedforward result
+        prof.start('bp')
         dLdXt = self.noise_layer.backprop(dLdXn)
         if self.use_tanh:
             dLdXc = self.tanh_layer.backprop(dLdXt)
@@ -356,14 +412,17 @@ class CAModel:
             dLdXc = dLdXt
         dLdXb = self.context_layer.backprop(dLdXc)
         self.word_layer.backprop(dLdXb)
+        prof.stop('bp')
 
         # Update parameters using the gradients computed in backprop
+        prof.start('update')
         if train_ctx:
             self.context_layer.apply_grad(learn_rate=learn_rate)
         if train_lut:
             self.word_layer.apply_grad(learn_rate=learn_rate)
         if train_cls:
             self.class_layer.apply_grad(learn_rate=learn_rate)
+        prof.stop('update')
         return L
 
     def train(self, pos_sampler, var_param, batch_size, batch_count, \
@@ -386,21 +445,24 @@ class CAModel:
         """
         print("Training all parameters:")
         L = 0.0
-        self.word_layer.reset_moms(1.0)
-        self.context_layer.reset_moms(1.0)
-        self.class_layer.reset_moms(1.0)
+        # resets are lazy, so only rows that get trained are touched
+        self.reset_moms(ada_init=1.0, lazy=True)
+        prof = self.prof
         for b in range(batch_count):
+            prof.start('sample')
             anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
             if self.use_ns:
-                param_1 = pos_keys
-                param_2 = var_param.sample(batch_size)
+                param_1 = var_param.sample_pn(pos_keys)
+                param_2 = None
             else:
                 param_1 = var_param['keys_to_code_keys'].take(pos_keys,axis=0)
                 param_2 = var_param['keys_to_code_signs'].take(pos_keys,axis=0)
+            prof.stop('sample')
             L += self.batch_update(anc_keys, param_1, param_2, phrase_keys, \
                                    train_ctx=train_ctx, train_lut=train_lut, \
                                    train_cls=train_cls, learn_rate=learn_rate)
-            # apply l2 regularization, but not every round (to save flops)
+            # apply l2 regularization (lazily, to touched rows only)
+            prof.start('reg')
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 reg_rate = learn_rate * self.reg_freq
                 if train_lut:
@@ -410,6 +472,9 @@ class CAModel:
                 if train_ctx:
                     self.context_layer.l2_regularize(lam_Wm=(reg_rate*self.lam_cv), \
                                                     lam_Wb=(reg_rate*self.lam_cv))
+            prof.stop('reg')
+            prof.count('samples', batch_size)
+            prof.end_batch()
             # diagnostic display stuff...
             if ((b > 1) and ((b % 1000) == 0)):
                 Wm_info = self.context_layer.norm_info('Wm')
@@ -419,6 +484,7 @@ class CAModel:
                 obs_count = 500.0 # * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        prof.flush()
         return
 
     def infer_context_vectors(self, pos_sampler, var_param, batch_size, \
@@ -445,24 +511,31 @@ class CAModel:
         new_context_layer.init_params(0.02)
         prev_context_layer = self.context_layer
         self.context_layer = new_context_layer
-        self.context_layer.reset_moms(1.0)
+        self.context_layer.reset_moms(1.0, lazy=True)
         print("Training new context vectors:")
         L = 0.0
+        prof = self.prof
         for b in range(batch_count):
+            prof.start('sample')
             anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
             if self.use_ns:
-                param_1 = pos_keys
-                param_2 = var_param.sample(batch_size)
+                param_1 = var_param.sample_pn(pos_keys)
+                param_2 = None
             else:
                 param_1 = var_param['keys_to_code_keys'].take(pos_keys,axis=0)
                 param_2 = var_param['keys_to_code_signs'].take(pos_keys,axis=0)
+            prof.stop('sample')
             L += self.batch_update(anc_keys, param_1, param_2, phrase_keys, \
                                    train_ctx=True, train_lut=False, \
                                    train_cls=False, learn_rate=learn_rate)
+            prof.start('reg')
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 reg_rate = learn_rate * self.reg_freq
                 self.context_layer.l2_regularize(lam_Wm=(reg_rate*self.lam_cv), \
                                                  lam_Wb=(reg_rate*self.lam_cv))
+            prof.stop('reg')
+            prof.count('samples', batch_size)
+            prof.end_batch()
             if ((b > 1) and ((b % 1000) == 0)):
                 Wm_info = self.context_layer.norm_info('Wm')
                 Wb_info = self.context_layer.norm_info('Wb')
@@ -471,37 +544,43 @@ class CAModel:
                 obs_count = 500.0 * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        prof.flush()
         # Set self.context_layer back to what it was previously
         self.context_layer = prev_context_layer
         # Reset gradients in all layers
-        self.word_layer.reset_grads_and_moms()
-        self.context_layer.reset_grads_and_moms()
-        self.class_layer.reset_grads_and_moms()
+        self.word_layer.reset_grads_and_moms(lazy=True)
+        self.context_layer.reset_grads_and_moms(lazy=True)
+        self.class_layer.reset_grads_and_moms(lazy=True)
         return new_context_layer
 
 
 
 class W2VModel:
     """
-    Word2Vec skip-gram model, trained with negative sampling. For more info
-    see: "Distributed Representations of Words and Phrases and their
+    Word2Vec skip-gram or CBOW model, trained with negative sampling. For more
+    info see: "Distributed Representations of Words and Phrases and their
     Compositionality" by Mikolov et. al. (NIPS 2013).
 
     Important Parameters (accessible via self.*):
       wv_dim: dimension of the word context/prediction vectors
       max_wv_key: max key of a valid word in the LUTs
       lam_l2: l2 regularization parameter for word vectors
+      cbow: if True, predict each word from the average of the words in its
+            window (CBOW), rather than from each of them in turn (skip-gram)
     """
-    def __init__(self, wv_dim, max_wv_key, lam_l2=1e-4):
+    def __init__(self, wv_dim, max_wv_key, lam_l2=1e-4, cbow=False):
         # Record options/parameters
         self.wv_dim = wv_dim
         self.max_wv_key = max_wv_key
         self.lam_l2 = lam_l2
-        self.reg_freq = 20 # number of batches between regularization updates
+        self.cbow = cbow
+        self.reg_freq = 1 # l2 decay is lazy, so it's cheap to do every batch
         # Create the layer to use during training
         self.w2v_layer = nlml.W2VLayer(max_word_key=self.max_wv_key, \
                                        word_dim=self.wv_dim, \
                                        lam_l2=self.lam_l2)
+        # Per-phase timers for training, off unless set_profiler() is called
+        self.prof = PhaseProfiler(enabled=False)
         return
 
     def init_params(self, weight_scale=0.05):
@@ -509,9 +588,15 @@ class W2VModel:
         self.w2v_layer.init_params(weight_scale)
         return
 
-    def reset_moms(self, ada_init=1e-3):
+    def reset_moms(self, ada_init=1e-3, lazy=False):
         """Reset the adagrad "momentums" in each layer."""
-        self.w2v_layer.reset_moms(ada_init)
+        self.w2v_layer.reset_moms(ada_init, lazy)
+        return
+
+    def set_profiler(self, prof):
+        """Time the phases of training with the given PhaseProfiler."""
+        self.prof = prof
+        self.w2v_layer.prof = prof
         return
 
     def batch_update(self, anc_keys, pos_keys, neg_keys, learn_rate=1e-3):
@@ -521,7 +606,8 @@ class W2VModel:
         Parameters:
             anc_keys: context LUT keys for the anchor words
             pos_keys: prediction LUT keys for the positive examples
-            neg_keys: prediction LUT keys for the negative examples
+            neg_keys: prediction LUT keys for the negative examples (or None,
+                      if pos_keys came from NegSampler.sample_pn())
             learn_rate: learning rate for adagrad updates
         """
         # Update the W2VLayer using the given examples
@@ -529,12 +615,31 @@ class W2VModel:
                                        learn_rate=learn_rate)
         return L
 
+    def batch_update_cbow(self, ctx_keys, ctx_lens, pos_keys, neg_keys, \
+                          learn_rate=1e-3):
+        """
+        Perform a single CBOW "minibatch" update of the model parameters.
+
+        Parameters:
+            ctx_keys: context LUT keys for the words in each window (packed
+                      into the front of each row, as from sample_cbow())
+            ctx_lens: number of context words in each row of ctx_keys
+            pos_keys: prediction LUT keys for the target words
+            neg_keys: prediction LUT keys for the negative examples (or None,
+                      if pos_keys came from NegSampler.sample_pn())
+            learn_rate: learning rate for adagrad updates
+        """
+        L = self.w2v_layer.batch_train_cbow(ctx_keys, ctx_lens, pos_keys, \
+                                            neg_keys, learn_rate=learn_rate)
+        return L
+
     def train(self, pos_sampler, neg_sampler, batch_size, batch_count, \
               learn_rate=1e-3):
         """
         Train all parameters in the model using minibatches of samples drawn
         from the given pos_sampler and neg_sampler. pos_sampler should provide
-        samples of anchor/context word pairs and neg_sampler should provide
+        samples of anchor/context word pairs (or context windows and their
+        target words, when self.cbow is True) and neg_sampler should provide
         words from the "negative contrastive sampling" distribution.
 
         Parameters:
@@ -545,31 +650,71 @@ class W2VModel:
             learn_rate: learning rate for adagrad updates
         """
         L = 0.0
+        prof = self.prof
         print("Training all parameters:")
         for b in range(batch_count):
-            anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(batch_size)
-            neg_keys = neg_sampler.sample(batch_size)
-            L += self.batch_update(anc_keys, pos_keys, neg_keys, learn_rate=learn_rate)
+            if self.cbow:
+                prof.start('sample')
+                ctx_keys, ctx_lens, pos_keys, phrase_keys = \
+                        pos_sampler.sample_cbow(batch_size)
+                pn_keys = neg_sampler.sample_pn(pos_keys)
+                prof.stop('sample')
+                L += self.batch_update_cbow(ctx_keys, ctx_lens, pn_keys, None, \
+                                            learn_rate=learn_rate)
+            else:
+                prof.start('sample')
+                anc_keys, pos_keys, phrase_keys = \
+                        pos_sampler.sample_pairs(batch_size)
+                pn_keys = neg_sampler.sample_pn(pos_keys)
+                prof.stop('sample')
+                L += self.batch_update(anc_keys, pn_keys, None, \
+                                       learn_rate=learn_rate)
+            prof.start('reg')
             if ((b > 1) and ((b % self.reg_freq) == 0)):
                 lam_multi = self.reg_freq * learn_rate * self.lam_l2
                 self.w2v_layer.l2_regularize(lam_multi)
+            prof.stop('reg')
+            prof.count('samples', batch_size)
+            prof.end_batch()
             if ((b % 1000) == 0):
                 obs_count = 1000.0# * batch_size
                 print("Batch {0:d}/{1:d}, loss {2:.4f}".format(b, batch_count, L/obs_count))
                 L = 0.0
+        prof.flush()
         return
 
-    def test(self, pos_sampler, neg_sampler, test_samples):
-        """Train all parameters in the model using the given phrases.
+    def test(self, pos_sampler, neg_sampler, test_samples, \
+             batch_size=100000):
+        """
+        Compute the loss of the model on test_samples samples drawn from the
+        given samplers (e.g. samplers for held-out phrases). The samples are
+        drawn and evaluated in (large) batches of batch_size, using only the
+        forward pass, so this is cheap enough to run often during training.
 
         Parameters:
             pos_sampler: sampler for generating positive prediction pairs
             neg_sampler: sampler for generating contrastive examples
             test_samples: number of samples to check loss for
+            batch_size: number of samples to evaluate in each kernel call
+        Returns the total loss over all test samples.
         """
-        anc_keys, pos_keys, phrase_keys = pos_sampler.sample_pairs(test_samples)
-        neg_keys = neg_sampler.sample(test_samples)
-        L = self.w2v_layer.batch_test(anc_keys, pos_keys, neg_keys)
+        L = 0.0
+        self.prof.start('test')
+        for b_start in range(0, test_samples, batch_size):
+            b_size = min(batch_size, test_samples - b_start)
+            if self.cbow:
+                ctx_keys, ctx_lens, pos_keys, phrase_keys = \
+                        pos_sampler.sample_cbow(b_size)
+                pn_keys = neg_sampler.sample_pn(pos_keys)
+                L += self.w2v_layer.batch_test_cbow(ctx_keys, ctx_lens, \
+                                                    pn_keys)
+            else:
+                anc_keys, pos_keys, phrase_keys = \
+                        pos_sampler.sample_pairs(b_size)
+                pn_keys = neg_sampler.sample_pn(pos_keys)
+                L += self.w2v_layer.batch_test(anc_keys, pn_keys)
+        self.prof.stop('test')
+        self.prof.count('test_samples', test_samples)
         print("Test loss: {0:.4f}".format(L / test_samples))
         return L
 
@@ -579,6 +724,15 @@ class W2VModel:
 
 def some_nearest_words(keys_to_words, sample_count, W1=None, W2=None):
     assert(not (W1 is None))
+    if isinstance(W1, QuantizedLUT):
+        # query the int8 table directly, rather than dequantizing it
+        all_keys = np.asarray(keys_to_words.keys()).astype(np.uint32)
+        source_keys = all_keys[npr.randint(0, all_keys.size, size=(sample_count,))]
+        neighbor_keys, _ = W1.nearest_keys(source_keys, count=10)
+        source_words = [keys_to_words[k] for k in source_keys]
+        neighbor_words = [[keys_to_words.get(k, '*NONE*') for k in n_keys] \
+                for n_keys in neighbor_keys]
+        return [source_keys, neighbor_keys, source_words, neighbor_words]
     if not (W2 is None):
         W = np.hstack((W1, W2))
     else:
@@ -609,7 +763,7 @@ def test_cam_model():
     data_dir = './flat_trees'
     sentences = cu.SentenceFileIterator(data_dir)
     key_dicts = cu.build_vocab(sentences, min_count=3, compute_hs_tree=True, \
-                            compute_ns_table=True, down_sample=0.0)
+                            compute_ns_table=True, down_sample=1e-3)
     w2k = key_dicts['words_to_keys']
     k2w = key_dicts['keys_to_words']
     neg_table = key_dicts['ns_table']
@@ -641,7 +795,8 @@ def test_cam_model():
     cam.set_noise(drop_rate=0.5, fuzz_scale=0.0)
 
     # initialize samplers for drawing positive pairs and negative contrastors
-    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window)
+    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window, \
+            keep_probs=key_dicts['keep_probs'])
     neg_sampler = cu.NegSampler(neg_table=neg_table, neg_count=ns_count)
 
     # train all parameters using the training set phrases
@@ -651,16 +806,63 @@ def test_cam_model():
         cam.train(pos_sampler, neg_sampler, 200, 10001, train_ctx=True, \
                   train_lut=True, train_cls=True, learn_rate=learn_rate)
         learn_rate = learn_rate * decay_rate
+        cam.word_layer.flush_l2()
         [s_keys, n_keys, s_words, n_words] = some_nearest_words( k2w, 10, \
                   W1=cam.word_layer.params['W'], W2=None)
         for w in range(10):
             print("{0:s}: {1:s}".format(s_words[w],", ".join(n_words[w])))
 
+def test_cam_output_layers():
+    """Compare training speed of CAModel with NS, HSM and ACL outputs."""
+    data_dir = './flat_trees'
+    sentences = cu.SentenceFileIterator(data_dir)
+    key_dicts = cu.build_vocab(sentences, min_count=3, compute_hs_tree=True, \
+                            compute_ns_table=True, down_sample=1e-3)
+    w2k = key_dicts['words_to_keys']
+    neg_table = key_dicts['ns_table']
+    unk_word = key_dicts['unk_word']
+    hsm_code_dict = key_dicts['hs_tree']
+    sentences = cu.SentenceFileIterator(data_dir)
+    tr_phrases = cu.sample_phrases(sentences, w2k, unk_word=unk_word, \
+                                max_phrases=100000)
+    max_cv_key = len(tr_phrases) + 1
+    max_wv_key = max(w2k.values())
+    max_hs_key = key_dicts['hs_tree']['max_code_key']
+
+    # Use the same hyperparameters and samplers for all output layers
+    sg_window = 6
+    ns_count = 10
+    wv_dim = 100
+    cv_dim = 10
+    lam_l2 = 1e-2
+    batch_size = 200
+    batch_count = 5001
+    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window, \
+            keep_probs=key_dicts['keep_probs'])
+    neg_sampler = cu.NegSampler(neg_table=neg_table, neg_count=ns_count)
+
+    words_per_sec = {}
+    for out_type in ['ns', 'hsm', 'acl']:
+        cam = CAModel(wv_dim, cv_dim, max_wv_key, max_cv_key, \
+                    use_ns=(out_type != 'hsm'), max_hs_key=max_hs_key, \
+                    lam_wv=lam_l2, lam_cv=lam_l2, lam_cl=lam_l2, \
+                    use_acl=(out_type == 'acl'))
+        cam.init_params(0.025)
+        var_param = hsm_code_dict if (out_type == 'hsm') else neg_sampler
+        t1 = time.time()
+        cam.train(pos_sampler, var_param, batch_size, batch_count, \
+                  learn_rate=1e-2)
+        t2 = time.time()
+        words_per_sec[out_type] = (batch_size * batch_count) / (t2 - t1)
+    for out_type in ['ns', 'hsm', 'acl']:
+        print("{0:s}: {1:.0f} words/sec".format(out_type, words_per_sec[out_type]))
+    return words_per_sec
+
 def test_pv_model():
     data_dir = './flat_trees'
     sentences = cu.SentenceFileIterator(data_dir)
     key_dicts = cu.build_vocab(sentences, min_count=3, compute_hs_tree=True, \
-                            compute_ns_table=True, down_sample=0.0)
+                            compute_ns_table=True, down_sample=1e-3)
     w2k = key_dicts['words_to_keys']
     k2w = key_dicts['keys_to_words']
     neg_table = key_dicts['ns_table']
@@ -688,12 +890,14 @@ def test_pv_model():
     pvm.set_noise(drop_rate=0.5, fuzz_scale=0.0)
 
     # Initialize samplers for training
-    ngram_sampler = cu.PhraseSampler(tr_phrases, sg_window)
+    ngram_sampler = cu.PhraseSampler(tr_phrases, sg_window, \
+            keep_probs=key_dicts['keep_probs'])
 
     # Train all parameters using the training set phrases
     for i in range(100):
         pvm.train(ngram_sampler, hsm_code_keys, hsm_code_signs, 300, 10001, \
                 train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3)
+        pvm.word_layer.flush_l2()
         [s_keys, n_keys, s_words, n_words] = some_nearest_words( k2w, 10, \
                 W1=pvm.word_layer.params['W'], W2=None)
         for w in range(10):
@@ -703,7 +907,7 @@ def test_w2v_model():
     data_dir = './training_text'
     sentences = cu.SentenceFileIterator(data_dir)
     key_dicts = cu.build_vocab(sentences, min_count=2, compute_hs_tree=True, \
-                            compute_ns_table=True, down_sample=0.0)
+                            compute_ns_table=True, down_sample=1e-3)
     w2k = key_dicts['words_to_keys']
     k2w = key_dicts['keys_to_words']
     neg_table = key_dicts['ns_table']
@@ -725,7 +929,8 @@ def test_w2v_model():
     w2vm.init_params(0.025)
 
     # initialize samplers for drawing positive pairs and negative contrastors
-    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window)
+    pos_sampler = cu.PhraseSampler(tr_phrases, sg_window, \
+            keep_probs=key_dicts['keep_probs'])
     neg_sampler = cu.NegSampler(neg_table=neg_table, neg_count=ns_count)
 
     # train all parameters using the training set phrases
@@ -734,6 +939,7 @@ def test_w2v_model():
     for i in range(100):
         w2vm.train(pos_sampler, neg_sampler, 200, 10001, learn_rate=learn_rate)
         learn_rate = learn_rate * decay_rate
+        w2vm.w2v_layer.flush_l2()
         [s_keys, n_keys, s_words, n_words] = some_nearest_words( k2w, 10, \
                   W1=w2vm.w2v_layer.params['Wa'], W2=None)
         for w in range(10):
@@ -1,214 +1,322 @@
 from __future__ import absolute_import
 
 import numpy as np
-import numpy.random as npr
-import threading
-import numba
-from math import exp, log, sqrt
-from numba import jit, void, i4, f4, u4
-from ctypes import pythonapi, c_void_p
-
-ADA_EPS = 0.001
-
-########################################
-# MULTITHREADING HELPER-FUNC AND DEFNS #
-########################################
-
-THREAD_NUM = 4
-
-savethread = pythonapi.PyEval_SaveThread
-savethread.argtypes = []
-savethread.restype = c_void_p
-
-restorethread = pythonapi.PyEval_RestoreThread
-restorethread.argtypes = [c_void_p]
-restorethread.restype = None
-
-def make_multithread(inner_func, numthreads):
-    def func_mt(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.int32)
-        chunklen = (length + (numthreads-1)) // numthreads
-        chunkargs = [(sp_idx[i*chunklen:(i+1)*chunklen],)+args for i in range(numthreads)]
-        # Start a thread for all but the last chunk of work
-        threads = [threading.Thread(target=inner_func, args=cargs)
-                   for cargs in chunkargs[:-1]]
-        for thread in threads:
-            thread.start()
-        # Give the last chunk of work to the main thread
-        inner_func(*chunkargs[-1])
-        for thread in threads:
-            thread.join()
-        return 1
-    def func_st(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.int32)
-        sp_args = (sp_idx,) + args
-        inner_fun(*sp_args)
-    func = None
-    if numthreads == 1:
-        func = func_st
-    else:
-        func = func_mt
-    return func_mt
-
-##############################
-# NUMBA FUNCTION DEFINITIONS #
-##############################
-
-def w2v_ff_bp_sp(sp_idx, anc_idx, pn_idx, pn_sign, Wa, Wc, b, dWa, dWc, db, L, do_grad):
-    """Feedforward and backprop for unified (neg-sample) word-2-vec layer."""
-    threadstate = savethread()
-    sp_size = sp_idx.shape[0]
-    cols = pn_idx.shape[1]
+from math import exp, log, sqrt, cos
+from numba import jit
+
+###############################################################
+# NUMBA VERSIONS OF THE CYTHON KERNELS (SAME CALL SIGNATURES) #
+################################################################################
+# NOTE: The functions below take exactly the same arguments as the matching    #
+#       *_pyx functions in CythonFuncsPyx.pyx, and compute the same things.    #
+#       CythonFuncs falls back to these when the compiled extension module     #
+#       isn't available. They release the GIL, so they can be multithreaded    #
+#       by CythonFuncs.make_multithread, just like the Cython versions. There  #
+#       is one kernel per name in CythonFuncs.KERNEL_NAMES (hsm_ff_bp has      #
+#       none, since CythonFuncs runs nsl_ff_bp for it).                        #
+################################################################################
+
+NB_MAX_HSM_KEY = 12345678
+NB_ADA_EPS = 0.001
+NB_ADA_RHO = 0.98
+# constants for the SplitMix64 counter-based RNG (same as in CorpusUtils)
+NB_RNG_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+NB_RNG_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+NB_RNG_MIX_2 = np.uint64(0x94D049BB133111EB)
+NB_RNG_SHIFT_1 = np.uint64(30)
+NB_RNG_SHIFT_2 = np.uint64(27)
+NB_RNG_SHIFT_3 = np.uint64(31)
+NB_RNG_SHIFT_F = np.uint64(40)
+NB_RNG_UNIT_F = 1.0 / 16777216.0
+NB_TWO_PI = 6.283185307179586
+
+@jit(nopython=True, nogil=True, cache=True)
+def w2v_ff_bp_nb(sp_idx, anc_keys, pn_keys, pn_sign, Wa, Wc, b, dWa, dWc, \
+                 db, L, do_grad):
     vec_dim = Wa.shape[1]
-    for sp_i in range(sp_size):
+    for sp_i in range(sp_idx.shape[0]):
         i = sp_idx[sp_i]
-        ai = anc_idx[i]
-        for j in range(cols):
-            ci = pn_idx[i,j]
-            y = b[ci]
+        a_key = anc_keys[i]
+        for j in range(pn_keys.shape[1]):
+            c_key = pn_keys[i,j]
+            neg_label = -1.0 * pn_sign[i,j]
+            y = 0.0
             for k in range(vec_dim):
-                y += (Wa[ai,k] * Wc[ci,k])
-            exp_pns_y = exp(pn_sign[i,j] * y)
+                y += Wa[a_key,k] * Wc[c_key,k]
+            y += b[c_key]
+            exp_pns_y = np.float32(exp(neg_label * y))
             L[0] += log(1.0 + exp_pns_y)
             if (do_grad == 1):
-                dLdy = pn_sign[i,j] * (exp_pns_y / (1.0 + exp_pns_y))
-                db[ci] = db[ci] + dLdy
+                g = np.float32(neg_label * (exp_pns_y / (1.0 + exp_pns_y)))
                 for k in range(vec_dim):
-                    dWa[ai,k] += (dLdy * Wc[ci,k])
-                    dWc[ci,k] += (dLdy * Wa[ai,k])
-    restorethread(threadstate)
+                    dWc[c_key,k] += g * Wa[a_key,k]
+                for k in range(vec_dim):
+                    dWa[a_key,k] += g * Wc[c_key,k]
+                db[c_key] += g
     return
-fn_sig_1 = void(i4[:], i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:], i4)
-w2v_ff_bp_st = jit(fn_sig_1, nopython=True)(w2v_ff_bp_sp)
-w2v_ff_bp = make_multithread(w2v_ff_bp_st, THREAD_NUM)
-
-def nsl_bp_sp(sp_idx, table_idx, X, W, dLdY, dLdX, dW, db):
-    """Backprop for NSLayer: main loop in Numba-friendly form."""
-    threadstate = savethread()
-    rows = sp_idx.shape[0]
-    cols = dLdY.shape[1]
-    vec_dim = X.shape[1]
-    for spi in range(rows):
-        i = sp_idx[spi]
-        for j in range(cols):
-            dldy = dLdY[i,j]
-            idx = table_idx[i,j]
-            db[idx] += dldy
+
+@jit(nopython=True, nogil=True, cache=True)
+def cbow_ff_bp_nb(sp_idx, ctx_keys, ctx_lens, pn_keys, pn_sign, Wa, Wc, b, \
+                  H, dH, dWa, dWc, db, L, do_grad):
+    vec_dim = Wa.shape[1]
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        ctx_len = ctx_lens[i]
+        L[i] = 0.0
+        if (ctx_len == 0):
+            continue
+        ctx_scale = np.float32(1.0 / ctx_len)
+        for k in range(vec_dim):
+            H[i,k] = 0.0
+            dH[i,k] = 0.0
+        for c in range(ctx_len):
+            a_key = ctx_keys[i,c]
             for k in range(vec_dim):
-                dW[idx,k] += dldy * X[i,k]
-                dLdX[i,k] += dldy * W[idx,k]
-    restorethread(threadstate)
+                H[i,k] += ctx_scale * Wa[a_key,k]
+        for j in range(pn_keys.shape[1]):
+            c_key = pn_keys[i,j]
+            if (c_key < NB_MAX_HSM_KEY):
+                neg_label = -1.0 * pn_sign[i,j]
+                y = 0.0
+                for k in range(vec_dim):
+                    y += H[i,k] * Wc[c_key,k]
+                y += b[c_key]
+                exp_pns_y = np.float32(exp(neg_label * y))
+                L[i] += log(1.0 + exp_pns_y)
+                if (do_grad == 1):
+                    g = np.float32(neg_label * (exp_pns_y / (1.0 + exp_pns_y)))
+                    for k in range(vec_dim):
+                        dWc[c_key,k] += g * H[i,k]
+                    for k in range(vec_dim):
+                        dH[i,k] += g * Wc[c_key,k]
+                    db[c_key] += g
+        if (do_grad == 1):
+            for c in range(ctx_len):
+                a_key = ctx_keys[i,c]
+                for k in range(vec_dim):
+                    dWa[a_key,k] += ctx_scale * dH[i,k]
     return
-fn_sig_2 = void(i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:,:], f4[:])
-nsl_bp_st = jit(fn_sig_2, nopython=True)(nsl_bp_sp)
-nsl_bp = make_multithread(nsl_bp_st, THREAD_NUM)
-
-def nsl_ff_sp(sp_idx, table_idx, X, W, b, Y):
-    """Feedforward for NSLayer: main loop in Numba-friendly form."""
-    threadstate = savethread()
-    rows = sp_idx.shape[0]
-    cols = table_idx.shape[1]
-    vec_dim = X.shape[1]
-    for spi in range(rows):
-        i = sp_idx[spi]
-        for j in range(cols):
-            idx = table_idx[i,j]
-            Y[i,j] = b[idx]
+
+@jit(nopython=True, nogil=True, cache=True)
+def _nb_pn_loss(i, h, pn_keys, pn_sign, Wc, b):
+    L_i = 0.0
+    for j in range(pn_keys.shape[1]):
+        c_key = pn_keys[i,j]
+        if (c_key < NB_MAX_HSM_KEY):
+            neg_label = -1.0 * pn_sign[i,j]
+            y = 0.0
+            for k in range(Wc.shape[1]):
+                y += h[k] * Wc[c_key,k]
+            y += b[c_key]
+            L_i += log(1.0 + np.float32(exp(neg_label * y)))
+    return L_i
+
+@jit(nopython=True, nogil=True, cache=True)
+def w2v_loss_nb(sp_idx, anc_keys, pn_keys, pn_sign, Wa, Wc, b, L):
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        L[i] = _nb_pn_loss(i, Wa[anc_keys[i]], pn_keys, pn_sign, Wc, b)
+    return
+
+@jit(nopython=True, nogil=True, cache=True)
+def cbow_loss_nb(sp_idx, ctx_keys, ctx_lens, pn_keys, pn_sign, Wa, Wc, b, \
+                 H, L):
+    vec_dim = Wa.shape[1]
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        ctx_len = ctx_lens[i]
+        if (ctx_len == 0):
+            L[i] = 0.0
+            continue
+        ctx_scale = np.float32(1.0 / ctx_len)
+        for k in range(vec_dim):
+            H[i,k] = 0.0
+        for c in range(ctx_len):
+            a_key = ctx_keys[i,c]
             for k in range(vec_dim):
-                Y[i,j] += X[i,k] * W[idx,k]
-    restorethread(threadstate)
+                H[i,k] += ctx_scale * Wa[a_key,k]
+        L[i] = _nb_pn_loss(i, H[i], pn_keys, pn_sign, Wc, b)
     return
-fn_sig_3 = void(i4[:], i4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:])
-nsl_ff_st = jit(fn_sig_3, nopython=True)(nsl_ff_sp)
-nsl_ff = make_multithread(nsl_ff_st, THREAD_NUM)
-
-def ag_update_2d_sp(sp_idx, row_idx, W, dW, mW, learn_rate):
-    """Element-wise partial update ala adagrad.
-
-    For the entries indicated by row_idx, this first updates the adagrad sums
-    of squares in mW, then updates the params in W, and finally sets the
-    grads in dW back to 0.
-    """
-    threadstate = savethread()
-    row_count = sp_idx.shape[0]
+
+@jit(nopython=True, nogil=True, cache=True)
+def nsl_ff_bp_nb(sp_idx, pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad):
     vec_dim = W.shape[1]
-    for spi in range(row_count):
-        idx = row_idx[sp_idx[spi]]
-        for j in range(vec_dim):
-            mW[idx,j] = (0.95 * mW[idx,j]) + (0.05 * dW[idx,j] * dW[idx,j])
-            W[idx,j] -= (learn_rate * (dW[idx,j] / (sqrt(mW[idx,j]) + ADA_EPS)))
-            dW[idx,j] = 0.0
-    restorethread(threadstate)
-    return
-fn_sig_4 = void(i4[:], i4[:], f4[:,:], f4[:,:], f4[:,:], f4)
-ag_update_2d_st = jit(fn_sig_4, nopython=True)(ag_update_2d_sp)
-ag_update_2d = make_multithread(ag_update_2d_st, THREAD_NUM)
-
-@numba.jit("void(i4[:], f4[:], f4[:], f4[:], f4)")
-def ag_update_1d(row_idx, W, dW, mW, learn_rate):
-    """Element-wise partial update ala adagrad.
-
-    For the entries indicated by row_idx, this first updates the adagrad sums
-    of squares in mW, then updates the params in W, and finally sets the
-    grads in dW back to 0.
-    """
-    row_count = row_idx.shape[0]
-    for i in range(row_count):
-        idx = row_idx[i]
-        mW[idx] = (0.95 * mW[idx]) + (0.05 * dW[idx] * dW[idx])
-        W[idx] -= learn_rate * (dW[idx] / (sqrt(mW[idx]) + ADA_EPS))
-        dW[idx] = 0.0
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        for j in range(pn_keys.shape[1]):
+            W_key = pn_keys[i,j]
+            if (W_key < NB_MAX_HSM_KEY):
+                neg_label = -1.0 * pn_sign[i,j]
+                y = 0.0
+                for k in range(vec_dim):
+                    y += X[i,k] * W[W_key,k]
+                y += b[W_key]
+                exp_pns_y = np.float32(exp(neg_label * y))
+                L[i,j] = log(1.0 + exp_pns_y)
+                if (do_grad == 1):
+                    g = np.float32(neg_label * (exp_pns_y / (1.0 + exp_pns_y)))
+                    for k in range(vec_dim):
+                        dW[W_key,k] += g * X[i,k]
+                    for k in range(vec_dim):
+                        dX[i,k] += g * W[W_key,k]
+                    db[W_key] += g
     return
 
-def lut_sp(sp_idx, row_idx, dLdY, dW):
-    """Simple row-wise updates for adjusting dW with dLdY.
-
-    This adds each row of dLdY to some row of dW. The row of dW to adjust
-    is given by the corresponding item in row_idx."""
-    threadstate = savethread()
-    row_count = sp_idx.shape[0]
-    vec_dim = dW.shape[1]
-    for i in range(row_count):
-        idx = row_idx[sp_idx[i]]
-        for j in range(vec_dim):
-            dW[idx,j] += dLdY[i,j]
-    restorethread(threadstate)
-    return
-fn_sig_5 = void(i4[:], i4[:], f4[:,:], f4[:,:])
-lut_st = jit(fn_sig_5, nopython=True)(lut_sp)
-lut_bp = make_multithread(lut_st, THREAD_NUM)
-
-
-def hsm_ff_bp_sp(sp_idx, X, code_keys, code_signs, W, b, dLdX, dLdW, dLdb, L):
-    threadstate = savethread()
-    obs_count = sp_idx.shape[0]
-    code_len = code_keys.shape[1]
-    vec_dim = X.shape[1]
-    for spi in range(obs_count):
-        i = sp_idx[spi]
-        for j in range(code_len):
-            code_key = code_keys[i,j]
-            if code_key < 1234567:
-                y = b[code_key]
-                # for speed, this needs to change to sdot via BLAS
+@jit(nopython=True, nogil=True, cache=True)
+def acl_ff_bp_nb(sp_idx, pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad):
+    vec_dim = W.shape[1]
+    a = 1.0
+    k_n = 1.0
+    c = 0.1
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        Wk_p = pn_keys[i,0]
+        y_p = 0.0
+        for k in range(vec_dim):
+            y_p += X[i,k] * W[Wk_p,k]
+        f_p = np.float32(exp(a*y_p + b[Wk_p]))
+        for j in range(1, pn_keys.shape[1]):
+            Wk_n = pn_keys[i,j]
+            y_n = 0.0
+            for k in range(vec_dim):
+                y_n += X[i,k] * W[Wk_n,k]
+            f_n = np.float32(k_n * exp(a*y_n + b[Wk_n]))
+            denom = np.float32(f_p + f_n + c)
+            L[i,j] = -log(f_p / denom)
+            if (do_grad == 1):
+                g_yp = np.float32(-(a * (c + f_n)) / denom)
+                g_yn = np.float32((a * f_n) / denom)
                 for k in range(vec_dim):
-                    y += X[i,k] * W[code_key,k]
-                neg_label = -1.0 * code_signs[i,j]
-                exp_y = exp(neg_label * y)
-                L[i,j] = log(1.0 + exp_y)
-                g = neg_label * (exp_y / (1.0 + exp_y))
-                dLdb[code_key] += g
-                # for speed, this needs to change to saxpy via BLAS
+                    dX[i,k] += (g_yp * W[Wk_p,k]) + (g_yn * W[Wk_n,k])
                 for k in range(vec_dim):
-                    dLdX[i,k] += g * W[code_key,k]
-                    dLdW[code_key,k] += g * X[i,k]
-    restorethread(threadstate)
+                    dW[Wk_p,k] += g_yp * X[i,k]
+                    dW[Wk_n,k] += g_yn * X[i,k]
+                db[Wk_p] += np.float32(-(c + f_n) / denom)
+                db[Wk_n] += np.float32(f_n / denom)
+    return
+
+@jit(nopython=True, nogil=True, cache=True)
+def ag_update_2d_nb(sp_idx, row_idx, W, dW, mW, alpha):
+    for sp_i in range(sp_idx.shape[0]):
+        row_key = row_idx[sp_idx[sp_i]]
+        for k in range(W.shape[1]):
+            mW[row_key,k] = (NB_ADA_RHO * mW[row_key,k]) + \
+                    ((1 - NB_ADA_RHO) * dW[row_key,k] * dW[row_key,k])
+            W[row_key,k] -= alpha * \
+                    (dW[row_key,k] / (sqrt(mW[row_key,k]) + NB_ADA_EPS))
+            dW[row_key,k] = 0.0
+    return
+
+@jit(nopython=True, nogil=True, cache=True)
+def ag_update_1d_nb(sp_idx, row_idx, W, dW, mW, alpha):
+    for sp_i in range(sp_idx.shape[0]):
+        row_key = row_idx[sp_idx[sp_i]]
+        mW[row_key] = (NB_ADA_RHO * mW[row_key]) + \
+                ((1 - NB_ADA_RHO) * dW[row_key] * dW[row_key])
+        W[row_key] -= alpha * (dW[row_key] / (sqrt(mW[row_key]) + NB_ADA_EPS))
+        dW[row_key] = 0.0
+    return
+
+@jit(nopython=True, nogil=True, cache=True)
+def lut_bp_nb(sp_idx, row_idx, dLdY, dW):
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        j = row_idx[i]
+        for k in range(dLdY.shape[1]):
+            dW[j,k] += dLdY[i,k]
+    return
+
+@jit(nopython=True, nogil=True, cache=True)
+def cm_ff_nb(sp_idx, C, X, Wm, Wb, S, Y, use_bias, sig_mode):
+    src_dim = X.shape[1]
+    bias_dim = Wb.shape[1]
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        c_key = C[i]
+        for k in range(bias_dim):
+            if (use_bias == 1):
+                Y[i,k] = Wb[c_key,k]
+            else:
+                Y[i,k] = 0.0
+        for k in range(src_dim):
+            if (sig_mode == 1):
+                s = np.float32(1.0 / (1.0 + exp(-Wm[c_key,k])))
+            elif (sig_mode == 0):
+                s = np.float32(1.0)
+            else:
+                s = np.float32(0.0)
+            S[i,k] = s
+            Y[i,bias_dim+k] = s * X[i,k]
+    return
+
+@jit(nopython=True, nogil=True, cache=True)
+def cm_bp_nb(sp_idx, C, X, S, dLdY, dWm, dWb, dX, do_Wm):
+    src_dim = X.shape[1]
+    bias_dim = dWb.shape[1]
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        c_key = C[i]
+        for k in range(bias_dim):
+            dWb[c_key,k] += dLdY[i,k]
+        for k in range(src_dim):
+            s = S[i,k]
+            g = dLdY[i,bias_dim+k]
+            if (do_Wm == 1):
+                dWm[c_key,k] += (1.0 - s) * X[i,k] * g
+            dX[i,k] = s * g
+    return
+
+@jit(nopython=True, nogil=True, cache=True)
+def _nb_rand_u64(seed, counter):
+    z = seed + (counter * NB_RNG_GAMMA)
+    z = (z ^ (z >> NB_RNG_SHIFT_1)) * NB_RNG_MIX_1
+    z = (z ^ (z >> NB_RNG_SHIFT_2)) * NB_RNG_MIX_2
+    return z ^ (z >> NB_RNG_SHIFT_3)
+
+@jit(nopython=True, nogil=True, cache=True)
+def _nb_rand_unit(seed, counter):
+    return np.float64(_nb_rand_u64(seed, counter) >> NB_RNG_SHIFT_F) * \
+            NB_RNG_UNIT_F
+
+@jit(nopython=True, nogil=True, cache=True)
+def noise_ff_nb(sp_idx, X, M, Y, seed_p, counter_p, do_drop, drop_rate, \
+                keep_scale, fuzz_c):
+    seed = np.uint64(seed_p)
+    counter = np.uint64(counter_p)
+    k_scale = np.float32(keep_scale)
+    f_scale = np.float32(fuzz_c)
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        r_seed = _nb_rand_u64(seed, counter + np.uint64(i))
+        for k in range(X.shape[1]):
+            r_ctr = np.uint64(3 * k)
+            if (do_drop == 1):
+                keep = (_nb_rand_unit(r_seed, r_ctr) >= drop_rate)
+                M[i,k] = 1 if keep else 0
+            else:
+                M[i,k] = 1
+            if (M[i,k] == 0):
+                Y[i,k] = 0.0
+            elif (f_scale > 0.0):
+                u1 = 1.0 - _nb_rand_unit(r_seed, r_ctr + np.uint64(1))
+                u2 = _nb_rand_unit(r_seed, r_ctr + np.uint64(2))
+                fuzz = np.float32(sqrt(-2.0 * log(u1)) * cos(NB_TWO_PI * u2))
+                Y[i,k] = k_scale * (X[i,k] + (f_scale * fuzz))
+            else:
+                Y[i,k] = k_scale * X[i,k]
+    return
+
+@jit(nopython=True, nogil=True, cache=True)
+def noise_bp_nb(sp_idx, dY, M, dX, keep_scale):
+    k_scale = np.float32(keep_scale)
+    for sp_i in range(sp_idx.shape[0]):
+        i = sp_idx[sp_i]
+        for k in range(dY.shape[1]):
+            if (M[i,k] == 0):
+                dX[i,k] = 0.0
+            else:
+                dX[i,k] = k_scale * dY[i,k]
     return
-fn_sig_6 = void(i4[:], f4[:,:], u4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,:], f4[:], f4[:,:])
-hsm_ff_bp_st = jit(fn_sig_6, nopython=True)(hsm_ff_bp_sp)
-hsm_ff_bp = make_multithread(hsm_ff_bp_st, THREAD_NUM)
 
 ##############
 # EYE BUFFER #
@@ -0,0 +1,82 @@
+"""
+Conformance tests for the kernel backends in CythonFuncs. Run them with
+"python TestKernels.py", or with pytest (e.g. "py.test TestKernels.py").
+Both need the compiled Cython kernels and Numba, since the point is to
+compare the two.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+import numpy.random as npr
+import CythonFuncs as cf
+import NLMLayers as nlml
+
+def test_two_backends():
+    backends = cf.available_backends()
+    assert (len(backends) >= 2), "only found backends: {0:s}".format( \
+            ", ".join(backends) or "none")
+
+def test_backends_agree():
+    cf.check_backends()
+
+def test_one_backend_fails():
+    try:
+        cf.check_kernel('lut_bp', 8, 4, 0, backends=['numba'])
+    except AssertionError:
+        return
+    assert False, "check_kernel passed with only one backend"
+
+def test_cm_layer_wide_inputs():
+    # PVModel's CMLayer gets inputs wider than source_dim, with rescaling off
+    rng = npr.RandomState(2)
+    (batch_size, source_dim, bias_dim, x_dim) = (16, 4, 8, 24)
+    X = rng.randn(batch_size, x_dim).astype(np.float32)
+    C = rng.randint(0, 10, size=(batch_size,)).astype(np.uint32)
+    dLdY = rng.randn(batch_size, bias_dim + x_dim).astype(np.float32)
+    for backend in cf.available_backends():
+        layer = nlml.CMLayer(max_key=9, source_dim=source_dim, \
+                             bias_dim=bias_dim, do_rescale=False, \
+                             backend=backend)
+        layer.init_params(w_scale=0.1, param='Wb')
+        Y = layer.feedforward(X, C)
+        Y_ref = np.hstack([layer.params['Wb'][C], X])
+        assert np.allclose(Y, Y_ref)
+        dLdX = layer.backprop(dLdY)
+        assert np.allclose(dLdX, dLdY[:,bias_dim:])
+        dWb_ref = np.zeros(layer.params['Wb'].shape, dtype=np.float32)
+        np.add.at(dWb_ref, C, dLdY[:,:bias_dim])
+        assert np.allclose(layer.grads['Wb'], dWb_ref, atol=1e-5)
+        assert not np.any(layer.grads['Wm'])
+
+def test_set_default_backend():
+    old_backend = cf.DEFAULT_BACKEND
+    try:
+        for backend in cf.available_backends():
+            cf.set_default_backend(backend)
+            kernels = cf.get_kernels(backend)
+            assert (cf.BACKEND == backend)
+            assert (cf.DEFAULT_KERNELS is kernels)
+            for name in kernels:
+                assert (getattr(cf, name) is kernels[name])
+    finally:
+        cf.set_default_backend(old_backend)
+
+def test_set_thread_num():
+    old_thread_num = cf.THREAD_NUM
+    try:
+        cf.set_thread_num(old_thread_num + 1)
+        assert (cf.DEFAULT_KERNELS is cf.get_kernels(cf.DEFAULT_BACKEND))
+        assert (cf.cm_ff is cf.DEFAULT_KERNELS['cm_ff'])
+    finally:
+        cf.set_thread_num(old_thread_num)
+
+if __name__ == '__main__':
+    for (test_name, test) in sorted(globals().items()):
+        if test_name.startswith('test_'):
+            test()
+            print("{0:s}: ok".format(test_name))
+
+
+##############
+# EYE BUFFER #
+##############
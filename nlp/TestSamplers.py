@@ -0,0 +1,134 @@
+"""
+Statistical checks for the vectorized samplers in HelperFuncs. Each one is
+compared with the per-sample loop it replaced, by the total variation
+distance between histograms of their outputs. Run them with
+"python TestSamplers.py", or with pytest.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+import numpy.random as npr
+import HelperFuncs as hf
+
+SAMPLE_COUNT = 100000
+# TV distance between two samples of SAMPLE_COUNT from the same distribution
+# over K outcomes is about sqrt(K / (pi * SAMPLE_COUNT)), i.e. < 0.02 here
+MAX_TV = 0.035
+
+def _test_phrases():
+    # phrase p holds keys 100*p + position, so a key tells where it came from
+    phrase_lens = [2, 3, 5, 8, 13]
+    return [(100 * p + np.arange(l)).astype(np.int32) \
+            for (p, l) in enumerate(phrase_lens)]
+
+def _tv_distance(rows_a, rows_b):
+    """TV distance between the empirical distributions of two sets of rows."""
+    hist_a = {}
+    hist_b = {}
+    for (hist, rows) in [(hist_a, rows_a), (hist_b, rows_b)]:
+        for row in rows:
+            key = tuple(row)
+            hist[key] = hist.get(key, 0) + 1
+    keys = set(hist_a.keys()) | set(hist_b.keys())
+    return 0.5 * sum(abs((hist_a.get(k, 0) / float(len(rows_a))) - \
+            (hist_b.get(k, 0) / float(len(rows_b)))) for k in keys)
+
+def _old_word_seqs(phrase_list, seq_count, seq_len, null_key):
+    seq_keys = np.zeros((seq_count, seq_len), dtype=np.uint32)
+    for i in range(seq_count):
+        phrase = phrase_list[npr.randint(0, len(phrase_list))]
+        final_key = npr.randint(0, len(phrase))
+        seq_keys[i,-1] = phrase[final_key]
+        for j in range(seq_len-1):
+            preceding_key = final_key - seq_len + j + 1
+            if (preceding_key < 0):
+                seq_keys[i,j] = null_key
+            else:
+                seq_keys[i,j] = phrase[preceding_key]
+    return seq_keys
+
+def _old_word_pairs(phrase_list, pair_count, context_size):
+    # rand_word_pairs and rand_pos_neg both replaced this loop
+    pairs = np.zeros((pair_count, 2), dtype=np.uint32)
+    for i in range(pair_count):
+        phrase = phrase_list[npr.randint(0, len(phrase_list))]
+        a_idx = npr.randint(0, len(phrase))
+        c_max = min((a_idx+context_size+1), len(phrase))
+        c_min = max((a_idx-context_size), 0)
+        c_idx = a_idx
+        while (c_idx == a_idx):
+            c_idx = npr.randint(c_min, c_max)
+        pairs[i,:] = [phrase[a_idx], phrase[c_idx]]
+    return pairs
+
+def test_word_seqs():
+    npr.seed(1)
+    phrases = _test_phrases()
+    old_seqs = _old_word_seqs(phrases, SAMPLE_COUNT, 4, 9999)
+    new_seqs, phrase_keys = hf.rand_word_seqs(phrases, SAMPLE_COUNT, 4, 9999)
+    assert (_tv_distance(old_seqs, new_seqs) < MAX_TV)
+    assert np.all((new_seqs[:,-1] // 100) == phrase_keys)
+
+def test_word_pairs():
+    npr.seed(2)
+    phrases = _test_phrases()
+    old_pairs = _old_word_pairs(phrases, SAMPLE_COUNT, 3)
+    anc_keys, ctx_keys, phrase_keys = hf.rand_word_pairs(phrases, \
+            SAMPLE_COUNT, 3)
+    new_pairs = np.vstack([anc_keys, ctx_keys]).T
+    assert (_tv_distance(old_pairs, new_pairs) < MAX_TV)
+    assert np.all((ctx_keys // 100) == phrase_keys)
+
+def test_pos_neg():
+    npr.seed(3)
+    phrases = _test_phrases()
+    all_words = np.arange(50)
+    old_pairs = _old_word_pairs(phrases, SAMPLE_COUNT, 3)
+    anc_keys, pos_keys, neg_keys, phrase_keys = hf.rand_pos_neg(phrases, \
+            all_words, SAMPLE_COUNT, 3, 5)
+    new_pairs = np.vstack([anc_keys, pos_keys]).T
+    assert (_tv_distance(old_pairs, new_pairs) < MAX_TV)
+    neg_hist = np.bincount(neg_keys.ravel(), minlength=all_words.size)
+    assert (np.max(np.abs(neg_hist / float(neg_keys.size) - 0.02)) < 0.005)
+
+def test_flat_phrases():
+    # passing in the flattened phrases gives the same draws as not doing so
+    phrases = _test_phrases()
+    flat = hf.flatten_phrases(phrases, min_len=2)
+    npr.seed(4)
+    pairs_a = hf.rand_word_pairs(phrases, 1000, 2)
+    npr.seed(4)
+    pairs_b = hf.rand_word_pairs(phrases, 1000, 2, flat=flat)
+    assert all(np.all(a == b) for (a, b) in zip(pairs_a, pairs_b))
+    # and changing the phrases in place isn't hidden by any caching
+    phrases[0][:] = [7, 7]
+    seq_keys, phrase_keys = hf.rand_word_seqs(phrases, 1000, 2, 9999)
+    assert np.all(seq_keys[phrase_keys == 0,-1] == 7)
+
+def test_short_phrases():
+    # empty phrases are never sampled, and one-key phrases only give seqs
+    npr.seed(5)
+    phrases = [np.zeros((0,), dtype=np.int32)] + _test_phrases() + \
+            [np.asarray([900], dtype=np.int32), np.zeros((0,), dtype=np.int32)]
+    seq_keys, phrase_keys = hf.rand_word_seqs(phrases, 10000, 3, 9999)
+    multi_key = (phrase_keys < 6)
+    assert np.all((seq_keys[multi_key,-1] // 100) == (phrase_keys[multi_key] - 1))
+    assert np.all(seq_keys[~multi_key] == [9999, 9999, 900])
+    assert (set(phrase_keys) == set(range(1, 7)))
+    anc_keys, ctx_keys, phrase_keys = hf.rand_word_pairs(phrases, 10000, 2)
+    assert np.all((anc_keys // 100) == (phrase_keys - 1))
+    assert np.all((ctx_keys // 100) == (phrase_keys - 1))
+    assert (set(phrase_keys) == set(range(1, 6)))
+    phrase_keys = hf.rand_pos_neg(phrases, np.arange(50), 10000, 2, 3)[-1]
+    assert (set(phrase_keys) == set(range(1, 6)))
+
+if __name__ == '__main__':
+    for (test_name, test) in sorted(globals().items()):
+        if test_name.startswith('test_'):
+            test()
+            print("{0:s}: ok".format(test_name))
+
+
+##############
+# EYE BUFFER #
+##############
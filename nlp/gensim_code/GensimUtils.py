@@ -20,11 +20,19 @@ import itertools
 import traceback
 import unicodedata
 
+import numpy as np
+
 if sys.version_info[0] >= 3:
     unicode = str
 
 from six import iteritems, u
 
+# the int8 embedding format is shared with the rest of nlp, in HelperFuncs
+nlp_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (nlp_dir in sys.path):
+    sys.path.append(nlp_dir)
+from HelperFuncs import QuantizedLUT
+
 
 PAT_ALPHABETIC = re.compile('(((?![\d])\w)+)', re.UNICODE)
 RE_HTML_ENTITY = re.compile(r'&(#?)(x?)(\w+);', re.UNICODE)
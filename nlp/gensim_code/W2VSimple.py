@@ -20,24 +20,29 @@ except ImportError:
     from Queue import Queue
 
 from numpy import exp, dot, zeros, outer, random, get_include, float32 as REAL, int64, prod, dtype as np_dtype, \
-    uint32, seterr, array, uint8, vstack, argsort, fromstring, sqrt, newaxis, empty, sum as np_sum
+    uint32, seterr, array, uint8, vstack, argsort, fromstring, sqrt, newaxis, empty, sum as np_sum, \
+    int32, flatnonzero, concatenate, ndarray
 
 logger = logging.getLogger("W2VSimple")
 
 import GensimUtils as gs_utils
+# the streaming corpus reader is shared with the rest of nlp, in CorpusUtils
+nlp_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (nlp_dir in sys.path):
+    sys.path.append(nlp_dir)
+from CorpusUtils import iter_text_blocks, block_key_phrases, LINE_BREAK, \
+                        LINE_BREAK_KEY
 from six import iteritems, itervalues, string_types
 from six.moves import xrange
 
 try:
-    # try to compile and use the faster cython version
-    import pyximport
-    models_dir = os.path.dirname(__file__) or os.getcwd()
-    pyximport.install(setup_args={"include_dirs": [models_dir, get_include()]})
+    # the cython kernels are compiled ahead of time, by running "python
+    # setup.py build_ext --inplace" in this directory
     from W2VInner import train_sentence_sg, train_sentence_cbow, FAST_VERSION
-except:
-    # give up and die
-    print("Training in plain Python is futile :(")
-    assert False
+except ImportError:
+    raise ImportError("W2VInner hasn't been built, run \"python setup.py " \
+            "build_ext --inplace\" in {0:s}".format( \
+            os.path.dirname(os.path.abspath(__file__))))
 
 
 def grouper(iterable, chunksize, as_numpy=False):
@@ -263,7 +268,7 @@ class W2VSimple():
     def train(self, sentences, total_words=None, word_count=0, chunksize=100):
         """
         Update the model's neural weights from a sequence of sentences (can be a once-only generator stream).
-        Each sentence must be a list of unicode strings.
+        Each sentence must be a list of unicode strings, or an int32 array of vocabulary indices.
 
         """
         if FAST_VERSION < 0:
@@ -312,8 +317,16 @@ class W2VSimple():
             thread.daemon = True  # make interrupting the process with ctrl+c easier
             thread.start()
 
+        index_vocabs = [self.vocab[word] for word in self.index2word]
+
         def prepare_sentences():
             for sentence in sentences:
+                # sentences of vocab indices (e.g. from LineSentence with a vocab) skip the word lookups
+                if isinstance(sentence, ndarray):
+                    sampled = [index_vocabs[i] for i in sentence
+                        if index_vocabs[i].sample_probability >= 1.0 or index_vocabs[i].sample_probability >= random.random_sample()]
+                    yield sampled
+                    continue
                 # avoid calling random_sample() where prob >= 1, to speed things up a little:
                 sampled = [self.vocab[word] for word in sentence
                     if word in self.vocab and (self.vocab[word].sample_probability >= 1.0 or self.vocab[word].sample_probability >= random.random_sample())]
@@ -353,6 +366,14 @@ class W2VSimple():
         return
 
 
+    def export_int8(self):
+        """
+        Get an int8 copy of syn0 (see `HelperFuncs.QuantizedLUT`), which can
+        answer lookups and similarity queries at a quarter of the memory.
+        """
+        return gs_utils.QuantizedLUT(self.syn0)
+
+
     def __getitem__(self, word):
         """
         Return a word's representations in vector space, as a 1D numpy array.
@@ -372,7 +393,7 @@ class W2VSimple():
 
 class LineSentence(object):
     """Simple format: one sentence = one line; words already preprocessed and separated by whitespace."""
-    def __init__(self, source):
+    def __init__(self, source, vocab=None):
         """
         `source` can be either a string or a file object.
 
@@ -385,8 +406,20 @@ class LineSentence(object):
             sentences = LineSentence('compressed_text.txt.bz2')
             sentences = LineSentence('compressed_text.txt.gz')
 
+        The source is read and decompressed in a background thread, in large
+        blocks that are tokenized as a whole. If `vocab` is given (e.g. the
+        `vocab` of an already built model), sentences are yielded as int32
+        arrays of vocabulary indices, with out-of-vocabulary words dropped::
+
+            sentences = LineSentence('compressed_text.txt.gz', vocab=model.vocab)
+            model.train(sentences)
+
         """
         self.source = source
+        self.word_index = None
+        if vocab is not None:
+            self.word_index = dict((word, v.index) for word, v in iteritems(vocab))
+            self.word_index[LINE_BREAK] = LINE_BREAK_KEY
         return
 
     def __iter__(self):
@@ -395,11 +428,16 @@ class LineSentence(object):
             # Assume it is a file-like object and try treating it as such
             # Things that don't have seek will trigger an exception
             self.source.seek(0)
-            for line in self.source:
-                yield gs_utils.to_unicode(line).split()
         except AttributeError:
             # If it didn't work like a file, use it as a string filename
-            with gs_utils.smart_open(self.source) as fin:
-                for line in fin:
-                    yield gs_utils.to_unicode(line).split()
+            pass
+        for block in iter_text_blocks(self.source):
+            block = gs_utils.to_unicode(block)
+            if self.word_index is None:
+                for line in block.split(u'\n'):
+                    yield line.split()
+            else:
+                for sentence in block_key_phrases(block, self.word_index.get):
+                    yield sentence
+
 
@@ -0,0 +1,38 @@
+"""
+Ahead-of-time build of the Cython kernels used by W2VSimple. From this
+directory, run:
+
+    python setup.py build_ext --inplace
+
+which puts the compiled W2VInner module next to W2VSimple.py. W2VSimple won't
+import until it has been built.
+
+The kernels are compiled with -O3 for the compiler's default (portable)
+target, so one build runs on any CPU of this architecture. Set NLP_MARCH to
+tune them for some -march, e.g. NLP_MARCH=native for the building machine.
+"""
+
+import os
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Build import cythonize
+from numpy import get_include
+
+models_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(models_dir)
+# voidptr.h lives in the parent directory
+header_dir = os.path.dirname(models_dir)
+compile_args = ['-O3']
+march = os.environ.get('NLP_MARCH', '')
+if march:
+    compile_args.append('-march={0:s}'.format(march))
+
+extensions = [
+    Extension('W2VInner', \
+              ['W2VInner.pyx'], \
+              include_dirs=[models_dir, header_dir, get_include()], \
+              extra_compile_args=compile_args)
+]
+
+setup(name='w2v_kernels', \
+      ext_modules=cythonize(extensions, build_dir='build'))
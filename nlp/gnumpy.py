@@ -201,38 +201,99 @@ def cudamatHas(name):
 
 max_memory_usage = numpy.inf # public
 
-_cmsForReuse = _collections.defaultdict(list) # dict from size to list of reusable (abandoned) cms
+_cmsForReuse = _collections.defaultdict(list) # dict from size class (a power of two) to list of reusable (abandoned) cms of that size
 __memoryInUse = 0
+__memoryPeak = 0
 _memoryUsers = _collections.defaultdict(lambda: (0, 0))
 track_memory_usage = False
 tracked_arrays = _weakref.WeakValueDictionary() # dict of id() to array. The key is never used. This remains empty if track_memory_usage remains False.
+track_pool_stats = False # public. If True, pool hits/misses and peak usage are recorded per allocating line of code. See pool_stats().
+_poolStats = _collections.defaultdict(lambda: [0, 0, 0, 0]) # dict from allocation site to [n hits, n misses, n bytes in use, peak n bytes in use]
+_elemBytes = ( 4 if _useGpu=='yes' else numpy.dtype(_cudamat.__DTYPE__).itemsize ) # bytes per element, including for GNUMPY_CPU_PRECISION on the cpu
+
+def _size_class(size):
+ """ Internal. Returns the smallest power of two that's at least <size>. All memory is allocated in blocks of such sizes. """
+ return 1 << (size-1).bit_length()
 
 def _new_cm(sizeOrShape):
  """
  Internal.
  Returns a new CUDAMatrix object of the given size.
  This is the only proc that allocs gpu mem.
+ Memory comes in power-of-two size classes. If an abandoned block of the right size class is available, the new cm is (a view on the start of) that block, so this only allocates when the pool for that size class is empty.
  """
- global __memoryInUse
  if type(sizeOrShape) == tuple:
   if _prodT(sizeOrShape)==0: return _new_cm(1) # cudamat workaround: cudamat can't handle size 0 arrays
   else: return _new_cm(sizeOrShape[0]*sizeOrShape[1]).reshape((sizeOrShape[1], sizeOrShape[0]))
  size = sizeOrShape
  if size==0: return _cudamat.empty((1, 1)) # cudamat workaround
- if len(_cmsForReuse[size])!=0:
-  return _cm_reshape(_cmsForReuse[size].pop(), (1, size)) # re-use an abandoned cm
+ sizeClass = _size_class(size)
+ isHit = len(_cmsForReuse[sizeClass])!=0
+ if isHit: block = _cmsForReuse[sizeClass].pop() # re-use an abandoned block
+ else: block = _alloc_cm(sizeClass)
+ if size==sizeClass: ret = _cm_reshape(block, (1, size))
+ else:
+  ret = _cm_reshape(_cm_reshape(block, (sizeClass, 1)).get_col_slice(0, size), (1, size)) # a view on the first <size> elements of the block
+  ret._pool_block = block
+ ret._pool_size_class = sizeClass
+ if track_pool_stats: _pool_stats_add(ret, isHit)
+ return ret
+
+def _alloc_cm(sizeClass):
+ """ Internal. Allocates a new block of <sizeClass> elements, respecting max_memory_usage. """
+ global __memoryInUse, __memoryPeak
+ nBytes = sizeClass*_elemBytes
  _init_gpu()
- if __memoryInUse+size*4*5 > max_memory_usage: free_reuse_cache(False) # if we're somewhat close to the limit, then free what's easy to free, and hope that there are contiguous blocks available.
- if __memoryInUse+size*4 > max_memory_usage: # if we're (still) OVER the limit, then do whatever can be done to make more mem available
+ if __memoryInUse+nBytes*5 > max_memory_usage: free_reuse_cache(False) # if we're somewhat close to the limit, then free what's easy to free, and hope that there are contiguous blocks available.
+ if __memoryInUse+nBytes > max_memory_usage: # if we're (still) OVER the limit, then do whatever can be done to make more mem available
   free_reuse_cache(True) # gc.collect can take quite some time
-  if __memoryInUse+size*4 > max_memory_usage:
-   raise MemoryError('Gnumpy ran out of memory. Currently in use are %s; the maximum allowed is %s; so the present request for %s is refused. Free some memory and try again.' % (_n_bytes_str(__memoryInUse), _n_bytes_str(max_memory_usage), _n_bytes_str(size*4)))
+  if __memoryInUse+nBytes > max_memory_usage:
+   raise MemoryError('Gnumpy ran out of memory. Currently in use are %s; the maximum allowed is %s; so the present request for %s is refused. Free some memory and try again.' % (_n_bytes_str(__memoryInUse), _n_bytes_str(max_memory_usage), _n_bytes_str(nBytes)))
  try:
-  ret = _cudamat.empty((size, 1))
-  __memoryInUse += size*4 # do this only if the malloc succeeded
+  ret = _cudamat.empty((sizeClass, 1))
+  __memoryInUse += nBytes # do this only if the malloc succeeded
+  __memoryPeak = __builtin__.max(__memoryPeak, __memoryInUse)
   return ret
  except _cudamat.CUDAMatException, e: # this means that malloc failed
-  raise MemoryError('The GPU failed to allocate the requested %d bytes of memory. This doesn\'t mean that your program is using too much memory. It does, however, mean that you should reduce the value of gnumpy.max_memory_usage (currently %s), to always have some memory unused (which is necessary to find contiguous large blocks of memory to allocate). Failing to allocate enough memory makes the GPU feel very unwell, so you are advised to restart Python now, or expect to see incoherent error messages and risk causing more serious damage.' % (size*4, str(max_memory_usage)))
+  raise MemoryError('The GPU failed to allocate the requested %d bytes of memory. This doesn\'t mean that your program is using too much memory. It does, however, mean that you should reduce the value of gnumpy.max_memory_usage (currently %s), to always have some memory unused (which is necessary to find contiguous large blocks of memory to allocate). Failing to allocate enough memory makes the GPU feel very unwell, so you are advised to restart Python now, or expect to see incoherent error messages and risk causing more serious damage.' % (nBytes, str(max_memory_usage)))
+
+def _release_cm(cm):
+ """ Internal. Puts the block behind a cm from _new_cm back in the pool for its size class. cms that didn't come from the pool are left to the garbage collector. """
+ sizeClass = getattr(cm, '_pool_size_class', None)
+ if sizeClass is None: return
+ if hasattr(cm, '_pool_site'): _pool_stats_remove(cm)
+ _cmsForReuse[sizeClass].append(getattr(cm, '_pool_block', cm))
+
+def _allocation_site():
+ """ Internal. A cheap description of the first line of code outside gnumpy on the call stack. """
+ frame = _sys._getframe(1)
+ while frame is not None and frame.f_globals is globals(): frame = frame.f_back
+ if frame is None: return '<unknown>'
+ return '%s:%d (%s)' % (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+def _pool_stats_add(cm, isHit):
+ site = _allocation_site()
+ stats = _poolStats[site]
+ stats[( 0 if isHit else 1)] += 1
+ stats[2] += cm._pool_size_class*_elemBytes
+ stats[3] = __builtin__.max(stats[3], stats[2])
+ cm._pool_site = site
+
+def _pool_stats_remove(cm):
+ _poolStats[cm._pool_site][2] -= cm._pool_size_class*_elemBytes
+ del cm._pool_site
+
+def pool_stats(reset=False):
+ """
+ Returns a dict from allocation site (a line of code) to a dict with the number of pool 'hits' and 'misses', the 'hit_rate', and the current and peak number of bytes handed out to that site ('bytes_in_use', 'peak_bytes').
+ Statistics are only collected while gnumpy.track_pool_stats is True. If <reset> is True, the statistics collected so far are cleared after reading them.
+ """
+ ret = {}
+ for site, (nHits, nMisses, nBytes, peakBytes) in _poolStats.items():
+  ret[site] = {'hits': nHits, 'misses': nMisses, 'hit_rate': float(nHits) / __builtin__.max(1, nHits+nMisses), 'bytes_in_use': nBytes, 'peak_bytes': peakBytes}
+ if reset:
+  for stats in _poolStats.values(): stats[0] = stats[1] = 0; stats[3] = stats[2]
+ return ret
 
 def free_reuse_cache(completely=True):
  """
@@ -241,10 +302,10 @@ def free_reuse_cache(completely=True):
  """
  if completely: _gc.collect() # this has to happen before the loop, because this may add more entries in _cmsForReuse which then have to be freed by the loop
  global __memoryInUse
- for size in _cmsForReuse:
-  while _cmsForReuse[size]:
-   _cmsForReuse[size].pop()
-   __memoryInUse -= size*4
+ for sizeClass in _cmsForReuse:
+  while _cmsForReuse[sizeClass]:
+   _cmsForReuse[sizeClass].pop()
+   __memoryInUse -= sizeClass*_elemBytes
  del _gc.garbage[:] # this shouldn't be necessary at all, but for some reason perfectly referenced AND perfectly deletable cms get put there
 
 def _n_bytes_str(n):
@@ -255,6 +316,10 @@ def memory_in_use(in_megabytes=False):
  """ returns the number of bytes (or megabytes if you asked for that) of GPU memory that are in use. """
  return __memoryInUse // ( 2**20 if in_megabytes else 1)
    
+def memory_peak(in_megabytes=False):
+ """ returns the largest number of bytes (or megabytes if you asked for that) of GPU memory that have been in use at any one time, including memory kept for re-use. """
+ return __memoryPeak // ( 2**20 if in_megabytes else 1)
+
 def memory_available(free_reuse_cache_first):
  if free_reuse_cache_first: free_reuse_cache()
  return max_memory_usage - memory_in_use()
@@ -299,7 +364,7 @@ def status():
  if usingGpu():
   if _boardId==None: print 'gnumpy is planning to run on a GPU, but hasn\'t yet chosen & initialized a board.'
   else: print 'gnumpy is running on GPU board #%d.' % _boardId
- print '%s of gpu memory are in use, of which at least %s can be freed immediately by gnumpy.free_reuse_cache().' % (_n_bytes_str(__memoryInUse), _n_bytes_str(__builtin__.sum( size*len(cms)*4 for size, cms in _cmsForReuse.items())))
+ print '%s of gpu memory are in use, of which at least %s can be freed immediately by gnumpy.free_reuse_cache().' % (_n_bytes_str(__memoryInUse), _n_bytes_str(__builtin__.sum( sizeClass*len(cms)*_elemBytes for sizeClass, cms in _cmsForReuse.items())))
  
  
   
@@ -728,7 +793,7 @@ class garray(object):
    if self._is_alias_of==None and track_memory_usage:
     self.allocating_line = _calling_line()
     tracked_arrays[id(self)] = self
-    _memoryUsers[self.allocating_line] = (_memoryUsers[self.allocating_line][0]+1, _memoryUsers[self.allocating_line][1]+self.size*4)
+    _memoryUsers[self.allocating_line] = (_memoryUsers[self.allocating_line][0]+1, _memoryUsers[self.allocating_line][1]+self.size*_elemBytes)
   elif isinstance(data, garray):
    if ndmin>0: data = data._add_axes(ndmin)
    garray.__init__(self, 
@@ -1148,8 +1213,8 @@ class garray(object):
    return # this object was never finished, because an exception (error or interrupt) occurred in the constructor. This check avoids error messages.
   if self._is_alias_of is None:
    # this is not true in one case: if a reference to self._base is stored somewhere explicitly (somewhere outside self but not in another garray). This happens internally sometimes. I saw it happening on the last line of setitem: a transpose is created (transposes own their mem, are not aliases), and then it's dropped but _base (obtained by _base_as_row) is still in use for a cm assign call. assert _sys.getrefcount(self._base)==2, _sys.getrefcount(self._base)
-   _cmsForReuse[self.size].append(self._base)
-   if track_memory_usage: _memoryUsers[self.allocating_line] = (_memoryUsers[self.allocating_line][0]-1, _memoryUsers[self.allocating_line][1]-self.size*4)
+   _release_cm(self._base)
+   if track_memory_usage: _memoryUsers[self.allocating_line] = (_memoryUsers[self.allocating_line][0]-1, _memoryUsers[self.allocating_line][1]-self.size*_elemBytes)
   else:
    assert type(self._is_alias_of).__name__ == 'garray', '_is_alias_of is of unexpected type, of which the str() is: "%s"' % str(type(self._is_alias_of))
    # del self._base # this is only to make the refcount assert not fail
@@ -1,8 +1,15 @@
-from time import clock
+import os
+import sys
 import numpy as np
 import numpy.random as npr
 from scipy import signal as signal
 
+# the profiling helpers are shared with the rest of nlp, in HelperFuncs
+nlp_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not (nlp_dir in sys.path):
+    sys.path.append(nlp_dir)
+from HelperFuncs import PhaseProfiler, wall_time
+
 #
 # Each LNLayer class provides several methods that are intended for use by
 # an external controller.
@@ -63,7 +70,7 @@ class KMaxLayer:
     def feedforward(self, input, auto_prop=False):
         """Perform feedforward through this layer.
         """
-        t1 = clock()
+        t1 = wall_time()
         # Roughly check that self.kmax was reasonably set prior to
         # attempting feedforward
         assert (len(input) == len(self.kmax))
@@ -77,7 +84,7 @@ class KMaxLayer:
         # Use the indices to construct the kmaxed output sequences
         self.Y = [self._apply_kmax(x, km_idx) for (x, km_idx) \
                 in zip(self.X, self.kmax_idx)]
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it forward
         if auto_prop and self.output_layer:
@@ -96,11 +103,11 @@ class KMaxLayer:
             assert (y.shape == dldy.shape)
 
         # Backprop through the k-max activation for each sequence
-        t1 = clock()
+        t1 = wall_time()
         self.dLdY = dLdY_bp
         self.dLdX = [self._unapply_kmax(x, dldy, km_idx) for (x, dldy, km_idx) \
                 in zip(self.X, self.dLdY, self.kmax_idx)]
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it backward
         if auto_prop and self.input_layer:
@@ -169,7 +176,7 @@ class KMaxNormLayer:
     def feedforward(self, input, auto_prop=False):
         """Perform feedforward through this layer.
         """
-        t1 = clock()
+        t1 = wall_time()
         # Roughly check that self.kmax was reasonably set prior to
         # attempting feedforward
         assert (len(input) == len(self.kmax))
@@ -183,7 +190,7 @@ class KMaxNormLayer:
         # Use the indices to construct the kmaxed output sequences
         self.Y = [self._apply_kmax(x, km_idx) for (x, km_idx) \
                 in zip(self.X, self.kmax_idx)]
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it forward
         if auto_prop and self.output_layer:
@@ -202,11 +209,11 @@ class KMaxNormLayer:
             assert (y.shape == dldy.shape)
 
         # Backprop through the k-max activation for each sequence
-        t1 = clock()
+        t1 = wall_time()
         self.dLdY = dLdY_bp
         self.dLdX = [self._unapply_kmax(x, dldy, km_idx) for (x, dldy, km_idx) \
                 in zip(self.X, self.dLdY, self.kmax_idx)]
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it backward
         if auto_prop and self.input_layer:
@@ -524,14 +531,14 @@ class FullLayer:
     def feedforward(self, input, auto_prop=False):
         """Run feedforward for this layer.
         """
-        t1 = clock()
+        t1 = wall_time()
         # Cleanup detritus from any previous feedforward
         self.cleanup()
         # Do new feedforward...
         self.X = input
         self.Y = np.dot(self.X, self.params['W']) + self.params['b']
         self.dLdY = np.zeros(self.Y.shape)
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         if auto_prop and self.output_layer:
             self.output_layer.feedforward(self.Y, True)
@@ -540,7 +547,7 @@ class FullLayer:
     def backprop(self, dLdY_bp, auto_prop=False):
         """Backprop through this layer.
         """
-        t1 = clock()
+        t1 = wall_time()
         self.dLdY = self.dLdY + dLdY_bp
         # Compute gradient with respect to layer parameters
         dLdW = np.dot(self.X.T, self.dLdY)
@@ -549,7 +556,7 @@ class FullLayer:
         self.param_grads['b'] = self.param_grads['b'] + dLdb
         # Compute gradient with respect to layer input
         self.dLdX = np.dot(self.dLdY, self.params['W'].T)
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         if auto_prop and self.input_layer:
             self.input_layer.backprop(self.dLdX, True)
@@ -692,7 +699,7 @@ class C1DLayer:
         The input passed to feedforward here should be either a single list
         of integer indices into the look-up table or a list of lut index lists.
         """
-        t1 = clock()
+        t1 = wall_time()
         # Cleanup detritus from any previous feedforward
         self.cleanup()
         self.X = input
@@ -701,7 +708,7 @@ class C1DLayer:
         # Convolve filters with each vector sequence in the input list
         self.Y = [self._conv_1d(xc) for xc in self.Xc]
         # Stop timer
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it forward
         if auto_prop and self.output_layer:
@@ -715,14 +722,14 @@ class C1DLayer:
         assert (len(dLdY_bp) == len(self.Y))
         for (y, dldy) in zip(self.Y, dLdY_bp):
             assert (y.shape == dldy.shape)
-        t1 = clock()
+        t1 = wall_time()
         self.dLdY = dLdY_bp
         # Compute gradients w.r.t. input sequences, note that this also
         # performs updates to self.param_grads['W'] and self.param_grads['b']
         # while computing gradients w.r.t. input sequences.
         self.dLdX = [self._deconv_1d(x, xc, dldy) for (x, xc, dldy) \
                 in zip(self.X, self.Xc, self.dLdY)]
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         # Pay it backward
         if auto_prop and self.input_layer:
@@ -804,7 +811,7 @@ class LUTLayer:
         of integer indices into the look-up table or a list of lut index lists.
         """
         # Cleanup detritus from any previous feedforward
-        t1 = clock()
+        t1 = wall_time()
         self.cleanup()
         if type(input[0]) is int:
             # List-of-listsify any single list of lut indices
@@ -822,7 +829,7 @@ class LUTLayer:
             # Convert this lut index sequence to a vector sequence
             vec_seq = W[idx_seq,:]
             self.Y.append(vec_seq)
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         if auto_prop and self.output_layer:
             self.output_layer.feedforward(self.Y, True)
@@ -832,7 +839,7 @@ class LUTLayer:
         """Backprop through this layer.
         """
         # Check that the shape of the incoming gradients is valid
-        t1 = clock()
+        t1 = wall_time()
         assert (len(dLdY_bp) == len(self.Y))
         for (out_seq, bp_seq) in zip(self.Y, dLdY_bp):
             assert (out_seq.shape == bp_seq.shape)
@@ -843,7 +850,7 @@ class LUTLayer:
                 dLdW[lut_idx,:] = dLdW[lut_idx,:] + dldy[seq_idx,:]
         # Add the gradients to the gradient accumulator
         self.param_grads['W'] = self.param_grads['W'] + dLdW
-        t2 = clock()
+        t2 = wall_time()
         self.comp_time = self.comp_time + (t2 - t1)
         return dLdW
 
@@ -909,7 +916,7 @@ if __name__ == '__main__':
     conv_layer_2 = C1DLayer(num_filt_2, filt_len_2, num_filt_1, km_layer_1)
     km_layer_2 = KMaxLayer(conv_layer_2)
     print("Feeding batches through conv layers:")
-    t1 = clock()
+    t1 = wall_time()
     for i in range(5):
         idx_batches = [rand_idx_list(key_count, batch_size) for b in range(batch_count)]
         km_layer_1.kmax = [10 for idx_batch in idx_batches]
@@ -921,7 +928,7 @@ if __name__ == '__main__':
             dLdY.append(np.zeros(y.shape))
         km_layer_2.backprop(dLdY, True)
         print("-- completed batch {0:d}.".format(i))
-    t2 = clock()
+    t2 = wall_time()
     e_time = t2 - t1
     print("Elapsed time: {0:.4f}".format(e_time))
     print("lut time: {0:.4f}".format(lut_layer.comp_time))
@@ -1,5 +1,4 @@
 from sys import stdout as stdout
-from time import clock
 import numpy as np
 import numpy.random as npr
 import LNLayers as lnl
@@ -102,6 +101,8 @@ class KMaxNet:
             if (i < (len(fcl_opts_list) - 1)):
                 relu_layer = lnl.ReluLayer(in_layer=self.all_layers[-1])
                 self.all_layers.append(relu_layer)
+        # Per-phase timers for training, off unless set_profiler() is called
+        self.prof = lnl.PhaseProfiler(enabled=False)
         return
 
     def check_opts(self, options={}):
@@ -212,6 +213,11 @@ class KMaxNet:
                 moms['b'] = np.zeros(moms['b'].shape) + ada_init
         return
 
+    def set_profiler(self, prof):
+        """Time the phases of process_training_batch() with prof."""
+        self.prof = prof
+        return
+
     def set_drop_rate(self, drop_rate=0.0):
         """Set the drop rate in all droppy layers."""
         # Set dropout rate
@@ -297,16 +303,24 @@ class KMaxNet:
 
     def process_training_batch(self, X, Y, learn_rate, use_dropout=False):
         """Process a batch of phrases Xb with labels Yb."""
+        prof = self.prof
         # Run feedforward for the batch
         batch_size = float(len(X))
+        prof.start('ff')
         Yh = self.feedforward(X, use_dropout)
+        prof.stop('ff')
         # Compute loss and gradient for the network predictions
+        prof.start('loss')
         loss_info = self.cross_entropy(Yh, Y)
         acc = loss_info[2]
         L = loss_info[0] / batch_size
         dLdYh = loss_info[1] / batch_size
+        prof.stop('loss')
         # Run backprop for the given loss gradients
+        prof.start('bp')
         self.backprop(dLdYh)
+        prof.stop('bp')
+        prof.start('update')
         # LUT layer uses adagrad updates
         p_mom = self.lut_moms['W']
         p_grad = self.lut_layer.param_grads['W']
@@ -329,11 +343,16 @@ class KMaxNet:
                     (layer.param_grads['W'] / np.sqrt(layer_moms['W'] + 1e-3))
             layer.params['b'] -= learn_rate * \
                     (layer.param_grads['b'] / np.sqrt(layer_moms['b'] + 1e-3))
+        prof.stop('update')
         # Reset gradient accumulators and apply norm bounds (via clipping)
+        prof.start('reg')
         for layer in self.all_layers:
             if layer.has_params:
                 layer.clip_params()
                 layer.reset_grads(shrink=0.0)
+        prof.stop('reg')
+        prof.count('phrases', len(X))
+        prof.end_batch()
         return [L, acc]
 
     def dev_loss(self, X, Y, M, Ws=[]):
@@ -359,7 +378,6 @@ def rand_idx_list(max_idx, samples):
     return idx_list
 
 if __name__ == '__main__':
-    from time import clock as clock
     print("Bonjour, monde!")
 
 
@@ -4,7 +4,6 @@ import StanfordTrees as st
 import LNLayers as lnl
 import LayerNets as ln
 import random as random
-from time import clock
 from sys import stdout as stdout
 
 def simple_stb_test(tree_dir='./trees'):
@@ -26,6 +25,7 @@ if __name__ == '__main__':
     # Initialize a network
     KMN = ln.KMaxNet(basic_opts)
     KMN.init_weights(w_scale=0.05, b_shift=0.1)
+    KMN.set_profiler(lnl.PhaseProfiler(report_every=50))
 
     # Get a "flattened" list of training phrases and classes
     train_phrases = []
@@ -50,7 +50,7 @@ if __name__ == '__main__':
         # Perform batch updates for the current epoch
         L = 0.0
         acc = 0.0
-        t1 = clock()
+        t1 = lnl.wall_time()
         random.shuffle(train_pairs)
         if ((e % 5) == 0):
             KMN.reset_moms(ada_init=0.0, clear_moms=False)
@@ -73,10 +73,13 @@ if __name__ == '__main__':
                         completed_batches, (L / 50.0), (acc / 50.0)))
                 L = 0.0
                 acc = 0.0
-                t2 = clock()
+                t2 = lnl.wall_time()
                 print("-- time: {0:.2f}".format(t2-t1))
-                t1 = clock()
+                t1 = lnl.wall_time()
                 stdout.flush()
+        # show where the time went (ff/bp/update/etc.) in this epoch
+        print(KMN.prof.report())
+        KMN.prof.reset()
 
 
 
@@ -2,6 +2,14 @@
 
 import os, pdb, time, warnings
 import numpy as np
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+try:
+    from scipy.linalg.blas import get_blas_funcs
+except ImportError:
+    get_blas_funcs = None
 
 __DTYPE__ = np.float64
 
@@ -39,6 +47,54 @@ InvalidConfig = CUDAMatException("Invalid Configuration Error (i.e., a dim of th
 MAX_DIM = 2**16
 
 
+## In-place kernels. Elementwise ops are evaluated straight into the target
+## array with numexpr (which is multithreaded, see NUMEXPR_NUM_THREADS) and
+## products are accumulated with BLAS gemm, so no temporaries are created.
+## Without numexpr/scipy, or for dtypes they don't handle, plain numpy is used.
+
+_NE_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+_NP_FUNCS = {'exp': np.exp, 'log': np.log, 'sqrt': np.sqrt, 'tanh': np.tanh,
+             'where': np.where}
+
+def _elementwise(expr, target, **operands):
+    """
+    Evaluate the elementwise expression expr (in numexpr syntax) over the given
+    numpy arrays/scalars, writing the result into target's array in place.
+    """
+    out = target.numpy_array
+    if ne is not None and out.dtype in _NE_DTYPES:
+        ne.evaluate(expr, local_dict=operands, out=out, casting='unsafe')
+    else:
+        out[...] = eval(expr, _NP_FUNCS, operands)
+    return target
+
+def _gemm(alpha, a, b, beta, c):
+    """
+    Compute c = alpha * dot(a, b) + beta * c in place, with a single BLAS call
+    when c is contiguous.
+    """
+    if get_blas_funcs is not None and c.dtype in _NE_DTYPES:
+        if c.flags.f_contiguous:
+            gemm = get_blas_funcs('gemm', (c,))
+            res = gemm(alpha, a, b, beta=beta, c=c, overwrite_c=True)
+        elif c.flags.c_contiguous:
+            # c.T is fortran-ordered, so compute c.T = alpha * b.T a.T + ...
+            gemm = get_blas_funcs('gemm', (c,))
+            res = gemm(alpha, b.T, a.T, beta=beta, c=c.T, overwrite_c=True).T
+        else:
+            res = None
+        if res is not None:
+            if not np.may_share_memory(res, c):
+                c[...] = res
+            return c
+    if beta == 0.:
+        c[...] = alpha * np.dot(a, b)
+    else:
+        c *= beta
+        c += alpha * np.dot(a, b)
+    return c
+
+
 class CUDAMatrix(object):
     """
     A CUDAMatrix object represents a matrix of single precision floating point
@@ -78,7 +134,7 @@ class CUDAMatrix(object):
         assert shape[0]*shape[1] == self.shape[0]*self.shape[1]
         #self.numpy_array.resize(shape)
         #self.numpy_array = self.numpy_array.reshape(shape, order='F')
-        self.numpy_array.resize(*shape)
+        self.numpy_array = self.numpy_array.reshape(shape, order='F')
         return self
 
 
@@ -372,7 +428,7 @@ class CUDAMatrix(object):
 
         target.resize(self.shape)
 
-        target.numpy_array[:] = self.numpy_array + vec.numpy_array
+        _elementwise('a + v', target, a=self.numpy_array, v=vec.numpy_array)
 
         return target
 
@@ -399,7 +455,8 @@ class CUDAMatrix(object):
 
         target.resize(self.shape)
 
-        target.numpy_array[:] = self.numpy_array + vec.numpy_array * mult
+        _elementwise('a + v * m', target, a=self.numpy_array,
+                     v=vec.numpy_array, m=mult)
 
         return target
 
@@ -430,7 +487,7 @@ class CUDAMatrix(object):
 
         target.resize(self.shape)
 
-        target.numpy_array[:] = vec.numpy_array + self.numpy_array
+        _elementwise('v + a', target, a=self.numpy_array, v=vec.numpy_array)
 
         return target
 
@@ -460,7 +517,7 @@ class CUDAMatrix(object):
         target.resize(self.shape)
 
 
-        target.numpy_array[:] = vec.numpy_array * self.numpy_array
+        _elementwise('v * a', target, a=self.numpy_array, v=vec.numpy_array)
 
 
         return target
@@ -485,7 +542,7 @@ class CUDAMatrix(object):
         target.resize(self.shape)
 
 
-        target.numpy_array[:] = vec.numpy_array * self.numpy_array
+        _elementwise('v * a', target, a=self.numpy_array, v=vec.numpy_array)
 
         return target
         
@@ -502,20 +559,7 @@ class CUDAMatrix(object):
 
 
 
-        if axis == 0:
-            ans = self.numpy_array.sum(0)[np.newaxis, :]
-        elif axis == 1:
-            ans = self.numpy_array.sum(1)[:, np.newaxis]
-        else:
-            raise ValueError("axis must be only 0 or 1; instead, got %s\n", axis)
-
-        ans = CUDAMatrix(ans)
-
-        if target is not None:
-            target.assign(ans)
-        else:
-            target = ans
-        return target
+        return _reduce(np.sum, self, axis, target)
 
 
     def mean(self, axis, target = None):
@@ -523,20 +567,7 @@ class CUDAMatrix(object):
 
 
 
-        if axis == 0:
-            ans = self.numpy_array.mean(0)[np.newaxis, :]
-        elif axis == 1:
-            ans = self.numpy_array.mean(1)[:, np.newaxis]
-        else:
-            raise ValueError("axis must be only 0 or 1; instead, got %s\n", axis)
-
-        ans = CUDAMatrix(ans)
-
-        if target is not None:
-            target.assign(ans)
-        else:
-            target = ans
-        return target
+        return _reduce(np.mean, self, axis, target)
 
 
 
@@ -585,14 +616,16 @@ class CUDAMatrix(object):
         target.resize(self.shape)
 
         if isinstance(val, (int, float, __DTYPE__)):
-            target.numpy_array[:] = self.numpy_array < val
+            _elementwise('where(a < v, 1.0, 0.0)', target, a=self.numpy_array,
+                         v=val)
 
         else:
             if val.shape != self.shape:
                 raise IncompatibleDimensionsException
 
 
-            target.numpy_array[:] = (self.numpy_array < val.numpy_array).astype(__DTYPE__)
+            _elementwise('where(a < v, 1.0, 0.0)', target, a=self.numpy_array,
+                         v=val.numpy_array)
 
         return target
 
@@ -614,13 +647,15 @@ class CUDAMatrix(object):
         target.resize(self.shape)
 
         if isinstance(val, (int, float, __DTYPE__)):
-            target.numpy_array[:] = (self.numpy_array > val).astype(__DTYPE__)
+            _elementwise('where(a > v, 1.0, 0.0)', target, a=self.numpy_array,
+                         v=val)
         else:
             if val.shape != self.shape:
                 raise IncompatibleDimensionsException
 
 
-            target.numpy_array[:] = (self.numpy_array > val.numpy_array).astype(__DTYPE__)
+            _elementwise('where(a > v, 1.0, 0.0)', target, a=self.numpy_array,
+                         v=val.numpy_array)
 
         return target
 
@@ -640,48 +675,9 @@ class CUDAMatrix(object):
 
 
 
-        m, n = self.shape
-
-        if axis == 0:
-            if target is None:
-                target = empty((1, n))
-
-            target.resize((1, n))
-
- 
-            target.numpy_array[:] = self.numpy_array.max(0)
-
-        
-
-        elif axis == 1:
-            # IN theory: we are supposed to do this:
-
-#             if not target:
-#                 #target = CUDAMatrix(np.empty((m, 1), dtype=np.float32, order = 'F'))
-#                 target = empty((m, 1))
-#             else:
-#                 target.resize((m, 1))
-                
-
-
-#             err_code =  _cudamat.max_by_axis(self.p_mat, target.p_mat, ct.c_int(axis))
-#             if err_code:
-#                 raise generate_exception(err_code)
-
-            assert transpose_aux != None
-
-            self.transpose(target = transpose_aux)
-
-            target.reshape(target.shape[::-1])
-
-            transpose_aux.max(axis = 0, target = target)
-
-            target.reshape(target.shape[::-1])
-
-
-
-
-        return target
+        # transpose_aux is only needed by cudamat, as numpy can reduce
+        # along either axis directly.
+        return _reduce(np.max, self, axis, target)
 
     def assign_max(self, mat, axis, transpose_aux=None):
         return mat.max(axis, target = self, transpose_aux = transpose_aux)
@@ -701,7 +697,7 @@ class CUDAMatrix(object):
 
         target.resize(self.shape)
 
-        target.numpy_array[:] = np.sign(self.numpy_array)
+        np.sign(self.numpy_array, out=target.numpy_array)
 
         return target
 
@@ -767,7 +763,7 @@ class CUDAMatrix(object):
         target.resize(self.shape)
 
 
-        target.numpy_array[:] = 1./self.numpy_array[:]
+        _elementwise('1. / a', target, a=self.numpy_array)
 
         return target
 
@@ -795,12 +791,10 @@ class CUDAMatrix(object):
         """
 
 
-        m3 = dot(m1, m2)
-
-        if m3.shape != self.shape:
+        if (m1.shape[0], m2.shape[1]) != self.shape or m1.shape[1] != m2.shape[0]:
             raise IncompatibleDimensionsException
 
-        self.numpy_array += m3.numpy_array
+        _gemm(1., m1.numpy_array, m2.numpy_array, 1., self.numpy_array)
 
 
         return self
@@ -812,12 +806,10 @@ class CUDAMatrix(object):
 
 
 
-        m3 = dot(m1, m2)
-
-        if m3.shape != self.shape:
+        if (m1.shape[0], m2.shape[1]) != self.shape or m1.shape[1] != m2.shape[0]:
             raise IncompatibleDimensionsException
 
-        self.numpy_array -= m3.numpy_array
+        _gemm(-1., m1.numpy_array, m2.numpy_array, 1., self.numpy_array)
 
 
         return self
@@ -831,7 +823,8 @@ class CUDAMatrix(object):
         if mat2.shape != self.shape:
             raise IncompatibleDimensionsException
 
-        self.numpy_array += mat2.numpy_array * alpha
+        _elementwise('a + b * alpha', self, a=self.numpy_array,
+                     b=mat2.numpy_array, alpha=alpha)
 
         return self
     
@@ -850,7 +843,8 @@ class CUDAMatrix(object):
         if mat2.shape != self.shape:
             raise IncompatibleDimensionsException
 
-        self.numpy_array -= mat2.numpy_array * alpha
+        _elementwise('a - b * alpha', self, a=self.numpy_array,
+                     b=mat2.numpy_array, alpha=alpha)
 
         return self
 
@@ -870,10 +864,10 @@ class CUDAMatrix(object):
         if isinstance(val, CUDAMatrix):
             if target.shape != val.shape:
                 raise IncompatibleDimensionsException
-            target.numpy_array[:] = self.numpy_array + val.numpy_array
+            _elementwise('a + b', target, a=self.numpy_array, b=val.numpy_array)
 
         elif isinstance(val, (int, float, __DTYPE__)):
-            target.numpy_array[:] = self.numpy_array + val
+            _elementwise('a + b', target, a=self.numpy_array, b=val)
         else:
             raise ValueError, "Value must be of type CUDAMatrix, int, or float."
 
@@ -901,10 +895,10 @@ class CUDAMatrix(object):
         if isinstance(val, CUDAMatrix):
             if target.shape != val.shape:
                 raise IncompatibleDimensionsException
-            target.numpy_array[:] = self.numpy_array - val.numpy_array
+            _elementwise('a - b', target, a=self.numpy_array, b=val.numpy_array)
 
         elif isinstance(val, (int, float, __DTYPE__)):
-            target.numpy_array[:] = self.numpy_array - val
+            _elementwise('a - b', target, a=self.numpy_array, b=val)
         else:
             raise ValueError, "Value must be of type CUDAMatrix, int, or float."
 
@@ -934,10 +928,10 @@ class CUDAMatrix(object):
         if isinstance(val, CUDAMatrix):
             if target.shape != val.shape:
                 raise IncompatibleDimensionsException
-            target.numpy_array[:] = self.numpy_array / val.numpy_array
+            _elementwise('a / b', target, a=self.numpy_array, b=val.numpy_array)
 
         elif isinstance(val, (int, float, __DTYPE__)):
-            target.numpy_array[:] = self.numpy_array / val
+            _elementwise('a / b', target, a=self.numpy_array, b=val)
         else:
             raise ValueError, "Value must be of type CUDAMatrix, int, or float."
 
@@ -966,10 +960,10 @@ class CUDAMatrix(object):
         if isinstance(val, CUDAMatrix):
             if target.shape != val.shape:
                 raise IncompatibleDimensionsException
-            target.numpy_array[:] = self.numpy_array * val.numpy_array
+            _elementwise('a * b', target, a=self.numpy_array, b=val.numpy_array)
 
         elif isinstance(val, (int, float, __DTYPE__)):
-            target.numpy_array[:] = self.numpy_array * val
+            _elementwise('a * b', target, a=self.numpy_array, b=val)
         else:
             raise ValueError, "Value must be of type CUDAMatrix, int, or float."
 
@@ -1036,7 +1030,7 @@ def empty(shape=None):
     if shape is None:
         shape = (1, 1)
 
-    return CUDAMatrix(np.empty(shape))
+    return CUDAMatrix(np.empty(shape, dtype=__DTYPE__, order='F'), ref=False)
 
 
 def zeros(shape):
@@ -1057,6 +1051,28 @@ def sum(mat, axis, target = None):
     return mat.sum(axis, target)
 
 
+def _reduce(func, mat, axis, target = None):
+    """
+    Reduce mat along the given axis with the numpy reduction func (np.sum,
+    np.mean or np.max), writing straight into target.
+    """
+    if axis == 0:
+        target_shape = (1, mat.shape[1])
+    elif axis == 1:
+        target_shape = (mat.shape[0], 1)
+    else:
+        raise ValueError("axis must be only 0 or 1; instead, got %s\n", axis)
+
+    if target is None:
+        target = empty(target_shape)
+
+    target.resize(target_shape)
+
+    func(mat.numpy_array, axis=axis, out=target.numpy_array, keepdims=True)
+
+    return target
+
+
 def dot(m1, m2, target = None):
     """
     Find the dot product between m1 and m2.
@@ -1071,11 +1087,11 @@ def dot(m1, m2, target = None):
 
     target.resize(target_shape)
 
-    try:
-        target.numpy_array[:] = np.dot(m1.numpy_array, m2.numpy_array)
-    except ValueError:
+    if m1.shape[1] != m2.shape[0]:
         raise IncompatibleDimensionsException
 
+    _gemm(1., m1.numpy_array, m2.numpy_array, 0., target.numpy_array)
+
     return target
 
 def vdot(m1, m2):
@@ -1095,7 +1111,7 @@ def sigmoid(mat, target = None):
 
     target.resize(mat.shape)
 
-    target.numpy_array[:] = 1. / (1 + np.exp(-mat.numpy_array))
+    _elementwise('1. / (1. + exp(-a))', target, a=mat.numpy_array)
 
     return target
 
@@ -1111,7 +1127,7 @@ def tanh(mat, target = None):
 
     target.resize(mat.shape)
 
-    target.numpy_array[:] = np.tanh(mat.numpy_array)
+    _elementwise('tanh(a)', target, a=mat.numpy_array)
 
     return target
 
@@ -1175,7 +1191,7 @@ def log(mat, target = None):
 
     target.resize(mat.shape)
 
-    target.numpy_array[:] = np.log(mat.numpy_array)
+    _elementwise('log(a)', target, a=mat.numpy_array)
 
     return target
 
@@ -1189,7 +1205,7 @@ def exp(mat, target = None):
 
     target.resize(mat.shape)
 
-    target.numpy_array[:] = np.exp(mat.numpy_array)
+    _elementwise('exp(a)', target, a=mat.numpy_array)
 
     return target
 
@@ -1212,7 +1228,7 @@ def sqrt(mat, target = None):
 
     target.resize(mat.shape)
 
-    target.numpy_array[:] = np.sqrt(mat.numpy_array)
+    _elementwise('sqrt(a)', target, a=mat.numpy_array)
 
     return target
 
@@ -1234,7 +1250,7 @@ def pow(mat, p, target = None):
 
     target.resize(mat.shape)
 
-    target.numpy_array[:] = mat.numpy_array[:] ** p
+    _elementwise('a ** p', target, a=mat.numpy_array, p=p)
 
     return target
 
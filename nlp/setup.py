@@ -0,0 +1,36 @@
+"""
+Ahead-of-time build of the Cython kernels used by NLMLayers. From this
+directory, run:
+
+    python setup.py build_ext --inplace
+
+which puts the compiled CythonFuncsPyx module next to CythonFuncs.py. If it
+hasn't been built, CythonFuncs falls back to the Numba kernels.
+
+The kernels are compiled with -O3 for the compiler's default (portable)
+target, so one build runs on any CPU of this architecture. Set NLP_MARCH to
+tune them for some -march, e.g. NLP_MARCH=native for the building machine.
+"""
+
+import os
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Build import cythonize
+from numpy import get_include
+
+models_dir = os.path.dirname(os.path.abspath(__file__))
+os.chdir(models_dir)
+compile_args = ['-O3']
+march = os.environ.get('NLP_MARCH', '')
+if march:
+    compile_args.append('-march={0:s}'.format(march))
+
+extensions = [
+    Extension('CythonFuncsPyx', \
+              ['CythonFuncsPyx.pyx'], \
+              include_dirs=[models_dir, get_include()], \
+              extra_compile_args=compile_args)
+]
+
+setup(name='nlp_kernels', \
+      ext_modules=cythonize(extensions, build_dir='build'))
@@ -0,0 +1,3 @@
+"""
+Code shared by the packages in this repository (see shared/README.md).
+"""
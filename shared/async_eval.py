@@ -0,0 +1,254 @@
+"""
+Asynchronous evaluation of parameter snapshots, shared by the Theano trainers
+(see shared/README.md).
+"""
+import numpy as np
+import traceback
+import Queue
+import multiprocessing as mp
+from collections import OrderedDict
+
+import theano
+
+###############################################################################
+# Asynchronous evaluation of parameter snapshots. The training loop hands    #
+# copies of the network parameters to a worker process, which runs its own  #
+# compiled copy of the metric graph over the validation/test sets and sends #
+# the results back through a queue. Training never waits on evaluation,      #
+# except on a GPU, where AsyncEvaluator falls back to evaluating in-process. #
+###############################################################################
+
+def compile_eval_func(x, y, metrics, eval_params):
+    """
+    Compile metrics as a function of (x, y, *param_values).
+
+    Each shared variable in eval_params is replaced by a fresh symbolic input
+    of the same type, so the compiled function can evaluate any snapshot of
+    the parameters without touching the live shared variables.
+    """
+    p_vars = [p.type() for p in eval_params]
+    p_metrics = theano.clone(metrics, replace=OrderedDict(zip(eval_params, p_vars)))
+    eval_func = theano.function(inputs=([x, y] + p_vars), outputs=p_metrics)
+    return eval_func
+
+def device_is_gpu():
+    """Check if Theano was configured to run on a GPU."""
+    device = str(theano.config.device)
+    return (device.startswith('gpu') or device.startswith('cuda'))
+
+def _eval_snapshot(eval_func, eval_sets, batch_size, param_vals):
+    """
+    Evaluate one snapshot of the parameters on each set in eval_sets.
+
+    Returns one list of metrics for each set. The first metric is treated as a
+    count of classification errors and reported as a percentage, the rest are
+    treated as per-sample means.
+    """
+    set_metrics = []
+    for (X, Y) in eval_sets:
+        obs_count = X.shape[0]
+        metrics = None
+        for b_start in xrange(0, obs_count, batch_size):
+            b_end = min(obs_count, (b_start + batch_size))
+            b_metrics = eval_func(X[b_start:b_end], Y[b_start:b_end], \
+                    *param_vals)
+            b_metrics = [float(b_metrics[0])] + \
+                    [(float(v) * (b_end - b_start)) for v in b_metrics[1:]]
+            if metrics is None:
+                metrics = b_metrics
+            else:
+                metrics = [(m + bm) for (m, bm) in zip(metrics, b_metrics)]
+        metrics[0] = 100. * (metrics[0] / obs_count)
+        metrics[1:] = [(m / obs_count) for m in metrics[1:]]
+        set_metrics.append(metrics)
+    return set_metrics
+
+def _eval_worker(eval_func, eval_sets, batch_size, job_queue, res_queue):
+    """
+    Worker loop for AsyncEvaluator.
+
+    Each job is an (epoch, param_values) pair, and each result is an
+    (epoch, set_metrics, error) triple. If evaluating a snapshot fails, the
+    result carries the formatted traceback as its error, and the worker
+    exits. A None job shuts the worker down.
+    """
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        (epoch, param_vals) = job
+        try:
+            set_metrics = _eval_snapshot(eval_func, eval_sets, batch_size, \
+                    param_vals)
+        except Exception:
+            res_queue.put((epoch, None, traceback.format_exc()))
+            break
+        res_queue.put((epoch, set_metrics, None))
+    return
+
+class AsyncEvaluator(object):
+    """
+    Evaluate snapshots of some network parameters in a separate process.
+
+    The worker is forked from the training process, which is only safe while
+    Theano runs on the CPU, since a forked child can't use its parent's CUDA
+    context. When Theano is on a GPU, snapshots are evaluated in-process as
+    they are submitted instead.
+
+    Parameters:
+        eval_func: function compiled by compile_eval_func()
+        eval_params: the shared variables that eval_func was compiled for
+        eval_sets: list of (X, Y) shared variable pairs to evaluate on
+        mem_mb: memory budget used to pick the evaluation batch size
+        max_pending: maximum number of snapshots waiting for evaluation
+        in_process: evaluate in-process (default: only when on a GPU)
+        poll_secs: how often a blocked wait checks that the worker is alive
+    """
+    def __init__(self, eval_func, eval_params, eval_sets, mem_mb=256, \
+            max_pending=2, in_process=None, poll_secs=1.0):
+        self.eval_func = eval_func
+        self.eval_params = eval_params
+        self.max_pending = max_pending
+        self.poll_secs = poll_secs
+        self.pending = 0
+        if in_process is None:
+            in_process = device_is_gpu()
+        self.in_process = in_process
+        # Pull the evaluation data off of the shared variables, once
+        np_sets = []
+        for (X, Y) in eval_sets:
+            np_X = np.asarray(X.get_value(borrow=True), \
+                    dtype=theano.config.floatX)
+            np_Y = np.asarray(Y.get_value(borrow=True)).astype(np.int32)
+            np_sets.append((np_X, np_Y))
+        self.np_sets = np_sets
+        # Use batches as large as the memory budget allows, estimating the
+        # per-sample footprint from the input and layer output sizes.
+        row_vals = np_sets[0][0].shape[1]
+        for p in eval_params:
+            p_shape = p.get_value(borrow=True).shape
+            if (len(p_shape) == 2):
+                row_vals = row_vals + p_shape[1]
+        row_bytes = 2 * row_vals * np.dtype(theano.config.floatX).itemsize
+        max_rows = max([npX.shape[0] for (npX, npY) in np_sets])
+        self.batch_size = int(max(1, min(max_rows, \
+                (mem_mb * 2**20) / row_bytes)))
+        self.finished = []
+        if self.in_process:
+            self.worker = None
+            return
+        # Start the worker, which will wait for parameter snapshots
+        self.job_queue = mp.Queue()
+        self.res_queue = mp.Queue()
+        self.worker = mp.Process(target=_eval_worker, \
+                args=(eval_func, np_sets, self.batch_size, \
+                self.job_queue, self.res_queue))
+        self.worker.daemon = True
+        self.worker.start()
+        return
+
+    def submit(self, epoch):
+        """
+        Queue a snapshot of the current parameters for evaluation.
+
+        If max_pending snapshots are already waiting, the snapshot is skipped
+        rather than blocking the trainer. Returns True if it was queued. When
+        evaluating in-process, the snapshot is evaluated right away.
+        """
+        if self.in_process:
+            param_vals = [p.get_value(borrow=True) for p in self.eval_params]
+            self.finished.append((epoch, _eval_snapshot(self.eval_func, \
+                    self.np_sets, self.batch_size, param_vals)))
+            return True
+        if (self.pending >= self.max_pending):
+            return False
+        param_vals = [p.get_value(borrow=False) for p in self.eval_params]
+        self.job_queue.put((epoch, param_vals))
+        self.pending = self.pending + 1
+        return True
+
+    def _get_result(self, block):
+        """
+        Get the next (epoch, set_metrics) from the worker, or None if there
+        isn't one yet. A blocked wait polls the queue, so a worker that dies
+        raises a RuntimeError rather than hanging the trainer.
+        """
+        while True:
+            try:
+                (epoch, set_metrics, error) = self.res_queue.get( \
+                        block=block, timeout=self.poll_secs)
+                break
+            except Queue.Empty:
+                if not block:
+                    return None
+                if not self.worker.is_alive():
+                    # a result may have been put just before the worker exited
+                    try:
+                        (epoch, set_metrics, error) = \
+                                self.res_queue.get(timeout=self.poll_secs)
+                        break
+                    except Queue.Empty:
+                        raise RuntimeError("evaluation worker exited with " \
+                                "code {0}".format(self.worker.exitcode))
+        self.pending = self.pending - 1
+        if error is not None:
+            raise RuntimeError("evaluation of epoch {0:d} failed:\n{1:s}".format( \
+                    epoch, error))
+        return (epoch, set_metrics)
+
+    def results(self, block=False):
+        """Get a list of (epoch, set_metrics) for finished evaluations."""
+        finished = self.finished
+        self.finished = []
+        while (self.pending > 0):
+            result = self._get_result(block)
+            if result is None:
+                break
+            finished.append(result)
+        return finished
+
+    def close(self):
+        """Wait for pending evaluations, then shut down the worker."""
+        if self.in_process:
+            return self.results()
+        try:
+            finished = self.results(block=True)
+            self.job_queue.put(None)
+            self.worker.join(self.poll_secs * 10)
+        finally:
+            if self.worker.is_alive():
+                self.worker.terminate()
+                self.worker.join()
+        return finished
+
+def log_eval_results(eval_results, train_log, best, results_file):
+    """
+    Record (epoch, [va_metrics, te_metrics]) results from an AsyncEvaluator.
+
+    train_log maps each submitted epoch to its (train_error, train_loss), and
+    best is a dict tracking the best validation error seen so far, the test
+    error at that point, and the epoch at which it occurred. Each result is
+    also appended to best['history'], as it is written to results_file.
+    """
+    for (e_idx, (va_metrics, te_metrics)) in eval_results:
+        (train_error, train_loss) = train_log.pop(e_idx)
+        tag = " "
+        if (va_metrics[0] < best['va_error']):
+            best['va_error'] = va_metrics[0]
+            best['te_error'] = te_metrics[0]
+            best['epoch'] = e_idx
+            tag = ", test={0:.2f}".format(te_metrics[0])
+        results_file.write("{0:d} {1:.2f} {2:.2f} {3:.2f} {4:.4f} {5:.4f} {6:.4f}\n".format( \
+                e_idx, train_error, va_metrics[0], te_metrics[0], train_loss, \
+                va_metrics[1], te_metrics[1]))
+        results_file.flush()
+        best['history'].append((e_idx, train_error, va_metrics[0], \
+                te_metrics[0], train_loss, va_metrics[1], te_metrics[1]))
+        print "eval {0:d}: valid={1:.2f}, v_loss={2:.4f}{3}".format( \
+                e_idx, va_metrics[0], va_metrics[1], tag)
+    return
+
+
+##############
+# EYE BUFFER #
+##############
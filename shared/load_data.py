@@ -0,0 +1,189 @@
+"""
+MNIST loaders shared by the Theano packages (see shared/README.md).
+"""
+import numpy as np
+import cPickle
+import gzip
+import os
+import sys
+
+import theano
+import theano.tensor as T
+
+def _shared_dataset(data_xy):
+    """ Function that loads the dataset into shared variables
+
+    The reason we store our dataset in shared variables is to allow
+    Theano to copy it into the GPU memory (when code is run on GPU).
+    Since copying data into the GPU is slow, copying a minibatch everytime
+    is needed (the default behaviour if the data is not in a shared
+    variable) would lead to a large decrease in performance.
+    """
+    data_x, data_y = data_xy
+    shared_x = theano.shared(np.asarray(data_x,
+                                           dtype=theano.config.floatX))
+    shared_y = theano.shared(np.asarray(data_y,
+                                           dtype=theano.config.floatX))
+    # When storing data on the GPU it has to be stored as floats
+    # therefore we will store the labels as ``floatX`` as well
+    # (``shared_y`` does exactly that).
+    return shared_x, shared_y
+
+def load_mnist(path, zero_mean=True):
+    mnist = np.load(path)
+    train_set_x = mnist['train_data']
+    train_set_y = mnist['train_labels'] + 1
+    test_set_x = mnist['test_data']
+    test_set_y = mnist['test_labels'] + 1
+
+    if zero_mean:
+        obs_mean = np.mean(train_set_x, axis=0, keepdims=True)
+        train_set_x = train_set_x - obs_mean
+        test_set_x = test_set_x - obs_mean
+
+    train_set_x, train_set_y = _shared_dataset((train_set_x, train_set_y))
+    test_set_x, test_set_y = _shared_dataset((test_set_x, test_set_y))
+    valid_set_x, valid_set_y = test_set_x, test_set_y
+
+    rval = [(train_set_x, train_set_y), (valid_set_x, valid_set_y),
+            (test_set_x, test_set_y)]
+    return rval
+
+def load_udm_ss(dataset, sup_count, rng, zero_mean=True):
+    """Load semi-supervised version of the standard UdM MNIST data.
+
+    For this, the training data is split into labeled and unlabeled portions.
+    The number of labeled examples is 'sup_count', and an equal number of
+    labeled examples will be selected for each class. The remaining (50000 -
+    sup_count) examples are provided as unlabeled training data. The validate
+    and test sets are left unchanged.
+
+    Note: labels for the normal digit classes will range from 1-10, i.e. +1
+    compared to their standard value, as 'un-classed' examples take label 0.
+    """
+
+    udm_data = load_udm(dataset, as_shared=False, zero_mean=zero_mean)
+    return split_udm_ss(udm_data, sup_count, rng)
+
+def split_udm_ss(udm_data, sup_count, rng):
+    """Split in-memory UdM MNIST data as described for load_udm_ss().
+
+    udm_data should be the (non-shared) result of load_udm(as_shared=False).
+    """
+    Xtr = udm_data[0][0]
+    Ytr = udm_data[0][1]
+
+    pc_count = int(np.ceil(sup_count / 10.0))
+
+    # Sample supervised and unsupervised subsets of each class' observations
+    su_idx = []
+    un_idx = []
+    for c_label in np.unique(Ytr):
+        c_idx = np.flatnonzero(Ytr == c_label)
+        rng.shuffle(c_idx)
+        su_idx.append(c_idx[0:pc_count])
+        un_idx.append(c_idx[pc_count:])
+
+    # Shuffle the rows so that observations are not grouped by class, and
+    # gather each subset with a single indexing operation.
+    su_idx = np.concatenate(su_idx)
+    su_idx = su_idx[rng.permutation(su_idx.shape[0])]
+    un_idx = np.concatenate(un_idx)
+    un_idx = un_idx[rng.permutation(un_idx.shape[0])]
+    Xtr_su = Xtr[su_idx,:]
+    Ytr_su = Ytr[su_idx] + 1
+    Xtr_un = Xtr[un_idx,:]
+    Ytr_un = np.zeros(Ytr[un_idx].shape, dtype=Ytr.dtype)
+
+    # Put matrices into GPU shared variables, for great justice
+    Xtr_su, Ytr_su = _shared_dataset((Xtr_su, Ytr_su))
+    Xtr_un, Ytr_un = _shared_dataset((Xtr_un, Ytr_un))
+    Xva, Yva = _shared_dataset((udm_data[1][0], (udm_data[1][1] + 1)))
+    Xte, Yte = _shared_dataset((udm_data[2][0], (udm_data[2][1] + 1)))
+
+    rval = [(Xtr_su, Ytr_su), (Xtr_un, Ytr_un), (Xva, Yva), (Xte, Yte)]
+
+    return rval
+
+UDM_CACHE_KEYS = ['train_x', 'train_y', 'valid_x', 'valid_y', \
+        'test_x', 'test_y']
+
+def _udm_cache_dir(dataset):
+    """Get the directory for the .npy cache of the given UdM pickle."""
+    cache_dir = dataset
+    for ext in ['.gz', '.pkl']:
+        if cache_dir.endswith(ext):
+            cache_dir = cache_dir[:-len(ext)]
+    return cache_dir + "_npy"
+
+def _build_udm_cache(dataset, cache_dir):
+    """Convert the UdM MNIST pickle into a directory of .npy files.
+
+    Observations are stored as float32 and labels as uint8. Each file is
+    written under a temporary name and then renamed, so an interrupted
+    conversion never leaves a partial cache behind.
+    """
+    if not os.path.isfile(dataset):
+        raise IOError("can't find {0} (it won't be downloaded)".format(dataset))
+    print '... converting {0} to {1}'.format(dataset, cache_dir)
+    f = gzip.open(dataset, 'rb')
+    train_set, valid_set, test_set = cPickle.load(f)
+    f.close()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for (name, (X, Y)) in zip(['train', 'valid', 'test'], \
+            [train_set, valid_set, test_set]):
+        for (key, A) in [(name + '_x', np.asarray(X, dtype=np.float32)), \
+                (name + '_y', np.asarray(Y, dtype=np.uint8))]:
+            npy_file = os.path.join(cache_dir, key + ".npy")
+            tmp_file = os.path.join(cache_dir, key + ".tmp.npy")
+            np.save(tmp_file, A)
+            os.rename(tmp_file, npy_file)
+    return
+
+def _load_udm_cache(dataset):
+    """Memory-map the cached UdM MNIST arrays, building the cache if needed.
+
+    Returns a dict mapping the names in UDM_CACHE_KEYS to read-only arrays.
+    Labels come back as int32, everything else stays memory-mapped.
+    """
+    cache_dir = _udm_cache_dir(dataset)
+    npy_files = [os.path.join(cache_dir, key + ".npy") for key in UDM_CACHE_KEYS]
+    if not all([os.path.isfile(f) for f in npy_files]):
+        _build_udm_cache(dataset, cache_dir)
+    udm_arrays = {}
+    for (key, npy_file) in zip(UDM_CACHE_KEYS, npy_files):
+        udm_arrays[key] = np.load(npy_file, mmap_mode='r')
+        if key.endswith('_y'):
+            udm_arrays[key] = udm_arrays[key].astype(np.int32)
+    return udm_arrays
+
+def load_udm(dataset, as_shared=True, zero_mean=True):
+    """Loads the UdM train/validate/test split of MNIST.
+
+    The pickled dataset is only decoded the first time, after which its
+    arrays are memory-mapped from a .npy cache next to it. With zero_mean
+    False and as_shared False, the observations are read-only memmaps.
+    """
+
+    print '... loading data'
+    udm_arrays = _load_udm_cache(dataset)
+    train_set = [udm_arrays['train_x'], udm_arrays['train_y']]
+    valid_set = [udm_arrays['valid_x'], udm_arrays['valid_y']]
+    test_set = [udm_arrays['test_x'], udm_arrays['test_y']]
+    if zero_mean:
+        obs_mean = np.mean(train_set[0], axis=0, keepdims=True)
+        train_set[0] = train_set[0] - obs_mean
+        valid_set[0] = valid_set[0] - obs_mean
+        test_set[0] = test_set[0] - obs_mean
+    rval = [(train_set[0], train_set[1]), (valid_set[0], valid_set[1]),
+            (test_set[0], test_set[1])]
+    if as_shared:
+        rval = share_udm(rval)
+    return rval
+
+def share_udm(udm_data):
+    """Put in-memory UdM MNIST data into shared variables, as load_udm()."""
+    rval = [_shared_dataset((X, (Y + 1))) for (X, Y) in udm_data]
+    return rval
+
@@ -0,0 +1,116 @@
+"""
+Per-phase wall-clock profiling for training loops.
+
+This is the one PhaseProfiler in the repository. The nlp models and layers
+use it through nlp/HelperFuncs, and the Theano trainers through their
+utils.py.
+"""
+
+import time
+import json
+
+#######################
+# PER-PHASE PROFILING #
+#######################
+
+# wall-clock timer (time.clock() measures CPU time on most platforms)
+wall_time = getattr(time, 'perf_counter', time.time)
+
+class PhaseProfiler(object):
+    """
+    Named wall-clock timers and counters for the phases of a training loop.
+
+    Bracket each phase with start(name)/stop(name), bump counters with
+    count(name, n), and call end_batch() once per batch. The totals for each
+    window of report_every batches are appended to self.windows, and written
+    as a JSON line to out_file (if given). When disabled, each hook costs just
+    a method call and a test.
+    """
+    def __init__(self, enabled=True, report_every=100, out_file=None, tag=''):
+        self.enabled = enabled
+        self.report_every = report_every
+        self.out_file = out_file
+        self.tag = tag
+        self.reset()
+        return
+
+    def reset(self):
+        """Clear all timers, counters, and finished windows."""
+        self.batches = 0
+        self.seconds = {}
+        self.counts = {}
+        self.total_batches = 0
+        self.total_seconds = {}
+        self.total_counts = {}
+        self.windows = []
+        self.starts = {}
+        return
+
+    def start(self, name):
+        """Start (or restart) the timer for phase name."""
+        if self.enabled:
+            self.starts[name] = wall_time()
+        return
+
+    def stop(self, name):
+        """Stop the timer for phase name, and add its time to the window."""
+        if self.enabled:
+            t = wall_time() - self.starts.pop(name)
+            self.seconds[name] = self.seconds.get(name, 0.0) + t
+        return
+
+    def count(self, name, n=1):
+        """Add n to the counter name."""
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+        return
+
+    def end_batch(self):
+        """Mark the end of a batch, closing the window every report_every."""
+        if self.enabled:
+            self.batches += 1
+            if (self.batches >= self.report_every):
+                self.flush()
+        return
+
+    def flush(self):
+        """Close the current window of batches (if it's not empty)."""
+        if ((self.batches == 0) and (len(self.seconds) == 0)):
+            return None
+        window = {'tag': self.tag, 'first_batch': self.total_batches, \
+                  'batches': self.batches, 'seconds': self.seconds, \
+                  'counts': self.counts}
+        self.total_batches += self.batches
+        for (name, t) in self.seconds.items():
+            self.total_seconds[name] = self.total_seconds.get(name, 0.0) + t
+        for (name, n) in self.counts.items():
+            self.total_counts[name] = self.total_counts.get(name, 0) + n
+        self.windows.append(window)
+        if not (self.out_file is None):
+            with open(self.out_file, 'a') as f:
+                f.write(json.dumps(window, sort_keys=True) + '\n')
+        self.batches = 0
+        self.seconds = {}
+        self.counts = {}
+        return window
+
+    def report(self):
+        """Flush, then get a summary of the time spent in each phase."""
+        self.flush()
+        all_time = sum(self.total_seconds.values())
+        lines = ["{0:d} batches, {1:.3f}s in timed phases".format( \
+                self.total_batches, all_time)]
+        for (name, t) in sorted(self.total_seconds.items(), \
+                                key=lambda x: -x[1]):
+            ms_per_batch = 1000.0 * t / max(1, self.total_batches)
+            lines.append("  {0:s}: {1:.3f}s, {2:.3f}ms/batch, {3:.1f}%".format( \
+                    name, t, ms_per_batch, 100.0 * t / max(all_time, 1e-12)))
+        for (name, n) in sorted(self.total_counts.items()):
+            lines.append("  {0:s}: {1:d} ({2:.0f}/s)".format( \
+                    name, n, n / max(all_time, 1e-12)))
+        return "\n".join(lines)
+
+
+##############
+# EYE BUFFER #
+##############
@@ -0,0 +1,228 @@
+"""
+Parallel test sweeps, shared by the Theano packages (see shared/README.md).
+"""
+###############################################################################
+# Run batches of independent tests (e.g. one per random seed) in parallel,   #
+# using local worker processes. The dataset is loaded once, into shared      #
+# memory, and every test adds a record to a single JSON-lines results file.  #
+###############################################################################
+
+import numpy as np
+import os
+import sys
+import time
+import json
+import ctypes
+import traceback
+import Queue
+import multiprocessing as mp
+
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', \
+        'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+# Thread-count setters and getters of the BLAS libraries that can be limited
+# after they have been loaded, keyed by part of the library's file name.
+BLAS_THREAD_FUNCS = [('openblas', 'openblas_set_num_threads', \
+        'openblas_get_num_threads'), ('mkl_rt', 'MKL_Set_Num_Threads', \
+        'MKL_Get_Max_Threads')]
+
+def _loaded_libraries():
+    """Get the paths of the shared libraries loaded into this process."""
+    try:
+        maps = open('/proc/self/maps')
+    except IOError:
+        return []
+    paths = set()
+    for line in maps:
+        path = line.split()[-1]
+        if (path.startswith('/') and ('.so' in path)):
+            paths.add(path)
+    maps.close()
+    return sorted(paths)
+
+def limit_blas_threads(thread_count):
+    """
+    Limit the number of threads used by BLAS in this process.
+
+    The environment variables only affect BLAS libraries that start up later,
+    e.g. in processes launched from this one. A library that's already loaded
+    (e.g. numpy's OpenBLAS) is limited through its own API instead, and the
+    limit is checked by reading it back. Returns the paths of the libraries
+    that were limited.
+    """
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = str(thread_count)
+    limited = []
+    for path in _loaded_libraries():
+        lib_name = os.path.basename(path)
+        for (tag, set_name, get_name) in BLAS_THREAD_FUNCS:
+            if not (tag in lib_name):
+                continue
+            lib = ctypes.CDLL(path)
+            if not (hasattr(lib, set_name) and hasattr(lib, get_name)):
+                continue
+            getattr(lib, set_name)(ctypes.c_int(thread_count))
+            lib_threads = getattr(lib, get_name)()
+            if (lib_threads > thread_count):
+                raise RuntimeError("{0:s} still uses {1:d} threads".format( \
+                        lib_name, lib_threads))
+            limited.append(path)
+    return limited
+
+def _to_shared_array(X):
+    """Copy the numpy array X into a new array backed by shared memory."""
+    X = np.ascontiguousarray(X)
+    raw_buf = mp.RawArray('b', max(1, X.nbytes))
+    X_shared = np.frombuffer(raw_buf, dtype=X.dtype, count=X.size)
+    X_shared = X_shared.reshape(X.shape)
+    X_shared[...] = X
+    return X_shared
+
+def share_arrays(data):
+    """
+    Move all numpy arrays in some nested lists/tuples into shared memory.
+
+    Returns data with the same nesting, in which each array has been replaced
+    by a copy backed by shared memory. Worker processes forked afterwards will
+    all read from the same copy, rather than each loading the data themselves.
+    """
+    if isinstance(data, np.ndarray):
+        return _to_shared_array(data)
+    if isinstance(data, (list, tuple)):
+        return type(data)([share_arrays(d) for d in data])
+    return data
+
+def _device_is_gpu():
+    """Check if this process has set Theano up to run on a GPU."""
+    if not ('theano' in sys.modules):
+        return False
+    from shared.async_eval import device_is_gpu
+    return device_is_gpu()
+
+def _run_test(test_func, test_num, test_data):
+    """Run a single test, and make a record of its outcome."""
+    t_start = time.time()
+    record = {'test_num': test_num, 'pid': os.getpid()}
+    try:
+        record['result'] = test_func(test_num, test_data)
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['seconds'] = time.time() - t_start
+    return record
+
+def _sweep_worker(test_func, test_data, thread_count, job_queue, res_queue):
+    """
+    Worker loop for run_sweep().
+
+    Each job is a test number, and each result is a dict describing the
+    outcome of test_func(test_num, test_data). A None job shuts the worker
+    down.
+    """
+    limit_blas_threads(thread_count)
+    while True:
+        test_num = job_queue.get()
+        if test_num is None:
+            break
+        res_queue.put(_run_test(test_func, test_num, test_data))
+    return
+
+def _log_record(record, sweep_tag, out_file):
+    """Write a test's record to the results file, and report it."""
+    record['sweep'] = sweep_tag
+    out_file.write(json.dumps(record) + "\n")
+    out_file.flush()
+    if 'error' in record:
+        print("sweep {0}: test {1:d} failed:\n{2}".format( \
+                sweep_tag, record['test_num'], record['error']))
+    else:
+        print("sweep {0}: test {1:d} done in {2:.1f}s".format( \
+                sweep_tag, record['test_num'], record['seconds']))
+    return
+
+def run_sweep(test_func, test_nums, test_data, sweep_tag, proc_count=None, \
+        threads_per_proc=1, results_file=None, poll_secs=5.0):
+    """
+    Run test_func(test_num, test_data) for each test_num, in parallel.
+
+    Parameters:
+        test_func: function that runs a single test and returns a summary of
+                   its results, which must be JSON serializable
+        test_nums: the test numbers (e.g. random seeds) to run
+        test_data: (nested lists/tuples of) numpy arrays, which are moved into
+                   shared memory once and handed to every test
+        sweep_tag: name for this sweep, recorded with each result
+        proc_count: number of worker processes (default: one per group of
+                    threads_per_proc cores)
+        threads_per_proc: BLAS thread limit for each worker
+        results_file: JSON-lines file to append results to (default:
+                      "sweep_<sweep_tag>.jsonl")
+        poll_secs: how often to check that the workers are still alive
+
+    If the workers die before finishing (e.g. killed for running out of
+    memory), the tests that never reported back are recorded as errors.
+    Forked workers can't use a CUDA context set up by this process, so if
+    Theano is running on a GPU the tests are run one at a time, in-process.
+    """
+    test_nums = list(test_nums)
+    if proc_count is None:
+        proc_count = max(1, mp.cpu_count() / threads_per_proc)
+    proc_count = max(1, min(proc_count, len(test_nums)))
+    if results_file is None:
+        results_file = "sweep_{0}.jsonl".format(sweep_tag)
+    if _device_is_gpu():
+        print("sweep {0}: {1:d} tests, in-process on the GPU".format( \
+                sweep_tag, len(test_nums)))
+        records = []
+        out_file = open(results_file, 'ab')
+        for test_num in test_nums:
+            record = _run_test(test_func, test_num, test_data)
+            _log_record(record, sweep_tag, out_file)
+            records.append(record)
+        out_file.close()
+        return records
+    test_data = share_arrays(test_data)
+
+    print("sweep {0}: {1:d} tests, {2:d} processes, {3:d} threads each".format( \
+            sweep_tag, len(test_nums), proc_count, threads_per_proc))
+    job_queue = mp.Queue()
+    res_queue = mp.Queue()
+    for test_num in test_nums:
+        job_queue.put(test_num)
+    # Workers aren't daemonic, as the trainers start their own evaluators.
+    workers = []
+    for i in range(proc_count):
+        job_queue.put(None)
+        worker = mp.Process(target=_sweep_worker, args=(test_func, \
+                test_data, threads_per_proc, job_queue, res_queue))
+        worker.start()
+        workers.append(worker)
+
+    records = []
+    done_nums = set()
+    out_file = open(results_file, 'ab')
+    while (len(done_nums) < len(test_nums)):
+        try:
+            record = res_queue.get(timeout=poll_secs)
+        except Queue.Empty:
+            if any([worker.is_alive() for worker in workers]):
+                continue
+            # a record may have been put just before the last worker exited
+            try:
+                record = res_queue.get(timeout=poll_secs)
+            except Queue.Empty:
+                break
+        _log_record(record, sweep_tag, out_file)
+        done_nums.add(record['test_num'])
+        records.append(record)
+    exit_codes = [worker.exitcode for worker in workers]
+    for test_num in test_nums:
+        if not (test_num in done_nums):
+            record = {'test_num': test_num, 'pid': None, 'seconds': None, \
+                    'error': "workers exited before the test finished " \
+                    "(exit codes: {0})".format(exit_codes)}
+            _log_record(record, sweep_tag, out_file)
+            records.append(record)
+    out_file.close()
+    for worker in workers:
+        worker.join()
+    return records